@@ -49,6 +49,11 @@ doc_events = {
     },
     "GL Entry": {
         "before_insert": "integracion.integracion.renumerar_asientos.before_insert"
+    },
+    "Bibliotecas SP": {
+        "on_update": "integracion.integracion.bibliotecas_sp.clear_library_cache",
+        "on_trash": "integracion.integracion.bibliotecas_sp.clear_library_cache",
+        "after_rename": "integracion.integracion.bibliotecas_sp.clear_library_cache"
     }
 }
 
@@ -56,6 +61,8 @@ override_whitelisted_methods = {
     "integracion.create_purchase_invoice": "integracion.integracion.create_purchase_invoice.create_purchase_invoice",
     "integracion.integracion.employee_link_override.filter_employees": "integracion.integracion.employee_link_override.filter_employees",
     "integracion.integracion.subir_archivo_sp.get_sharepoint_structure" : "integracion.integracion.subir_archivo_sp.get_sharepoint_structure",
+    "integracion.integracion.subir_archivo_sp.get_upload_status" : "integracion.integracion.subir_archivo_sp.get_upload_status",
+    "integracion.integracion.subir_archivo_sp.get_sharepoint_folder" : "integracion.integracion.subir_archivo_sp.get_sharepoint_folder",
     "integracion.integracion.generate_c34_compra": "integracion.integracion.generate_c34_compra.generate_c34_compra",
     "integracion.integracion.generate_c34_venta": "integracion.integracion.generate_c34_venta.generate_c34_venta",
     "integracion.integracion.sii.sii_integracion.enviar_facturas_emitidas_wrapper": "integracion.integracion.sii.sii_integracion.enviar_facturas_emitidas_wrapper",
@@ -119,6 +126,9 @@ scheduler_events = {
         "0 16 * * *":[
             #"integracion.integracion.hc_diary_noti.enviar_notificacion_a_asesoria"
         ],
+        "*/5 * * * *": [
+            "integracion.integracion.subir_archivo_sp.process_pending_uploads"
+        ],
 
     },
     "daily": [
@@ -0,0 +1,205 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+import frappe
+from integracion.integracion.conexion_sp import get_sharepoint_context
+from integracion.integracion.carpetas_sp import normalize_path
+
+site_config = frappe.get_site_config()
+
+# Hilos del proceso dedicados a listar carpetas hermanas en paralelo
+MAX_HILOS_ARBOL = int(site_config.get('sp_hilos_arbol') or 4)
+# Carpetas hermanas que se piden en cada petición por lotes ($batch)
+TAMANO_LOTE_ARBOL = 20
+# Segundos durante los que se sirve la estructura sin consultar SharePoint
+TTL_ESTRUCTURA = int(site_config.get('sp_ttl_estructura') or 60)
+# Pasado este tiempo la estructura se reconstruye aunque ninguna carpeta haya cambiado
+TTL_MAX_ESTRUCTURA = int(site_config.get('sp_ttl_max_estructura') or 900)
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/arbol_sp.log', maxBytes=5 * 1024 * 1024, backupCount=3)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Pool acotado y compartido por el proceso; cada hilo usa su propio contexto
+_executor = ThreadPoolExecutor(max_workers=MAX_HILOS_ARBOL, thread_name_prefix="arbol_sp")
+
+
+def list_folders_batch(site_url, rutas):
+    """
+    Lista subcarpetas y archivos de varias carpetas en una sola petición,
+    expandiendo `Folders` y `Files` de cada una. Devuelve, en el mismo orden
+    que `rutas`, una tupla (nombres de carpetas, nombres de archivos,
+    TimeLastModified de la carpeta o None si no se pudo listar).
+    """
+    try:
+        ctx = get_sharepoint_context(site_url)
+        if not ctx:
+            raise Exception(f"No se pudo conectar a SharePoint: {site_url}")
+
+        folders = [
+            ctx.web.get_folder_by_server_relative_url(normalize_path(ruta)).expand(["Folders", "Files"]).get()
+            for ruta in rutas
+        ]
+        if len(folders) == 1:
+            ctx.execute_query()
+        else:
+            ctx.execute_batch()
+
+        return [
+            (
+                [f.properties["Name"] for f in folder.folders],
+                [f.properties["Name"] for f in folder.files],
+                str(folder.properties.get("TimeLastModified"))
+            )
+            for folder in folders
+        ]
+    except Exception as e:
+        logger.error(f"Error procesando las carpetas {rutas}: {e}")
+        return [([], [], None) for _ in rutas]
+
+
+def build_tree(site_url, ruta, carpeta_actual, max_depth=None, modificados=None):
+    """
+    Rellena `carpeta_actual["children"]` con el contenido de `ruta` nivel a
+    nivel: cada nivel se resuelve con una petición por lote de carpetas
+    hermanas, repartidas en el pool de hilos. Con `max_depth` se detiene en
+    esa profundidad y marca las carpetas no exploradas con `"expandir": True`
+    para que el cliente las pida bajo demanda.
+
+    Si se pasa `modificados`, se rellena con el TimeLastModified de cada
+    carpeta listada (None si falló), que es lo que se revalida en la caché.
+    """
+    nivel = [(ruta, carpeta_actual)]
+    profundidad = 0
+
+    while nivel and (max_depth is None or profundidad < max_depth):
+        lotes = [nivel[i:i + TAMANO_LOTE_ARBOL] for i in range(0, len(nivel), TAMANO_LOTE_ARBOL)]
+        resultados = _executor.map(lambda lote: list_folders_batch(site_url, [r for r, _ in lote]), lotes)
+
+        siguiente_nivel = []
+        for lote, contenidos in zip(lotes, resultados):
+            for (ruta_carpeta, nodo), (carpetas, archivos, modificado) in zip(lote, contenidos):
+                if modificados is not None:
+                    modificados[ruta_carpeta] = modificado
+                for nombre in carpetas:
+                    subcarpeta = {
+                        "tipo": "C",
+                        "nombre": nombre,
+                        'url': f"{site_url}/{ruta_carpeta}/{nombre}",
+                        "children": []
+                    }
+                    nodo["children"].append(subcarpeta)
+                    siguiente_nivel.append((f"{ruta_carpeta}/{nombre}", subcarpeta))
+
+                for nombre in archivos:
+                    nodo["children"].append({
+                        "tipo": "F",
+                        "nombre": nombre,
+                        'url': f"{site_url}/{ruta_carpeta}/{nombre}"
+                    })
+
+        logger.info(f"Nivel {profundidad} de {ruta}: {len(nivel)} carpetas en {len(lotes)} peticiones")
+        nivel = siguiente_nivel
+        profundidad += 1
+
+    for _, nodo in nivel:
+        nodo["expandir"] = True
+
+    return carpeta_actual
+
+
+def structure_cache_key(doctype, docname, max_depth, site_url, ruta):
+    # La carpeta resuelta forma parte de la clave: si cambia la biblioteca o la
+    # estructura del documento, la entrada antigua deja de usarse
+    carpeta = f"{site_url}/{normalize_path(ruta)}".lower()
+    return f"estructura_sp|{doctype}|{docname}|{max_depth or 0}|{carpeta}"
+
+
+def get_folders_last_modified(site_url, rutas):
+    """
+    TimeLastModified de varias carpetas con peticiones por lotes de carpetas
+    repartidas en el pool de hilos. Devuelve un diccionario ruta -> fecha.
+    """
+    rutas = list(rutas)
+    lotes = [rutas[i:i + TAMANO_LOTE_ARBOL] for i in range(0, len(rutas), TAMANO_LOTE_ARBOL)]
+
+    def consultar(lote):
+        ctx = get_sharepoint_context(site_url)
+        if not ctx:
+            raise Exception(f"No se pudo conectar a SharePoint: {site_url}")
+        folders = [
+            ctx.web.get_folder_by_server_relative_url(normalize_path(ruta)).select(["TimeLastModified"]).get()
+            for ruta in lote
+        ]
+        if len(folders) == 1:
+            ctx.execute_query()
+        else:
+            ctx.execute_batch()
+        return [str(folder.properties.get("TimeLastModified")) for folder in folders]
+
+    modificados = {}
+    for lote, fechas in zip(lotes, _executor.map(consultar, lotes)):
+        modificados.update(zip(lote, fechas))
+    return modificados
+
+
+def get_cached_structure(doctype, docname, max_depth, site_url, ruta):
+    """
+    Devuelve el JSON cacheado de la estructura del documento o None si hay
+    que reconstruirla. Dentro de `TTL_ESTRUCTURA` no se llama a SharePoint;
+    después se revalida el TimeLastModified de todas las carpetas listadas en
+    el árbol (un lote de peticiones), ya que el de una carpeta solo cambia
+    con sus hijos directos.
+    """
+    key = structure_cache_key(doctype, docname, max_depth, site_url, ruta)
+    entrada = frappe.cache().get_value(key)
+    if not entrada:
+        return None
+
+    ahora = frappe.utils.now_datetime().timestamp()
+    if ahora - entrada["creado"] > TTL_MAX_ESTRUCTURA:
+        return None
+    if ahora - entrada["validado"] < TTL_ESTRUCTURA:
+        return entrada["json"]
+
+    try:
+        if get_folders_last_modified(site_url, entrada["modificados"]) == entrada["modificados"]:
+            entrada["validado"] = ahora
+            frappe.cache().set_value(key, entrada, expires_in_sec=TTL_MAX_ESTRUCTURA)
+            logger.info(f"Estructura de {doctype} {docname} revalidada sin cambios")
+            return entrada["json"]
+    except Exception as e:
+        logger.warning(f"No se pudo revalidar la estructura de {doctype} {docname}: {e}")
+    return None
+
+
+def set_cached_structure(doctype, docname, max_depth, site_url, ruta, modificados, estructura_json):
+    """
+    Guarda la estructura junto con el TimeLastModified de cada carpeta
+    listada. No se guarda si alguna carpeta no se pudo listar.
+    """
+    if not modificados or not all(modificados.values()):
+        logger.warning(f"No se cachea la estructura de {doctype} {docname}: hay carpetas sin listar")
+        return
+
+    ahora = frappe.utils.now_datetime().timestamp()
+    frappe.cache().set_value(structure_cache_key(doctype, docname, max_depth, site_url, ruta), {
+        "modificados": modificados,
+        "json": estructura_json,
+        "creado": ahora,
+        "validado": ahora
+    }, expires_in_sec=TTL_MAX_ESTRUCTURA)
+
+
+def invalidate_structure_cache(doctype=None, docname=None):
+    """
+    Olvida las estructuras cacheadas del documento o, sin argumentos, todas.
+    """
+    if doctype and docname:
+        frappe.cache().delete_keys(f"estructura_sp|{doctype}|{docname}|")
+    else:
+        frappe.cache().delete_keys("estructura_sp|")
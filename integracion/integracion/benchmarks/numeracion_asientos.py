@@ -0,0 +1,62 @@
+"""
+Compara el coste de asignar el número de asiento de un GL Entry con la
+consulta MAX(custom_numero) anterior y con el contador de 'Contador Asientos'.
+
+    bench --site <sitio> execute integracion.integracion.benchmarks.numeracion_asientos.run
+
+Se mide cada empresa y año del libro: el coste de la consulta MAX crece con
+las filas del año, el del contador se mantiene plano. Todo se deshace al final.
+"""
+import time
+import frappe
+from integracion.integracion.renumerar_asientos import siguiente_numero
+
+
+def medir(funcion, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion()
+    return (time.perf_counter() - inicio) * 1000 / repeticiones
+
+
+def run(repeticiones=20, lineas_por_voucher=20):
+    repeticiones = int(repeticiones)
+    lineas_por_voucher = int(lineas_por_voucher)
+
+    libros = frappe.db.sql("""
+        SELECT company, YEAR(posting_date) AS year, COUNT(*) AS filas
+        FROM `tabGL Entry`
+        GROUP BY company, YEAR(posting_date)
+        ORDER BY filas ASC
+    """, as_dict=True)
+
+    resultados = []
+    try:
+        for libro in libros:
+            def consulta_max():
+                frappe.db.sql("""
+                    SELECT MAX(custom_numero)
+                    FROM `tabGL Entry`
+                    WHERE YEAR(posting_date) = %s
+                    AND company = %s
+                """, (libro.year, libro.company))
+
+            # Antes: una consulta MAX por cada línea del voucher
+            ms_max = medir(consulta_max, repeticiones) * lineas_por_voucher
+            # Ahora: un incremento del contador por voucher, las líneas hermanas usan la memoria
+            siguiente_numero(libro.company, libro.year)
+            ms_contador = medir(lambda: siguiente_numero(libro.company, libro.year), repeticiones)
+
+            resultados.append({
+                "company": libro.company,
+                "year": libro.year,
+                "filas": libro.filas,
+                "ms_voucher_max": round(ms_max, 3),
+                "ms_voucher_contador": round(ms_contador, 3)
+            })
+            print(f"{libro.company} {libro.year}: {libro.filas} filas, "
+                  f"MAX {ms_max:.3f} ms/voucher, contador {ms_contador:.3f} ms/voucher")
+    finally:
+        frappe.db.rollback()
+
+    return resultados
@@ -0,0 +1,129 @@
+"""
+Compara el coste de construir y validar el sobre SII de facturas emitidas con
+el método anterior (SubElement con el nombre completo de cada elemento,
+tostring con pretty_print y el XSD compilado en cada validación) y con el
+constructor de `xml_sii` (nombres cualificados precalculados, cada registro
+escrito elemento a elemento con xmlfile y esquema de la caché del proceso).
+
+    bench --site <sitio> execute integracion.integracion.benchmarks.xml_sii.run --kwargs "{'facturas': 10000}"
+
+Cada medida es la mediana de `repeticiones` ejecuciones. Las facturas son
+sintéticas, no se lee ni se escribe nada en la base de datos.
+"""
+import io
+import statistics
+import time
+from lxml import etree
+from integracion.integracion.sii.method.xml_sii import (
+    ELEMENTOS_LR, NS_SII, NS_SII_LR, NS_SOAPENV, NSMAP, XSD_SII, build_envelope, validate_envelope
+)
+from integracion.integracion.sii.method.runtime_sii import get_schema
+
+SERVICIO = "SuministroLRFacturasEmitidas"
+REGISTRO = "RegistroLRFacturasEmitidas"
+
+
+def build_datos(facturas):
+    return {
+        'Cabecera': {
+            'IDVersionSii': "1.1",
+            'Titular': {'NombreRazon': "Empresa de Pruebas SL", 'NIF': "B00000000"},
+            'TipoComunicacion': "A0"
+        },
+        REGISTRO: [
+            {
+                'PeriodoLiquidacion': {'Ejercicio': "2024", 'Periodo': "10"},
+                'IDFactura': {
+                    'IDEmisorFactura': {'NIF': "B00000000"},
+                    'NumSerieFacturaEmisor': f"FV-2024-{i:06d}",
+                    'FechaExpedicionFacturaEmisor': "15-10-2024"
+                },
+                'FacturaExpedida': {
+                    'TipoFactura': "F1",
+                    'ClaveRegimenEspecialOTrascendencia': "01",
+                    'ImporteTotal': "121.00",
+                    'DescripcionOperacion': "Venta de Producto/Servicio",
+                    'Contraparte': {'NombreRazon': f"Cliente {i}", 'NIF': "12345678Z"},
+                    'TipoDesglose': {
+                        'DesgloseFactura': {
+                            'Sujeta': {
+                                'NoExenta': {
+                                    'TipoNoExenta': "S1",
+                                    'DesgloseIVA': {
+                                        'DetalleIVA': [{'TipoImpositivo': "21", 'BaseImponible': "100.00", 'CuotaRepercutida': "21.00"}]
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+            for i in range(facturas)
+        ]
+    }
+
+
+def add_sub_elements(padre, nombre, valor):
+    # Método anterior: nombre completo en notación Clark en cada SubElement
+    if isinstance(valor, list):
+        for item in valor:
+            add_sub_elements(padre, nombre, item)
+        return
+
+    elemento = etree.SubElement(padre, f"{{{NS_SII_LR if nombre in ELEMENTOS_LR else NS_SII}}}{nombre}")
+    if isinstance(valor, dict):
+        for hijo, valor_hijo in valor.items():
+            add_sub_elements(elemento, hijo, valor_hijo)
+    else:
+        elemento.text = str(valor)
+
+
+def build_envelope_anterior(datos):
+    envelope = etree.Element(f"{{{NS_SOAPENV}}}Envelope", nsmap=NSMAP)
+    body = etree.SubElement(envelope, f"{{{NS_SOAPENV}}}Body")
+    root = etree.SubElement(body, f"{{{NS_SII_LR}}}{SERVICIO}")
+    add_sub_elements(root, "Cabecera", datos["Cabecera"])
+    add_sub_elements(root, REGISTRO, datos[REGISTRO])
+    return etree.tostring(envelope, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+
+
+def validate_anterior(xml_data):
+    schema = etree.XMLSchema(etree.parse(XSD_SII))
+    body_content = etree.fromstring(xml_data).find(f".//{{{NS_SOAPENV}}}Body/*")
+    return schema.validate(body_content)
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return resultado, statistics.median(tiempos)
+
+
+def run(facturas=10000, repeticiones=5):
+    facturas = int(facturas)
+    repeticiones = int(repeticiones)
+    datos = build_datos(facturas)
+    # El esquema se compila una vez por proceso; la primera compilación no cuenta
+    get_schema(XSD_SII)
+
+    xml_anterior, ms_construir_anterior = medir(lambda: build_envelope_anterior(datos), repeticiones)
+    _, ms_validar_anterior = medir(lambda: validate_anterior(xml_anterior), repeticiones)
+
+    xml_nuevo, ms_construir = medir(lambda: build_envelope(SERVICIO, REGISTRO, datos, pretty_print=False), repeticiones)
+    _, ms_validar = medir(lambda: validate_envelope(io.BytesIO(xml_nuevo)), repeticiones)
+
+    resultado = {
+        "facturas": facturas,
+        "ms_construir_anterior": round(ms_construir_anterior, 1),
+        "ms_validar_anterior": round(ms_validar_anterior, 1),
+        "kb_anterior": len(xml_anterior) // 1024,
+        "ms_construir": round(ms_construir, 1),
+        "ms_validar": round(ms_validar, 1),
+        "kb": len(xml_nuevo) // 1024
+    }
+    print(f"{facturas} facturas: anterior {ms_construir_anterior:.1f} ms + {ms_validar_anterior:.1f} ms validación "
+          f"({resultado['kb_anterior']} KB), nuevo {ms_construir:.1f} ms + {ms_validar:.1f} ms validación ({resultado['kb']} KB)")
+    return resultado
@@ -0,0 +1,117 @@
+import logging
+from logging.handlers import RotatingFileHandler
+import frappe
+from integracion.integracion.arbol_sp import invalidate_structure_cache
+
+CACHE_KEY_BIBLIOTECAS = "bibliotecas_sp_map"
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/bibliotecas_sp.log', maxBytes=5 * 1024 * 1024, backupCount=3)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+
+def split_sharepoint_url(url_sp):
+    """
+    Separa la URL completa de una biblioteca en la URL del sitio y la ruta
+    relativa al sitio. Devuelve (None, None) si la URL no contiene '/sites/'.
+    """
+    start_idx = url_sp.find('/sites/')
+    if start_idx == -1:
+        return None, None
+
+    end_idx = start_idx + len('/sites/') + url_sp[start_idx + len('/sites/'):].find('/')
+    return url_sp[:end_idx], url_sp[end_idx + 1:]
+
+
+def build_library_map():
+    """
+    Precalcula el enrutado de 'Bibliotecas SP' con dos consultas:
+    docname (o tipo de proyecto) -> url_sp y doctype -> url_sp con los
+    docnames de su tabla hija.
+    """
+    por_docname = {}
+    por_doctype = {}
+
+    bibliotecas = frappe.get_all("Bibliotecas SP", fields=["name", "documento", "url_sp"], order_by="creation asc")
+    url_por_biblioteca = {b.name: b.url_sp for b in bibliotecas}
+
+    docnames_por_biblioteca = {}
+    for biblioteca in bibliotecas:
+        if biblioteca.documento and biblioteca.documento not in por_doctype:
+            por_doctype[biblioteca.documento] = {"url_sp": biblioteca.url_sp, "docnames": set()}
+            docnames_por_biblioteca[biblioteca.name] = por_doctype[biblioteca.documento]["docnames"]
+
+    entradas = frappe.get_all(
+        "Bibliotecas SP Docnames",
+        filters={"parenttype": "Bibliotecas SP"},
+        fields=["parent", "docname"],
+        order_by="idx asc"
+    )
+    for entrada in entradas:
+        if not entrada.docname:
+            continue
+        por_docname.setdefault(entrada.docname, url_por_biblioteca.get(entrada.parent))
+        if entrada.parent in docnames_por_biblioteca:
+            docnames_por_biblioteca[entrada.parent].add(entrada.docname)
+
+    logger.info(f"Mapa de bibliotecas SP construido: {len(por_doctype)} doctypes, {len(por_docname)} docnames")
+    return {"por_docname": por_docname, "por_doctype": por_doctype}
+
+
+def get_library_map():
+    return frappe.cache().get_value(CACHE_KEY_BIBLIOTECAS, generator=build_library_map)
+
+
+def clear_library_cache(doc=None, method=None):
+    """
+    Hook de 'Bibliotecas SP': invalida el mapa al guardar, renombrar o borrar,
+    y con él las estructuras cacheadas, que dependen de la biblioteca resuelta.
+    """
+    frappe.cache().delete_value(CACHE_KEY_BIBLIOTECAS)
+    invalidate_structure_cache()
+
+
+def resolve_library(doctype, docname, project_type=None):
+    """
+    Resuelve la biblioteca de SharePoint de un documento con el mismo orden
+    de prioridad que se usaba en cada hook:
+
+    1. Entrada de la tabla hija cuyo docname sea el documento (o su tipo de proyecto).
+    2. Biblioteca del doctype: su URL general si la tabla hija está vacía, o
+       nada si la tabla hija tiene entradas y el documento no está entre ellas.
+
+    Devuelve un diccionario con `url_sp`, `site_url` y `site_relative_path`,
+    o None si el documento no tiene biblioteca.
+    """
+    bibliotecas = get_library_map()
+
+    url_sp = bibliotecas["por_docname"].get(project_type or docname)
+    if url_sp:
+        logger.info(f"URL encontrada en la tabla hija para {doctype} con docname {docname}: {url_sp}")
+    else:
+        biblioteca = bibliotecas["por_doctype"].get(doctype)
+        if not biblioteca:
+            logger.info(f"No se encontró ningún documento en 'Bibliotecas SP' para {doctype}.")
+            return None
+
+        if biblioteca["docnames"] and docname not in biblioteca["docnames"]:
+            logger.info(f"No se encontró una coincidencia en la tabla hija para {docname}.")
+            return None
+
+        url_sp = biblioteca["url_sp"]
+        logger.info(f"Usando la URL general para {doctype}: {url_sp}")
+
+    if not url_sp:
+        logger.error("No se pudo obtener la URL de la carpeta en SharePoint.")
+        return None
+
+    site_url, site_relative_path = split_sharepoint_url(url_sp)
+    if not site_url:
+        logger.error("La URL no contiene '/sites/'. No se puede calcular la ruta relativa.")
+        return None
+
+    return {"url_sp": url_sp, "site_url": site_url, "site_relative_path": site_relative_path}
@@ -0,0 +1,71 @@
+import logging
+from logging.handlers import RotatingFileHandler
+from urllib.parse import unquote
+import frappe
+
+site_config = frappe.get_site_config()
+
+# Segundos durante los que una carpeta creada o comprobada se da por existente
+TTL_CARPETAS = int(site_config.get('sp_ttl_carpetas') or 3600)
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/carpetas_sp.log', maxBytes=5 * 1024 * 1024, backupCount=3)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+
+def normalize_path(folder_relative_url):
+    """
+    Normaliza una ruta relativa de SharePoint: sin codificar y sin barras
+    al inicio o al final.
+    """
+    return unquote(folder_relative_url or "").strip('/')
+
+
+def folder_cache_key(site_url, folder_relative_url):
+    # SharePoint no distingue mayúsculas en las rutas
+    return f"carpetas_sp|{site_url}|{normalize_path(folder_relative_url)}".lower()
+
+
+def ensure_folder_path(ctx, folder_relative_url):
+    """
+    Garantiza que existe la ruta completa de carpetas `folder_relative_url`
+    (relativa al sitio del contexto). Los niveles ya conocidos se leen de la
+    caché; los que faltan se crean en una única petición por lotes, ya que
+    `folders.add` devuelve la carpeta existente si ya estaba creada.
+    """
+    site_url = ctx.base_url
+    path = normalize_path(folder_relative_url)
+    cache = frappe.cache()
+
+    if cache.get_value(folder_cache_key(site_url, path)):
+        return path
+
+    parts = path.split('/')
+    prefixes = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+    missing = [prefix for prefix in prefixes if not cache.get_value(folder_cache_key(site_url, prefix))]
+
+    logger.info(f"Materializando ruta {path} en {site_url}, niveles no conocidos: {missing}")
+    try:
+        for prefix in missing:
+            ctx.web.folders.add(prefix)
+        ctx.execute_batch()
+    except Exception as e:
+        logger.warning(f"Fallo en la creación por lotes de {path}, usando ensure_folder_path: {e}")
+        ctx.clear()
+        ctx.web.ensure_folder_path(path).execute_query()
+
+    for prefix in prefixes:
+        cache.set_value(folder_cache_key(site_url, prefix), 1, expires_in_sec=TTL_CARPETAS)
+    return path
+
+
+def invalidate_folder_cache(site_url, folder_relative_url=None):
+    """
+    Olvida las carpetas conocidas bajo `folder_relative_url` (incluida ella
+    misma) o todas las del sitio si no se indica ruta.
+    """
+    frappe.cache().delete_keys(folder_cache_key(site_url, folder_relative_url))
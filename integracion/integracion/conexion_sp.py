@@ -0,0 +1,163 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from logging.handlers import RotatingFileHandler
+from urllib.parse import urlsplit
+import msal
+from office365.sharepoint.client_context import ClientContext
+import frappe
+
+# Leer credenciales desde el archivo de configuración del sitio
+site_config = frappe.get_site_config()
+id_cliente = site_config.get('id_sp_client')
+tenant_id = site_config.get('tenant_sp')
+cert_path = site_config.get('cert_path')
+cert_finger = site_config.get('cert_finger')  # Huella digital del certificado
+
+# Número máximo de contextos abiertos por proceso (se descarta el menos usado)
+CTX_MAX_SITIOS = int(site_config.get('sp_ctx_max_sitios') or 16)
+# Segundos durante los que un contexto se da por válido sin volver a probar la conexión
+CTX_TTL_VERIFICACION = int(site_config.get('sp_ctx_ttl_verificacion') or 300)
+# Margen (segundos) antes de la expiración del token en el que se pide uno nuevo
+TOKEN_MARGEN_EXPIRACION = 300
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/conexion_sp.log', maxBytes=5 * 1024 * 1024, backupCount=3)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+
+@dataclass
+class Token:
+    tokenType: str
+    accessToken: str
+
+
+@dataclass
+class EntradaContexto:
+    ctx: ClientContext
+    verificado_en: float
+    expira: float
+
+
+# Estado compartido por todo el proceso (worker)
+_lock = threading.RLock()
+_app_msal = None
+_tokens = {}
+_contextos = OrderedDict()
+
+
+def get_app_msal():
+    """
+    Devuelve la aplicación MSAL del proceso. El certificado se lee del disco
+    una única vez por worker, no en cada evento.
+    """
+    global _app_msal
+    with _lock:
+        if _app_msal is None:
+            logger.info(f"Cargando certificado desde {cert_path} con huella digital: {cert_finger}")
+            with open(cert_path, 'r') as cert_file:
+                private_key = cert_file.read()
+
+            _app_msal = msal.ConfidentialClientApplication(
+                id_cliente,
+                authority=f"https://login.microsoftonline.com/{tenant_id}",
+                client_credential={
+                    "thumbprint": cert_finger.replace(":", "").upper(),
+                    "private_key": private_key
+                }
+            )
+        return _app_msal
+
+
+def get_token(host):
+    """
+    Devuelve un token válido (y su expiración) para el host de SharePoint
+    indicado, renovándolo solo cuando está a punto de expirar.
+    """
+    with _lock:
+        token, expira = _tokens.get(host, (None, 0))
+        if token and time.time() < expira - TOKEN_MARGEN_EXPIRACION:
+            return token, expira
+
+        result = get_app_msal().acquire_token_for_client(scopes=[f"https://{host}/.default"])
+        if "access_token" not in result:
+            logger.error(f"Error de autenticación en {host}: {result.get('error_description')}")
+            raise frappe.AuthenticationError(result.get('error_description'))
+
+        token = Token(tokenType="Bearer", accessToken=result['access_token'])
+        expira = time.time() + int(result.get('expires_in', 3599))
+        _tokens[host] = (token, expira)
+        logger.info(f"Token obtenido para {host}, expira en {result.get('expires_in')} segundos")
+        return token, expira
+
+
+def get_sharepoint_context(site_url):
+    """
+    Devuelve un ClientContext autenticado para `site_url` reutilizando el del
+    proceso si existe. La conexión solo se prueba contra SharePoint cuando ha
+    pasado `CTX_TTL_VERIFICACION` desde la última comprobación.
+
+    Si el token con el que se creó el contexto está a punto de expirar, el
+    contexto se vuelve a crear. Los contextos no son seguros entre hilos, así
+    que la clave incluye el hilo.
+    """
+    clave = (site_url, threading.get_ident())
+    ahora = time.time()
+
+    with _lock:
+        entrada = _contextos.get(clave)
+        if entrada and ahora >= entrada.expira - TOKEN_MARGEN_EXPIRACION:
+            logger.info(f"Token próximo a expirar para {site_url}, se renueva el contexto")
+            del _contextos[clave]
+            entrada = None
+        if entrada:
+            _contextos.move_to_end(clave)
+
+    if entrada and ahora - entrada.verificado_en < CTX_TTL_VERIFICACION:
+        return entrada.ctx
+
+    if entrada:
+        try:
+            entrada.ctx.web.get().execute_query()
+            entrada.verificado_en = ahora
+            return entrada.ctx
+        except Exception as e:
+            logger.warning(f"Contexto caducado para {site_url}, se vuelve a crear: {e}")
+            invalidate_sharepoint_context(site_url)
+
+    try:
+        host = urlsplit(site_url).netloc
+        token, expira = get_token(host)
+        ctx = ClientContext(site_url).with_access_token(lambda: get_token(host)[0])
+
+        # Probar la conexión accediendo a algún recurso básico
+        web = ctx.web.get().execute_query()
+        logger.info(f"Conexión exitosa al sitio SharePoint: {web.properties['Title']}")
+    except Exception as e:
+        logger.error(f"Error al conectar a SharePoint con certificado: {e}")
+        return None
+
+    with _lock:
+        _contextos[clave] = EntradaContexto(ctx=ctx, verificado_en=time.time(), expira=expira)
+        _contextos.move_to_end(clave)
+        while len(_contextos) > CTX_MAX_SITIOS:
+            descartado, _ = _contextos.popitem(last=False)
+            logger.info(f"Contexto descartado por límite de caché: {descartado[0]}")
+
+    return ctx
+
+
+def invalidate_sharepoint_context(site_url=None):
+    """
+    Elimina de la caché los contextos de `site_url` (o todos si no se indica).
+    """
+    with _lock:
+        for clave in list(_contextos):
+            if site_url is None or clave[0] == site_url:
+                del _contextos[clave]
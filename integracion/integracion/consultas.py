@@ -0,0 +1,20 @@
+import frappe
+
+# Consultas en bloque compartidas por los módulos que cargan muchos documentos a la vez
+
+
+def get_hijos(doctype, parenttype, parents, fields):
+    """
+    Filas de una tabla hija de todos los documentos `parents` en una consulta,
+    agrupadas por documento y en el orden del formulario.
+    """
+    por_padre = {parent: [] for parent in parents}
+    filas = frappe.get_all(
+        doctype,
+        filters={"parenttype": parenttype, "parent": ["in", parents]},
+        fields=["parent"] + fields,
+        order_by="parent asc, idx asc"
+    )
+    for fila in filas:
+        por_padre[fila.parent].append(fila)
+    return por_padre
@@ -0,0 +1,170 @@
+import frappe
+from integracion.integracion.consultas import get_hijos
+
+# Modos de pago que entran en las remesas
+MODO_COBRO_REMESA = "Giro bancario"
+MODO_PAGO_REMESA = "Transferencia bancaria"
+
+# Campos de las facturas que usan el XML SEPA, el Excel, la remesa y el pago
+CAMPOS_VENTA = [
+    "name", "company", "customer", "customer_name", "grand_total", "outstanding_amount",
+    "remarks", "posting_date", "debit_to", "currency", "docstatus"
+]
+CAMPOS_COMPRA = [
+    "name", "company", "supplier", "supplier_name", "bill_no", "bill_date", "grand_total",
+    "rounded_total", "outstanding_amount", "remarks", "posting_date", "credit_to", "currency",
+    "docstatus", "custom_varios_pagos"
+]
+
+
+def get_cuentas_bancarias(party_type, terceros):
+    """
+    Cuentas bancarias (name, iban, company) de todos los terceros en una
+    consulta, agrupadas por tercero. Los terceros sin cuentas enlazadas usan
+    su `default_bank_account`, que se resuelve en dos consultas más para todos.
+    """
+    terceros = list(set(terceros))
+    cuentas = {tercero: [] for tercero in terceros}
+    if not terceros:
+        return cuentas
+
+    for cuenta in frappe.get_all("Bank Account", filters={
+        "party_type": party_type,
+        "party": ["in", terceros]
+    }, fields=["name", "party", "iban", "company"]):
+        cuentas[cuenta.party].append(cuenta)
+
+    sin_cuenta = [tercero for tercero, lista in cuentas.items() if not lista]
+    if sin_cuenta:
+        por_defecto = {
+            t.name: t.default_bank_account
+            for t in frappe.get_all(party_type, filters={"name": ["in", sin_cuenta]}, fields=["name", "default_bank_account"])
+            if t.default_bank_account
+        }
+        if por_defecto:
+            por_nombre = {
+                c.name: c
+                for c in frappe.get_all("Bank Account", filters={"name": ["in", list(set(por_defecto.values()))]}, fields=["name", "iban", "company"])
+            }
+            for tercero, cuenta in por_defecto.items():
+                if cuenta in por_nombre:
+                    cuentas[tercero].append(por_nombre[cuenta])
+    return cuentas
+
+
+def elegir_cuenta(cuentas, company):
+    """
+    La cuenta del tercero en la empresa o, si no tiene, la primera disponible.
+    """
+    for cuenta in cuentas:
+        if cuenta.get("company") == company:
+            return cuenta
+    return cuentas[0] if cuentas else None
+
+
+def get_terceros(doctype, nombres, fields):
+    return {
+        t.name: t
+        for t in frappe.get_all(doctype, filters={"name": ["in", list(set(nombres))]}, fields=["name"] + fields)
+    } if nombres else {}
+
+
+def get_facturas(doctype, filters, invoice_names, fields):
+    filters = dict(filters)
+    if invoice_names:
+        filters["name"] = ["in", invoice_names]
+    return frappe.get_all(doctype, filters=filters, fields=fields)
+
+
+def completar_terceros(facturas, party_type, campo_tercero, terceros, campo_modo):
+    """
+    Añade a cada factura la fila de su tercero (`tercero`), su modo de pago
+    (`modo_de_cobro`) y la cuenta bancaria elegida para su empresa
+    (`cuenta_tercero`, `iban`).
+    """
+    cuentas = get_cuentas_bancarias(party_type, terceros)
+    for factura in facturas:
+        tercero = terceros.get(factura[campo_tercero]) or frappe._dict()
+        cuenta = elegir_cuenta(cuentas.get(factura[campo_tercero], []), factura.company)
+        factura.tercero = tercero
+        factura.modo_de_cobro = tercero.get(campo_modo)
+        factura.cuenta_tercero = cuenta.name if cuenta else None
+        factura.iban = cuenta.iban if cuenta else None
+    return facturas
+
+
+def load_facturas_venta(invoice_names=None):
+    """
+    Facturas de venta pendientes de remesar (todas o solo `invoice_names`) con
+    los datos de su cliente: cabeceras en una consulta, clientes en otra y
+    cuentas bancarias de todos los clientes en una o tres más.
+    """
+    facturas = get_facturas("Sales Invoice", {
+        "custom_aprobada_para_cobro": 1,
+        "custom_remesa_emitida": 0,
+        "docstatus": ["!=", 2]
+    }, invoice_names, CAMPOS_VENTA)
+
+    clientes = get_terceros("Customer", [f.customer for f in facturas], ["customer_name", "tax_id", "custom_pais", "custom_modo_de_cobro"])
+    return completar_terceros(facturas, "Customer", "customer", clientes, "custom_modo_de_cobro")
+
+
+def load_facturas_compra(invoice_names=None):
+    """
+    Facturas de compra pendientes de remesar (todas o solo `invoice_names`)
+    con los datos de su proveedor y, las de varios pagos, sus pagos parciales
+    en `custom_pagos`.
+    """
+    facturas = get_facturas("Purchase Invoice", {
+        "custom_aprobado_para_pago": 1,
+        "custom_remesa_emitida": 0,
+        "docstatus": ["!=", 2]
+    }, invoice_names, CAMPOS_COMPRA)
+
+    fraccionadas = [f.name for f in facturas if f.custom_varios_pagos]
+    pagos = get_hijos("Pago Parcial", "Purchase Invoice", fraccionadas, ["name", "monto", "pagado"]) if fraccionadas else {}
+    for factura in facturas:
+        factura.custom_pagos = pagos.get(factura.name, [])
+
+    proveedores = get_terceros("Supplier", [f.supplier for f in facturas], ["supplier_name", "tax_id", "mode_of_payment"])
+    return completar_terceros(facturas, "Supplier", "supplier", proveedores, "mode_of_payment")
+
+
+def get_empresas(empresas):
+    """
+    Abreviatura, NIF, cuenta contable del banco por defecto (con su 'Bank
+    Account' en `cuenta_bancaria` y su IBAN), centro de coste y moneda de cada
+    empresa en dos consultas.
+    """
+    datos = get_terceros("Company", empresas, ["abbr", "tax_id", "default_bank_account", "cost_center", "default_currency"])
+    cuentas = [e.default_bank_account for e in datos.values() if e.default_bank_account]
+    bancos = {
+        c.account: c
+        for c in frappe.get_all("Bank Account", filters={"account": ["in", cuentas]}, fields=["name", "account", "iban"])
+    } if cuentas else {}
+    for empresa in datos.values():
+        banco = bancos.get(empresa.default_bank_account) or frappe._dict()
+        empresa.cuenta_bancaria = banco.name
+        empresa.iban = banco.iban
+    return datos
+
+
+def get_pagos_activos(doctype, facturas):
+    """
+    Pagos no cancelados de todas las facturas en una consulta, agrupados por
+    factura: filas con el Payment Entry (`pago`), su estado y el importe asignado.
+    """
+    pagos = {factura: [] for factura in facturas}
+    if not facturas:
+        return pagos
+
+    for fila in frappe.db.sql("""
+        SELECT per.reference_name AS factura, per.parent AS pago, per.allocated_amount, pe.docstatus
+        FROM `tabPayment Entry Reference` per
+        INNER JOIN `tabPayment Entry` pe ON pe.name = per.parent
+        WHERE per.reference_doctype = %(doctype)s
+            AND per.reference_name IN %(facturas)s
+            AND pe.docstatus != 2
+    """, {"doctype": doctype, "facturas": tuple(facturas)}, as_dict=True):
+        pagos[fila.factura].append(fila)
+    return pagos
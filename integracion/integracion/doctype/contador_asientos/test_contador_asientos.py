@@ -0,0 +1,9 @@
+# Copyright (c) 2024, Xappiens and Contributors
+# See license.txt
+
+# import frappe
+from frappe.tests.utils import FrappeTestCase
+
+
+class TestContadorAsientos(FrappeTestCase):
+	pass
@@ -0,0 +1,8 @@
+// Copyright (c) 2024, Xappiens and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Registro Envio SII", {
+// 	refresh(frm) {
+
+// 	},
+// });
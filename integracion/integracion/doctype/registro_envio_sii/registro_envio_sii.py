@@ -0,0 +1,14 @@
+# Copyright (c) 2024, Xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class RegistroEnvioSII(Document):
+	pass
+
+
+def on_doctype_update():
+	# Último intento de cada factura y facturas pendientes desde una fecha
+	frappe.db.add_index("Registro Envio SII", ["tipo_documento", "factura", "fecha_envio"])
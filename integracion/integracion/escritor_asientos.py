@@ -0,0 +1,81 @@
+import time
+from itertools import islice
+import logging
+import frappe
+
+site_config = frappe.get_site_config()
+
+# Asientos insertados entre cada commit
+TAMANO_LOTE_ASIENTOS = int(site_config.get('tamano_lote_asientos') or 100)
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+
+handler = logging.FileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/escritor_asientos.log')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+
+def insert_journal_entries(asientos, tamano_lote=None, on_error=None, on_progress=None, on_rollback=None):
+    """
+    Inserta los Journal Entry ya validados de una importación. `asientos` es
+    una lista o un generador de diccionarios con la clave `doc` (el diccionario
+    del Journal Entry) y los datos que el importador necesite para informar de
+    sus errores. Con un generador solo se mantiene en memoria el lote en curso.
+
+    Cada asiento se inserta dentro de un savepoint: si falla, solo se deshace
+    ese asiento, se llama a `on_rollback()` para que el llamador descarte el
+    estado que dependía de lo deshecho y a `on_error(asiento, excepcion)`. Se hace commit una
+    vez por lote y se llama a `on_progress(procesados, total)` tras cada lote (`total`
+    es None si los asientos llegan de un generador).
+    Devuelve el resumen de la escritura con el rendimiento en asientos/s.
+    """
+    tamano_lote = tamano_lote or TAMANO_LOTE_ASIENTOS
+    # Si los asientos llegan de un generador no se conoce el total ni se guardan todos en memoria
+    total = len(asientos) if hasattr(asientos, "__len__") else None
+    iterador = iter(asientos)
+    procesados = 0
+    creados = []
+    fallidos = 0
+    inicio = time.perf_counter()
+
+    while True:
+        lote = list(islice(iterador, tamano_lote))
+        if not lote:
+            break
+
+        for asiento in lote:
+            frappe.db.savepoint("insertar_asiento")
+            try:
+                journal_entry = frappe.get_doc(asiento["doc"]).insert(ignore_permissions=True)
+                frappe.db.release_savepoint("insertar_asiento")
+                creados.append(journal_entry.name)
+            except Exception as e:
+                frappe.db.rollback(save_point="insertar_asiento")
+                if on_rollback:
+                    on_rollback()
+                fallidos += 1
+                logger.error(f"Error al insertar el asiento {asiento['doc'].get('title')}: {e}")
+                if on_error:
+                    on_error(asiento, e)
+
+        frappe.db.commit()
+
+        procesados += len(lote)
+        if on_progress:
+            on_progress(procesados, total)
+
+    segundos = time.perf_counter() - inicio
+    resumen = {
+        "creados": creados,
+        "fallidos": fallidos,
+        "segundos": round(segundos, 2),
+        "asientos_por_segundo": round(len(creados) / segundos, 2) if segundos else 0
+    }
+    logger.info(
+        f"{len(creados)} asientos creados y {fallidos} fallidos en {resumen['segundos']} s "
+        f"({resumen['asientos_por_segundo']} asientos/s, lotes de {tamano_lote})"
+    )
+    return resumen
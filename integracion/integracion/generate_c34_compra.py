@@ -5,10 +5,17 @@ import datetime
 from urllib.parse import quote
 from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
-from lxml import etree
 import frappe
+from integracion.integracion.conexion_sp import get_sharepoint_context
+from integracion.integracion.carpetas_sp import ensure_folder_path, normalize_path
+from integracion.integracion.subida_sp import upload_local_file
+from integracion.integracion.sepa_xml import XSD_PAIN_001, get_ruta_cuaderno, validate_sepa, write_pain_001
+from integracion.integracion.datos_remesa import (
+    MODO_PAGO_REMESA, elegir_cuenta, get_cuentas_bancarias, get_empresas, get_pagos_activos, load_facturas_compra
+)
 import pandas as pd
 from frappe import _
+from frappe.utils import flt
 import requests
 from dataclasses import dataclass
 
@@ -35,32 +42,17 @@ logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
 def get_supplier_iban(supplier_name, company):
-    # Consultar la cuenta bancaria que tiene un enlace al proveedor
-    bank_accounts = frappe.get_all("Bank Account", filters={
-        "party_type": "Supplier",
-        "party": supplier_name
-    }, fields=["iban", "company", "name"])
+    # Cuenta del proveedor en la empresa, la primera disponible o su default_bank_account.
+    # Devuelve el diccionario de la cuenta bancaria (iban, name, company) o None
+    return elegir_cuenta(get_cuentas_bancarias("Supplier", [supplier_name])[supplier_name], company)
 
-    if not bank_accounts:
-        # Si no se encuentra el IBAN en las cuentas bancarias del proveedor, buscar el default_bank_account
-        default_bank_account = frappe.get_value("Supplier", supplier_name, "default_bank_account")
-        if default_bank_account:
-            # Obtener el IBAN de la cuenta bancaria predeterminada
-            bank_account_doc = frappe.get_value("Bank Account", default_bank_account, ["iban", "name"], as_dict=1)
 
-            if bank_account_doc:
-                # Devolver siempre un diccionario, incluso si solo tienes el IBAN
-                return {"iban": bank_account_doc.get("iban"), "name": bank_account_doc.get("name")}
-
-        return None  # Devolver None si no se encuentra el IBAN en ninguna parte
-
-    # Filtrar cuentas bancarias por la empresa específica
-    filtered_accounts = [account for account in bank_accounts if account.get("company") == company]
-
-    if filtered_accounts:
-        return filtered_accounts[0]  # Retornar el diccionario completo de la cuenta bancaria
-    else:
-        return bank_accounts[0]  # Si no hay coincidencia con la empresa, devolver el primer diccionario disponible
+def get_importe_pago(invoice):
+    # Las facturas de varios pagos se transfieren por la suma de sus pagos parciales
+    # pendientes, lo mismo que se anota en la remesa; el resto por su importe pendiente
+    if invoice.custom_varios_pagos:
+        return sum(flt(pago.monto) for pago in invoice.custom_pagos if not pago.pagado)
+    return invoice.outstanding_amount
 
 
 
@@ -101,6 +93,21 @@ def change_status_to_remesa_emitida(purchase_invoice_name, remesa_name):
         logger.error(f"Error al cambiar el estado de la factura {purchase_invoice_name}: {e}")
 
 
+def marcar_remesa_emitida(invoices, remesa_name):
+    # Las facturas validadas se marcan en una sola actualización; los borradores se guardan uno a uno
+    validadas = [invoice.name for invoice in invoices if invoice.docstatus == 1]
+    if validadas:
+        frappe.db.set_value("Purchase Invoice", {"name": ["in", validadas]}, {
+            "custom_remesa_emitida": 1,
+            "custom_remesa": remesa_name
+        })
+        logger.info(f"Campos personalizados de {len(validadas)} facturas validadas actualizados con la remesa {remesa_name}")
+
+    for invoice in invoices:
+        if invoice.docstatus == 0:
+            change_status_to_remesa_emitida(invoice.name, remesa_name)
+
+
 
 
 @frappe.whitelist()
@@ -108,20 +115,14 @@ def generate_c34_compra(invoice_data=None):
     logger.info("Inicio de la generación de Cuaderno 34")
 
     try:
-        # Filtros de búsqueda de facturas
-        filters = {
-            "custom_aprobado_para_pago": 1,
-            "custom_remesa_emitida": 0,
-            "docstatus": ["!=", 2]
-        }
-
-        # Si hay facturas seleccionadas desde el frontend, añadirlas al filtroo
+        # Si hay facturas seleccionadas desde el frontend, filtrar solo esas
+        invoice_names = None
         if invoice_data:
             invoice_names = [i["name"] for i in json.loads(invoice_data)]
             logger.info(invoice_names)
-            filters.update({"name": ["in", invoice_names]})
 
-        filtered_invoices = frappe.get_all("Purchase Invoice", filters=filters, fields=["name"])
+        # Facturas aprobadas con los datos y el IBAN de su proveedor
+        filtered_invoices = load_facturas_compra(invoice_names)
 
         logger.debug(f"Total facturas encontradas: {len(filtered_invoices)}")
 
@@ -130,14 +131,12 @@ def generate_c34_compra(invoice_data=None):
         return
 
     invoices_by_company = {}
-    for invoice_data in filtered_invoices:
+    for invoice in filtered_invoices:
         try:
-            invoice = frappe.get_doc("Purchase Invoice", invoice_data["name"])
             logger.debug(f"Procesando factura {invoice.name}")
 
-            mode_of_payment = frappe.get_value("Supplier", invoice.supplier, "mode_of_payment")
-            if mode_of_payment != "Transferencia bancaria":
-                logger.debug(f"Factura {invoice.name} ignorada por modo de pago {mode_of_payment} {invoice.supplier}")
+            if invoice.modo_de_cobro != MODO_PAGO_REMESA:
+                logger.debug(f"Factura {invoice.name} ignorada por modo de pago {invoice.modo_de_cobro} {invoice.supplier}")
                 continue
 
             company = invoice.company
@@ -145,103 +144,70 @@ def generate_c34_compra(invoice_data=None):
                 logger.error(f"Factura {invoice.name} no tiene una empresa asociada.")
                 continue
 
+            invoice.importe_pago = get_importe_pago(invoice)
+            if flt(invoice.importe_pago, 2) <= 0:
+                logger.info(f"Factura {invoice.name} ignorada: no tiene importe pendiente de pago")
+                continue
+
             if company not in invoices_by_company:
                 invoices_by_company[company] = []
             invoices_by_company[company].append(invoice)
             logger.debug(f"Factura {invoice.name} agregada a la empresa {company}")
 
         except Exception as e:
-            logger.error(f"Error al procesar la factura {invoice_data['name']}: {e}")
+            logger.error(f"Error al procesar la factura {invoice.name}: {e}")
+
+    # Datos de todas las empresas de la remesa en una sola pasada
+    empresas = get_empresas(list(invoices_by_company))
+
     sharepoint_urls = []
     files = []
     for company, invoices in invoices_by_company.items():
         try:
-            abbr = frappe.get_value("Company", company, "abbr")
-            now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            empresa = empresas[company]
+            abbr = empresa.abbr
+            ahora = datetime.datetime.now()
+            now = ahora.strftime("%Y%m%d%H%M%S")
+            creacion = ahora.strftime("%Y-%m-%dT%H:%M:%S")
             fichero_id_value = f"C19-{abbr}-{now}"
 
-            # Crear el elemento principal del XML conforme al estándar SEPA
-            root = etree.Element("Document", xmlns="urn:iso:std:iso:20022:tech:xsd:pain.001.001.03")
-            cstmr_cdt_trf_initn = etree.SubElement(root, "CstmrCdtTrfInitn")
-
-            # Crear el header del grupo
-            grp_hdr = etree.SubElement(cstmr_cdt_trf_initn, "GrpHdr")
-            msg_id = etree.SubElement(grp_hdr, "MsgId")
-            msg_id.text = fichero_id_value
-            cre_dt_tm = etree.SubElement(grp_hdr, "CreDtTm")
-            cre_dt_tm.text = now
-            nb_of_txs = etree.SubElement(grp_hdr, "NbOfTxs")
-            nb_of_txs.text = str(len(invoices))
-            ctrl_sum = etree.SubElement(grp_hdr, "CtrlSum")
-            ctrl_sum.text = str(sum(invoice.grand_total for invoice in invoices))
-            initg_pty = etree.SubElement(grp_hdr, "InitgPty")
-            nm = etree.SubElement(initg_pty, "Nm")
-            nm.text = company
-            id_elem = etree.SubElement(initg_pty, "Id")
-            org_id = etree.SubElement(id_elem, "OrgId")
-            othr = etree.SubElement(org_id, "Othr")
-            othr_id = etree.SubElement(othr, "Id")
-            othr_id.text = frappe.get_value("Company", company, "tax_id")
-
-            # Información de pago
-            pmt_inf = etree.SubElement(cstmr_cdt_trf_initn, "PmtInf")
-            pmt_inf_id = etree.SubElement(pmt_inf, "PmtInfId")
-            pmt_inf_id.text = f"PMT-{abbr}-{now}"
-            pmt_mtd = etree.SubElement(pmt_inf, "PmtMtd")
-            pmt_mtd.text = "TRF"
-            btch_bookg = etree.SubElement(pmt_inf, "BtchBookg")
-            btch_bookg.text = "false"
-            nb_of_txs_pmt_inf = etree.SubElement(pmt_inf, "NbOfTxs")
-            nb_of_txs_pmt_inf.text = str(len(invoices))
-            ctrl_sum_pmt_inf = etree.SubElement(pmt_inf, "CtrlSum")
-            ctrl_sum_pmt_inf.text = str(sum(invoice.grand_total for invoice in invoices))
-            pmt_tp_inf = etree.SubElement(pmt_inf, "PmtTpInf")
-            instr_prty = etree.SubElement(pmt_tp_inf, "InstrPrty")
-            instr_prty.text = "NORM"
-            svc_lvl = etree.SubElement(pmt_tp_inf, "SvcLvl")
-            svc_lvl_cd = etree.SubElement(svc_lvl, "Cd")
-            svc_lvl_cd.text = "SEPA"
-            reqd_exctn_dt = etree.SubElement(pmt_inf, "ReqdExctnDt")
-            reqd_exctn_dt.text = frappe.utils.nowdate()
-
-            # Ordenante
-            dbtr = etree.SubElement(pmt_inf, "Dbtr")
-            dbtr_nm = etree.SubElement(dbtr, "Nm")
-            dbtr_nm.text = company
-
-            # Extraer el texto plano del campo HTML address_html
-            #address_html = frappe.get_value("Company", company, "address_html")
-            #soup = BeautifulSoup(address_html, 'html.parser')
-            #address_text = soup.get_text(separator=", ")
-
-            dbtr_pstl_adr = etree.SubElement(dbtr, "PstlAdr")
-            dbtr_ctry = etree.SubElement(dbtr_pstl_adr, "Ctry")
-            dbtr_ctry.text = "ES"
-            dbtr_adr_line = etree.SubElement(dbtr_pstl_adr, "AdrLine")
-            #dbtr_adr_line.text = address_text
-            dbtr_adr_line.text = "address_text"
-            dbtr_id = etree.SubElement(dbtr, "Id")
-            dbtr_org_id = etree.SubElement(dbtr_id, "OrgId")
-            dbtr_othr = etree.SubElement(dbtr_org_id, "Othr")
-            dbtr_othr_id = etree.SubElement(dbtr_othr, "Id")
-            dbtr_othr_id.text = frappe.get_value("Company", company, "tax_id")
-            dbtr_acct = etree.SubElement(pmt_inf, "DbtrAcct")
-            dbtr_acct_id = etree.SubElement(dbtr_acct, "Id")
-            dbtr_acct_iban = etree.SubElement(dbtr_acct_id, "IBAN")
-            dbtr_acct_iban.text = frappe.get_value("Company", company, "default_bank_account")
-            dbtr_agt = etree.SubElement(pmt_inf, "DbtrAgt")
-            dbtr_fin_instn_id = etree.SubElement(dbtr_agt, "FinInstnId")
-            # dbtr_bic = etree.SubElement(dbtr_fin_instn_id, "BIC")
-            # dbtr_bic.text = frappe.get_value("Company", company, "bic")
+            # Escribir el XML conforme al estándar SEPA (pain.001.001.03) con las filas precargadas
+            xml_file_path = get_ruta_cuaderno(f"{fichero_id_value}.xml")
+            num_pagos, total_pagos = write_pain_001(xml_file_path, {
+                "msg_id": fichero_id_value,
+                "creacion": creacion,
+                "nombre": company,
+                "nif": empresa.tax_id,
+                "pmt_inf_id": f"PMT-{abbr}-{now}",
+                "fecha_ejecucion": frappe.utils.nowdate(),
+                "iban": (empresa.iban or "").upper()
+            }, [
+                {
+                    "id": invoice.name,
+                    "importe": invoice.importe_pago,
+                    "nombre": invoice.supplier_name,
+                    "iban": (invoice.iban or "").upper(),
+                    "concepto": invoice.bill_no or invoice.name
+                }
+                for invoice in invoices
+            ])
+            logger.info(f"Archivo XML generado para {company}: {xml_file_path} ({num_pagos} pagos, {total_pagos} EUR)")
+
+            # Validar el XML contra el XSD
+            validation_errors = validate_sepa(xml_file_path, XSD_PAIN_001)
+            if validation_errors:
+                # No se sube ni se remesa un fichero que el banco rechazaría
+                os.remove(xml_file_path)
+                sharepoint_urls.append({"company": company, "error": f"El XML no es válido según el XSD: {validation_errors}"})
+                continue
 
             # generar excel
             total_factura = 0
             data = []
             for invoice in invoices:
                 try:
-                    supplier_bank = get_supplier_iban(invoice.supplier,company)
-                    supplier_iban = supplier_bank.get('iban') if supplier_bank else None
-                    supplier_cif = frappe.get_value("Supplier", invoice.supplier, "tax_id")
+                    supplier_iban = invoice.iban
+                    supplier_cif = invoice.tercero.tax_id
 
 
                     data.append({
@@ -249,14 +215,14 @@ def generate_c34_compra(invoice_data=None):
                         "Nombre proveedor": invoice.supplier_name,
                         "CIF Proveedor": supplier_cif,
                         "IBAN Proveedor": supplier_iban,
-                        "Importe Factura": invoice.outstanding_amount,
+                        "Importe Factura": invoice.importe_pago,
                         "Objeto de la Factura": invoice.remarks or "Pago de factura",
                         "Fecha de factura": invoice.bill_date.strftime('%Y-%m-%d'),
                         "Tipo Transferencia" : "SEPA"
                     })
 
                     logger.debug(f"Datos agregados para la factura {invoice.name} del proveedor {invoice.supplier_name}")
-                    total_factura = total_factura + float(invoice.outstanding_amount)
+                    total_factura = total_factura + float(invoice.importe_pago)
                 except Exception as e:
                     logger.error(f"Error al procesar la factura {invoice.name}: {e}")
 
@@ -272,28 +238,36 @@ def generate_c34_compra(invoice_data=None):
             #         })
 
             df = pd.DataFrame(data)
-            file_path = f"/home/frappe/frappe-bench/sites/erp.grupoatu.com/private/cuaderno/{fichero_id_value}.xlsx"
+            file_path = get_ruta_cuaderno(f"{fichero_id_value}.xlsx")
             df.to_excel(file_path, index=False)
             logger.info(f"Archivo Excel generado para {company}: {file_path}")
 
+            # Subir el XML a SharePoint junto al Excel
+            xml_sharepoint_url = upload_file_to_sharepoint(xml_file_path, company, fichero_id_value)
+            if xml_sharepoint_url:
+                logger.debug(f"Archivo XML subido a SharePoint: {xml_sharepoint_url}")
+
             sharepoint_url = upload_file_to_sharepoint(file_path, company, fichero_id_value)
             if sharepoint_url:
                 sharepoint_urls.append({"company": company, "url": sharepoint_url})
                 logger.debug(f"Archivo subido a SharePoint: {sharepoint_url}")
 
-                remesa_name = create_remesa(company, invoices, sharepoint_url)
-                for invoice in invoices:
-                    change_status_to_remesa_emitida(invoice.name, remesa_name)
-                    logger.debug(f"Estado cambiado a 'Remesa Emitida' para la factura {invoice.name}")
+                remesa_name = create_remesa(company, invoices, sharepoint_url, abbr)
+                marcar_remesa_emitida(invoices, remesa_name)
 
-                    payment_name = create_payment_entry_for_purchase_invoice(invoice, supplier_iban)
+                # Pagos existentes y líneas de la remesa de todas las facturas en una consulta cada uno
+                pagos = get_pagos_activos("Purchase Invoice", [invoice.name for invoice in invoices])
+                lineas_remesa = {
+                    linea.factura: linea.name
+                    for linea in frappe.get_all("Remesa Factura", filters={"parent": remesa_name}, fields=["name", "factura"])
+                } if remesa_name else {}
+
+                for invoice in invoices:
+                    payment_name = create_payment_entry_for_purchase_invoice(invoice, invoice.iban, empresa=empresa, pagos=pagos[invoice.name])
 
                     if not payment_name:
-                        payment_name = frappe.get_value(
-                            "Payment Entry Reference",
-                            {"reference_doctype": "Purchase Invoice", "reference_name": invoice.name, "docstatus": 1},
-                            "parent"
-                        )
+                        # La factura ya tenía un pago: enlazar el validado
+                        payment_name = next((pago.pago for pago in pagos[invoice.name] if pago.docstatus == 1), None)
                     # Crear el registro de Payment Entry para cada factura
                     # payment_entry_name = create_payment_entry_for_invoice(company, invoice)
                     # if payment_entry_name:
@@ -302,31 +276,27 @@ def generate_c34_compra(invoice_data=None):
                     #     logger.error(f"No se pudo crear el Payment Entry para la factura {invoice.name}")
 
                     # Insertar pago en línea de remesa creada (Remesa Factura)
-                    remesa_factura =  frappe.get_all("Remesa Factura", {"factura": invoice.name, "parent": remesa_name})
-
-                    if payment_name and len(remesa_factura):
-                        remesa_factura_doc = frappe.get_doc("Remesa Factura", remesa_factura[0].get("name"))
+                    if payment_name and invoice.name in lineas_remesa:
+                        frappe.db.set_value("Remesa Factura", lineas_remesa[invoice.name], "pago", payment_name)
 
-                        if remesa_factura_doc:
-                            remesa_factura_doc.db_set("pago", payment_name)
-
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Archivo local {file_path} eliminado después de subirlo a SharePoint")
+            for local_path in (xml_file_path, file_path):
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+                    logger.info(f"Archivo local {local_path} eliminado después de subirlo a SharePoint")
         except Exception as e:
             logger.error(f"Error al subir el archivo {file_path} a SharePoint: {e}")
 
     return sharepoint_urls
 
 
-def create_remesa(company, invoices, sharepoint_url):
+def create_remesa(company, invoices, sharepoint_url, abbr=None):
     try:
         # Crear un nuevo documento de Remesa
         remesa_doc = frappe.get_doc({
             "doctype": "Remesa Registro",
             "remesa_de": "Purchase Invoice",
             "company": company,
-            "company_abbr": frappe.get_value("Company", company, "abbr"),
+            "company_abbr": abbr or frappe.get_value("Company", company, "abbr"),
             "fecha": frappe.utils.nowdate(),
             "url": sharepoint_url,
             "facturas": [],
@@ -347,8 +317,7 @@ def create_remesa(company, invoices, sharepoint_url):
                     for pago in filter(lambda i: not i.pagado, inv.custom_pagos):
                         total_importe += pago.monto
 
-                        pago.db_set("pagado", True)
-                        pago.db_set("remesa", remesa_doc.name)
+                        frappe.db.set_value("Pago Parcial", pago.name, {"pagado": 1, "remesa": remesa_doc.name})
 
                     remesa_doc.append("facturas", {"factura": inv.name, "importe": total_importe})
 
@@ -365,29 +334,6 @@ def create_remesa(company, invoices, sharepoint_url):
         logger.error(f"Error al crear el documento de remesa para {company}: {e}")
         return None
 
-def create_folder_if_not_exists(ctx, folder_relative_url, folder_name):
-    try:
-        logger.info(f"Comprobando existencia de carpeta en la ruta: /{folder_relative_url}/{folder_name}")
-        parent_folder = ctx.web.get_folder_by_server_relative_url(f"{folder_relative_url}")
-        ctx.load(parent_folder)
-        ctx.execute_query()
-        logger.info(f"Conectado a parent {parent_folder}")
-
-        folders = parent_folder.folders
-        ctx.load(folders)
-        ctx.execute_query()
-
-        folder_names = [folder.properties['Name'] for folder in folders]
-
-        if folder_name in folder_names:
-            logger.info(f"La carpeta ya existe: {folder_relative_url}/{folder_name}")
-        else:
-            new_folder = parent_folder.folders.add(folder_name).execute_query()
-            logger.info(f"Carpeta creada: {new_folder.serverRelativeUrl}")
-    except Exception as e:
-        logger.error(f"Error verificando/creando carpeta en {folder_relative_url}/{folder_name}: {e}")
-        raise
-
 def upload_file_to_sharepoint(file_path, company, fichero_id_value):
     logger.info(f"Subiendo archivo {file_path} a SharePoint para la compañía {company} con Cuaderno {fichero_id_value}")
     try:
@@ -406,54 +352,24 @@ def upload_file_to_sharepoint(file_path, company, fichero_id_value):
         logger.info(f"Ruta relativa calculada: {relative_path}")
         logger.info(f"Conectando al contexto del sitio: {site_url}")
 
-        def connect_to_sharepoint_with_token(site_url):
-            try:
-                # Usar el certificado y la huella digital para autenticarse directamente
-                logger.info(f"Conectando al contexto del sitio: {site_url} con huella digital: {cert_finger} y ruta de certificado: {cert_path}")
-
-                # Configurar el contexto de cliente con el certificado
-                ctx = ClientContext(site_url).with_client_certificate(
-                    client_id=id_cliente,
-                    thumbprint=cert_finger.replace(":", "").upper(),
-                    cert_path=cert_path,
-                    tenant=tenant_id
-                )
-
-                # Probar la conexión accediendo a algún recurso básico
-                web = ctx.web.get().execute_query()
-                logger.info(f"Conexión exitosa al sitio SharePoint: {web.properties['Title']}")
-
-                return ctx
-            except Exception as e:
-                logger.error(f"Error al conectar a SharePoint con certificado: {e}")
-                return None
-
         # credentials = UserCredential(user_email, user_password)
         # ctx = ClientContext(site_url).with_credentials(credentials)
-        ctx = connect_to_sharepoint_with_token(site_url)
+        ctx = get_sharepoint_context(site_url)
         company_folder_name = quote(company)
         cuaderno_folder_name = quote(fichero_id_value)
 
-        # Crear la carpeta de la compañía si no existe
-        create_folder_if_not_exists(ctx, relative_path, company_folder_name)
-
-        # Crear la carpeta del Cuaderno 34 dentro de la carpeta de la compañía
+        # Crear las carpetas de la compañía y del Cuaderno 34 en una sola petición
         company_folder_relative_url = f"{relative_path}/{company_folder_name}".strip('/')
-        create_folder_if_not_exists(ctx, company_folder_relative_url, cuaderno_folder_name)
-
-        with open(file_path, 'rb') as file_content:
-            content = file_content.read()
+        ensure_folder_path(ctx, f"{company_folder_relative_url}/{cuaderno_folder_name}")
 
         file_name = os.path.basename(file_path)
         file_url = f"{company_folder_relative_url}/{cuaderno_folder_name}/{file_name}"
         logger.info(f"Intentando subir archivo a: {file_url}")
 
         try:
-            target_folder = ctx.web.get_folder_by_server_relative_url(f"{company_folder_relative_url}/{cuaderno_folder_name}")
-            ctx.load(target_folder)
-            ctx.execute_query()
+            target_folder = ctx.web.get_folder_by_server_relative_url(normalize_path(f"{company_folder_relative_url}/{cuaderno_folder_name}"))
 
-            target_folder.upload_file(file_name, content).execute_query()
+            upload_local_file(ctx, target_folder, file_path, file_name)
             logger.info(f"Archivo subido: {file_url}")
 
             # Devolver la URL de SharePoint
@@ -467,7 +383,9 @@ def upload_file_to_sharepoint(file_path, company, fichero_id_value):
         logger.error(f"Error al subir archivo a SharePoint: {str(e)}")
         return None
 
-def create_payment_entry_for_purchase_invoice(invoice, supplier_iban, company_account=None):
+def create_payment_entry_for_purchase_invoice(invoice, supplier_iban, company_account=None, empresa=None, pagos=None):
+   # `empresa` (fila de get_empresas) y `pagos` (de get_pagos_activos) llegan precargados
+   # desde la remesa; si no se indican se consultan solo para esta factura
    try:
        # Verificar si la factura ya ha sido pagada
        if invoice.outstanding_amount == 0:
@@ -475,46 +393,45 @@ def create_payment_entry_for_purchase_invoice(invoice, supplier_iban, company_ac
            return  # Salir de la función sin crear el Payment Entry
 
        # Verificar si ya existe un Payment Entry para esta factura con el mismo monto
-       existing_payments = frappe.get_all(
-           "Payment Entry Reference",
-           filters={
-               "reference_doctype": "Purchase Invoice",
-               "reference_name": invoice.name,
-               "allocated_amount": invoice.outstanding_amount,
-               "parent": ["in", frappe.get_all("Payment Entry", filters={"docstatus": ["!=", 2]}, pluck="name")]
-           },
-           fields=["parent"]
-       )
+       if pagos is None:
+           pagos = get_pagos_activos("Purchase Invoice", [invoice.name])[invoice.name]
+       existing_payments = [pago for pago in pagos if flt(pago.allocated_amount) == flt(invoice.outstanding_amount)]
 
        if existing_payments:
            logger.info(f"Ya existe un Payment Entry activo para la factura {invoice.name} con el mismo monto.")
            return  # Salir de la función sin crear un nuevo Payment Entry
 
+       if empresa is None:
+           empresa = get_empresas([invoice.company])[invoice.company]
+
        # Obtener la cuenta por pagar del proveedor desde la factura de compra
        credit_account = invoice.credit_to
 
        # Verificar que la cuenta 'debit_account' esté configurada como "Payable"
-       if frappe.db.get_value("Account", credit_account, "account_type") != "Payable":
+       if frappe.get_cached_value("Account", credit_account, "account_type") != "Payable":
            frappe.throw(_("La cuenta de débito asignada no es de tipo 'Payable'. Verifique la configuración de la cuenta."))
 
        # Obtener la cuenta bancaria de la empresa (para `paid_to`)
-       company_bank_account = company_account or frappe.get_value("Company", invoice.company, "default_bank_account")
-       bank_account_name = frappe.get_value("Bank Account", {"account": company_bank_account}, "name")
-       bank_account = frappe.get_doc("Bank Account", bank_account_name)
-       default_cost_center = frappe.get_value("Company", invoice.company, "cost_center")
+       company_bank_account = company_account or empresa.default_bank_account
+       default_cost_center = empresa.cost_center
 
        # Validar que la cuenta bancaria de la empresa esté configurada
        if not company_bank_account:
            frappe.throw(_("No se ha configurado una cuenta bancaria por defecto para la empresa."))
 
-       # Obtener la cuenta bancaria del proveedor usando el IBAN
-       supplier_bank = frappe.get_value("Bank Account", {"iban": supplier_iban}, "name")
+       if company_bank_account == empresa.default_bank_account and empresa.cuenta_bancaria:
+           bank_account_name = empresa.cuenta_bancaria
+       else:
+           bank_account_name = frappe.get_value("Bank Account", {"account": company_bank_account}, "name")
+
+       # Cuenta bancaria del proveedor: la elegida al cargar la remesa o la del IBAN
+       supplier_bank = invoice.get("cuenta_tercero") or frappe.get_value("Bank Account", {"iban": supplier_iban}, "name")
        if not supplier_bank:
            frappe.throw(_("No se encontró una cuenta bancaria con el IBAN especificado."))
 
        # Obtener el tipo de cambio
        source_exchange_rate = 1.0
-       company_currency = frappe.get_value("Company", invoice.company, "default_currency")
+       company_currency = empresa.default_currency
        if invoice.currency != company_currency:
            source_exchange_rate = frappe.get_value("Currency Exchange", {"from_currency": invoice.currency, "to_currency": company_currency}, "exchange_rate")
            if not source_exchange_rate:
@@ -528,15 +445,15 @@ def create_payment_entry_for_purchase_invoice(invoice, supplier_iban, company_ac
            "party_type": "Supplier",
            "party": invoice.supplier,
            "company": invoice.company,
-           "mode_of_payment": frappe.get_value("Supplier", invoice.supplier, "mode_of_payment"),
+           "mode_of_payment": invoice.get("modo_de_cobro") or frappe.get_value("Supplier", invoice.supplier, "mode_of_payment"),
            "paid_amount": invoice.rounded_total,  # Ajuste de paid_amount a outstanding_amount válido
            "received_amount": invoice.rounded_total,  # Ajuste de received_amount a outstanding_amount válido
            "paid_from": company_bank_account or "",  # Cuenta por pagar del proveedor (cuenta del proveedor en la factura)
-           "paid_from_account_currency": frappe.get_value("Account", company_bank_account, "account_currency") if company_bank_account else None,
+           "paid_from_account_currency": frappe.get_cached_value("Account", company_bank_account, "account_currency") if company_bank_account else None,
            "paid_to": credit_account,  # Cuenta bancaria de la empresa para pagos
-           "paid_to_account_currency": frappe.get_value("Account", credit_account, "account_currency"),
+           "paid_to_account_currency": frappe.get_cached_value("Account", credit_account, "account_currency"),
            "reference_no": invoice.name,
-           "bank_account": bank_account.name,
+           "bank_account": bank_account_name,
            "party_bank_account": supplier_bank,
            "cost_center": default_cost_center,
            "reference_date": invoice.posting_date,
@@ -558,6 +475,7 @@ def create_payment_entry_for_purchase_invoice(invoice, supplier_iban, company_ac
        payment_entry.submit()
 
        logger.info(f"Payment Entry creado para la factura {invoice.name}: {payment_entry.name}")
+       return payment_entry.name
 
    except Exception as e:
        logger.error(f"Error al crear Payment Entry para la factura {invoice.name}: {e}")
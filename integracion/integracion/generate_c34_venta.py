@@ -5,8 +5,14 @@ from datetime import datetime, timedelta
 from urllib.parse import quote
 from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
-from lxml import etree
 import frappe
+from integracion.integracion.conexion_sp import get_sharepoint_context
+from integracion.integracion.carpetas_sp import ensure_folder_path, normalize_path
+from integracion.integracion.subida_sp import upload_local_file
+from integracion.integracion.sepa_xml import XSD_PAIN_008, get_ruta_cuaderno, validate_sepa, write_pain_008
+from integracion.integracion.datos_remesa import (
+    MODO_COBRO_REMESA, elegir_cuenta, get_cuentas_bancarias, get_empresas, load_facturas_venta
+)
 import pandas as pd
 from frappe import _
 import requests
@@ -20,6 +26,15 @@ def remove_accents(input_str):
     # Filter out any non-ASCII characters (this removes accents)
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
+# Caracteres que admite el esquema SEPA en la referencia del mandato (MndtId, hasta 35)
+CARACTERES_NO_SEPA = re.compile(r"[^A-Za-z0-9/\-?:().,'+ ]")
+MAX_REFERENCIA_MANDATO = 35
+
+def get_referencia_mandato(cliente):
+    # Nombre del cliente (o su CIF) sin acentos ni caracteres fuera del juego SEPA, recortado a 35
+    referencia = CARACTERES_NO_SEPA.sub("", remove_accents(cliente.customer_name or cliente.tax_id or ""))
+    return referencia.strip()[:MAX_REFERENCIA_MANDATO].strip()
+
 # Leer credenciales desde el archivo de configuración del sitio
 # Leer credenciales desde el archivo de configuración del sitio
 site_config = frappe.get_site_config()
@@ -43,33 +58,12 @@ logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
 def get_customer_iban(client_name, company):
-    # Consultar la cuenta bancaria que tiene un enlace al cliente
-    bank_accounts = frappe.get_all("Bank Account", filters={
-        "party_type": "Customer",
-        "party": client_name
-    }, fields=["iban", "company"])
-
-    if not bank_accounts:
-        # Si no se encuentra el IBAN en las cuentas bancarias del cliente, buscar el default_bank_account
-        default_bank_account = frappe.get_value("Customer", client_name, "default_bank_account")
-        if default_bank_account:
-            # Obtener el IBAN de la cuenta bancaria predeterminada
-            iban = frappe.get_value("Bank Account", default_bank_account, "iban")
-            if iban:
-                return {"iban": iban}
-        
-        return ""  # Devolver un valor vacío si no se encuentra el IBAN en ninguna parte
-
-    # Filtrar cuentas bancarias por la empresa específica
-    filtered_accounts = [account for account in bank_accounts if account.get("company") == company]
-
-    if filtered_accounts:
-        return filtered_accounts[0].iban
-    else:
-        return bank_accounts[0].iban  # Si no hay coincidencia con la empresa, devolver el primero disponible
+    # Cuenta del cliente en la empresa, la primera disponible o su default_bank_account
+    cuenta = elegir_cuenta(get_cuentas_bancarias("Customer", [client_name])[client_name], company)
+    return (cuenta.iban or "") if cuenta else ""  # Devolver un valor vacío si no se encuentra el IBAN en ninguna parte
 
 
-def change_status_to_remesa_emitida(sales_invoice_name, remesa_name):
+def change_status_to_remesa_emitida(sales_invoice_name, remesa_name, customer_custom_modo_de_cobro=None):
     try:
         # Obtener el documento de la factura de compra
         doc = frappe.get_doc("Sales Invoice", sales_invoice_name)
@@ -84,7 +78,8 @@ def change_status_to_remesa_emitida(sales_invoice_name, remesa_name):
 
 
         # Establecer el modo de pago desde el cliente
-        customer_custom_modo_de_cobro = frappe.get_value("Customer", doc.customer, "custom_modo_de_cobro")
+        if customer_custom_modo_de_cobro is None:
+            customer_custom_modo_de_cobro = frappe.get_value("Customer", doc.customer, "custom_modo_de_cobro")
         doc.custom_modo_de_cobro = customer_custom_modo_de_cobro
 
         # Obtener la cuenta bancaria predeterminada para el modo de pago
@@ -115,6 +110,40 @@ def change_status_to_remesa_emitida(sales_invoice_name, remesa_name):
     except Exception as e:
         logger.error(f"Error al cambiar el estado de la factura {sales_invoice_name}: {e}")
 
+
+def marcar_remesa_emitida(company, invoices, remesa_name):
+    # Las facturas validadas se marcan con una actualización por modo de cobro; los borradores se guardan uno a uno
+    validadas = {}
+    for invoice in invoices:
+        if invoice.docstatus == 1:
+            validadas.setdefault(invoice.modo_de_cobro, []).append(invoice.name)
+        elif invoice.docstatus == 0:
+            change_status_to_remesa_emitida(invoice.name, remesa_name, invoice.modo_de_cobro)
+
+    if not validadas:
+        return
+
+    cuentas = {
+        cuenta.parent: cuenta.default_account
+        for cuenta in frappe.get_all(
+            "Mode of Payment Account",
+            filters={"parent": ["in", list(validadas)], "company": company},
+            fields=["parent", "default_account"]
+        )
+    }
+    for modo, facturas in validadas.items():
+        try:
+            cuenta = cuentas.get(modo)
+            frappe.db.sql(f"""
+                UPDATE `tabSales Invoice`
+                SET custom_remesa_emitida = 1, custom_remesa = %(remesa)s, paid_amount = outstanding_amount,
+                    {"cash_bank_account = %(cuenta)s," if cuenta else ""} modified = %(ahora)s
+                WHERE name IN %(facturas)s
+            """, {"remesa": remesa_name, "cuenta": cuenta, "ahora": frappe.utils.now(), "facturas": tuple(facturas)})
+            logger.info(f"Campos personalizados de {len(facturas)} facturas validadas actualizados con la remesa {remesa_name}")
+        except Exception as e:
+            logger.error(f"Error al marcar las facturas {facturas} con la remesa {remesa_name}: {e}")
+
 @frappe.whitelist()
 def generate_c34_venta(invoice_data=None):
     logger.info("Inicio de la generación de Cuaderno 34")
@@ -126,40 +155,28 @@ def generate_c34_venta(invoice_data=None):
         if invoice_names:
             logger.debug(f"Procesando facturas específicas: {invoice_names}")
 
-            # Aplicar el filtro solo a las facturas seleccionadas
-            filtered_invoices = frappe.get_all("Sales Invoice", filters={
-                "name": ["in", invoice_names],
-                "custom_aprobada_para_cobro": 1,
-                "custom_remesa_emitida": 0,
-                "docstatus": ["!=", 2]
-            }, fields=["name"])
-
-            # Si no se encuentran facturas después del filtro, no hacer nada
-            if not filtered_invoices:
-                logger.warning("No se encontraron facturas que cumplan los criterios.")
-                return
-        else:
-            # Si no se seleccionan facturas, obtener todas las facturas aprobadas
-            filtered_invoices = frappe.get_all("Sales Invoice", filters={
-                "custom_aprobada_para_cobro": 1,
-                "custom_remesa_emitida": 0,
-                "docstatus": ["!=", 2]
-            }, fields=["name"])
-            logger.debug(f"Total facturas encontradas: {len(filtered_invoices)}")
+        # Facturas aprobadas (todas o solo las seleccionadas) con los datos y el IBAN de su cliente
+        filtered_invoices = load_facturas_venta(invoice_names)
+        logger.debug(f"Total facturas encontradas: {len(filtered_invoices)}")
+
+        # Si no se encuentran facturas después del filtro, no hacer nada
+        if invoice_names and not filtered_invoices:
+            logger.warning("No se encontraron facturas que cumplan los criterios.")
+            return
 
     except Exception as e:
         logger.error(f"Error al obtener facturas: {e}")
         return
 
+    # URLs de los archivos subidos y, con "error", las facturas excluidas y los archivos no válidos
+    sharepoint_urls = []
     invoices_by_company = {}
-    for invoice_data in filtered_invoices:
+    for invoice in filtered_invoices:
         try:
-            invoice = frappe.get_doc("Sales Invoice", invoice_data["name"])
             logger.debug(f"Procesando factura {invoice.name}")
 
-            custom_modo_de_cobro = frappe.get_value("Customer", invoice.customer, "custom_modo_de_cobro")
-            if custom_modo_de_cobro != "Giro bancario":
-                logger.debug(f"Factura {invoice.name} ignorada por modo de cobro {custom_modo_de_cobro} {invoice.customer}")
+            if invoice.modo_de_cobro != MODO_COBRO_REMESA:
+                logger.debug(f"Factura {invoice.name} ignorada por modo de cobro {invoice.modo_de_cobro} {invoice.customer}")
                 continue
 
             company = invoice.company
@@ -167,172 +184,88 @@ def generate_c34_venta(invoice_data=None):
                 logger.error(f"Factura {invoice.name} no tiene una empresa asociada.")
                 continue
 
+            # Sin IBAN o sin referencia de mandato el banco rechaza el adeudo: se excluye solo esta factura
+            invoice.mandato = get_referencia_mandato(invoice.tercero)
+            error = None
+            if not invoice.iban:
+                error = f"El cliente {invoice.customer_name} no tiene IBAN"
+            elif not invoice.mandato:
+                error = f"El cliente {invoice.customer} no tiene nombre ni CIF para la referencia del mandato"
+            if error:
+                logger.error(f"Factura {invoice.name} excluida de la remesa: {error}")
+                sharepoint_urls.append({"company": company, "factura": invoice.name, "error": error})
+                continue
+
             if company not in invoices_by_company:
                 invoices_by_company[company] = []
             invoices_by_company[company].append(invoice)
             logger.debug(f"Factura {invoice.name} agregada a la empresa {company}")
 
         except Exception as e:
-            logger.error(f"Error al procesar la factura {invoice_data['name']}: {e}")
+            logger.error(f"Error al procesar la factura {invoice.name}: {e}")
     
-    sharepoint_urls = []
+    # Datos de todas las empresas de la remesa en una sola pasada
+    empresas = get_empresas(list(invoices_by_company))
+
     files = []
     for company, invoices in invoices_by_company.items():
         try:
             company_clean = remove_accents(company)
-            abbr = frappe.get_value("Company", company, "abbr")
+            empresa = empresas[company]
+            abbr = empresa.abbr
             now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
             now_format = datetime.now().strftime("%d-%m-%Y")
-            tax_id = frappe.get_value("Company", company, "tax_id")  # Obteniendo el CIF de la empresa
+            tax_id = empresa.tax_id  # Obteniendo el CIF de la empresa
             fichero_id_value = f"C19-{abbr}-{now.replace(':', '')}"
             
-            # Crear el elemento principal del XML conforme al estándar SEPA
-            root = etree.Element("Document", xmlns="urn:iso:std:iso:20022:tech:xsd:pain.008.001.02")
-            cstmr_drct_dbt_initn = etree.SubElement(root, "CstmrDrctDbtInitn")
-
-            # Crear el header del grupo
-            grp_hdr = etree.SubElement(cstmr_drct_dbt_initn, "GrpHdr")
-            msg_id = etree.SubElement(grp_hdr, "MsgId")
-            msg_id.text = fichero_id_value
-            cre_dt_tm = etree.SubElement(grp_hdr, "CreDtTm")
-            cre_dt_tm.text = now
-            nb_of_txs = etree.SubElement(grp_hdr, "NbOfTxs")
-            nb_of_txs.text = str(len(invoices))
-            ctrl_sum = etree.SubElement(grp_hdr, "CtrlSum")
-            ctrl_sum.text = "{:.2f}".format(sum(invoice.grand_total for invoice in invoices))
-            initg_pty = etree.SubElement(grp_hdr, "InitgPty")
-            nm = etree.SubElement(initg_pty, "Nm")
-            nm.text = company_clean
-            id_elem = etree.SubElement(initg_pty, "Id")
-            org_id = etree.SubElement(id_elem, "OrgId")
-            othr = etree.SubElement(org_id, "Othr")
-            othr_id = etree.SubElement(othr, "Id")
-            othr_id.text = frappe.get_value("Company", company, "tax_id")
-            schme_nm = etree.SubElement(othr, "SchmeNm")
-            prtry = etree.SubElement(schme_nm, "Prtry")
-            prtry.text = "ES"
-
-            # Información de pago
-            pmt_inf = etree.SubElement(cstmr_drct_dbt_initn, "PmtInf")
-            pmt_inf_id = etree.SubElement(pmt_inf, "PmtInfId")
-            pmt_inf_id.text = f"{tax_id} {now_format}"
-            pmt_mtd = etree.SubElement(pmt_inf, "PmtMtd")
-            pmt_mtd.text = "DD"
-            nb_of_txs_pmt_inf = etree.SubElement(pmt_inf, "NbOfTxs")
-            nb_of_txs_pmt_inf.text = str(len(invoices))
-            ctrl_sum_pmt_inf = etree.SubElement(pmt_inf, "CtrlSum")
-            ctrl_sum_pmt_inf.text = "{:.2f}".format(sum(invoice.grand_total for invoice in invoices))
-            pmt_tp_inf = etree.SubElement(pmt_inf, "PmtTpInf")
-            svc_lvl = etree.SubElement(pmt_tp_inf, "SvcLvl")
-            svc_lvl_cd = etree.SubElement(svc_lvl, "Cd")
-            svc_lvl_cd.text = "SEPA"
-            lcl_instrm = etree.SubElement(pmt_tp_inf, "LclInstrm")
-            lcl_instrm_cd = etree.SubElement(lcl_instrm, "Cd")
-            lcl_instrm_cd.text = "CORE"
-            seq_tp = etree.SubElement(pmt_tp_inf, "SeqTp")
-            seq_tp.text = "RCUR"
-            reqd_colltn_dt = etree.SubElement(pmt_inf, "ReqdColltnDt")
-            reqd_colltn_date = frappe.utils.getdate(frappe.utils.nowdate()) + timedelta(days=4)
-            reqd_colltn_dt.text = reqd_colltn_date.strftime('%Y-%m-%d')
-
-            # Acreedor (Cdtr)
-            cdtr = etree.SubElement(pmt_inf, "Cdtr")
-            cdtr_nm = etree.SubElement(cdtr, "Nm")
-            cdtr_nm.text = company_clean
-
-            cdtr_acct = etree.SubElement(pmt_inf, "CdtrAcct")
-            cdtr_acct_id = etree.SubElement(cdtr_acct, "Id")
-            cdtr_acct_iban = etree.SubElement(cdtr_acct_id, "IBAN")
-            default_bank_account = frappe.get_value("Company", company, "default_bank_account")
-            iban = frappe.get_value("Bank Account", {"account": default_bank_account}, "iban")
-            logger.debug(f"IBAN de la empresa {company}: {iban}")
-            cdtr_acct_iban.text = iban.upper()
-
-            # Agente del acreedor (CdtrAgt)
-            cdtr_agt = etree.SubElement(pmt_inf, "CdtrAgt")
-            fin_instn_id = etree.SubElement(cdtr_agt, "FinInstnId")
-
-
-            chrg_br = etree.SubElement(pmt_inf, "ChrgBr")
-            chrg_br.text = "SLEV"
-
-            # Esquema del acreedor (CdtrSchmeId)
-            cdtr_schme_id = etree.SubElement(pmt_inf, "CdtrSchmeId")
-            id_elem = etree.SubElement(cdtr_schme_id, "Id")
-            prvt_id = etree.SubElement(id_elem, "PrvtId")
-            othr = etree.SubElement(prvt_id, "Othr")
-            othr_id = etree.SubElement(othr, "Id")
-            othr_id.text = frappe.get_value("Company", company, "tax_id")
-            schme_nm = etree.SubElement(othr, "SchmeNm")
-            prtry = etree.SubElement(schme_nm, "Prtry")
-            prtry.text = "ES"
-
-            # Datos de las transacciones (facturas)
-            for invoice in invoices:
-                customer_cif = frappe.get_value("Customer", invoice.customer, "tax_id")
-                ref_mandato = frappe.get_value("Customer", invoice.customer, "customer_name") or customer_cif
-                firma_mandato = frappe.utils.nowdate()
-                drct_dbt_tx_inf = etree.SubElement(pmt_inf, "DrctDbtTxInf")
-                pmt_id = etree.SubElement(drct_dbt_tx_inf, "PmtId")
-                end_to_end_id = etree.SubElement(pmt_id, "EndToEndId")
-                end_to_end_id.text = invoice.name
-
-                amt = etree.SubElement(drct_dbt_tx_inf, "InstdAmt", Ccy="EUR")
-                amt.text = "{:.2f}".format(invoice.grand_total)
-
-                drct_dbt_tx = etree.SubElement(drct_dbt_tx_inf, "DrctDbtTx")
-                mndt_rltd_inf = etree.SubElement(drct_dbt_tx, "MndtRltdInf")
-                mndt_id = etree.SubElement(mndt_rltd_inf, "MndtId")
-                mndt_id.text = ref_mandato # Mandato relacionado con la factura
-
-                dt_of_sgntr = etree.SubElement(mndt_rltd_inf, "DtOfSgntr")
-                dt_of_sgntr.text = firma_mandato  # Fecha de la firma del mandato
-
-                dbtr_agt = etree.SubElement(drct_dbt_tx_inf, "DbtrAgt")
-                fin_instn_id = etree.SubElement(dbtr_agt, "FinInstnId")  # No necesita BIC
-
-                dbtr = etree.SubElement(drct_dbt_tx_inf, "Dbtr")
-                dbtr_nm = etree.SubElement(dbtr, "Nm")
-                dbtr_nm.text = invoice.customer_name
-
-                dbtr_acct = etree.SubElement(drct_dbt_tx_inf, "DbtrAcct")
-                dbtr_acct_id = etree.SubElement(dbtr_acct, "Id")
-                iban_elem = etree.SubElement(dbtr_acct_id, "IBAN")
-                iban_customer = get_customer_iban(invoice.customer, invoice.company).upper()
-                logger.debug(f"IBAN del cliente {invoice.customer}: {iban_customer}")
-                iban_elem.text = iban_customer
-
-
-                rmt_inf = etree.SubElement(drct_dbt_tx_inf, "RmtInf")
-                ustrd = etree.SubElement(rmt_inf, "Ustrd")
-                ustrd.text = invoice.name or "Pago de factura"
-
-            # Guardar el XML
-            xml_file_path = f"/home/frappe/frappe-bench/sites/erp.grupoatu.com/private/cuaderno/{fichero_id_value}.xml"
-            tree = etree.ElementTree(root)
-            tree.write(xml_file_path, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-            logger.info(f"Archivo XML generado para {company}: {xml_file_path}")
+            # Datos de las transacciones (facturas), leídos de las filas precargadas
+            fecha_cobro = frappe.utils.getdate(frappe.utils.nowdate()) + timedelta(days=4)
+            firma_mandato = frappe.utils.nowdate()
+            cobros = [
+                {
+                    "id": invoice.name,
+                    "importe": invoice.grand_total,
+                    "mandato": invoice.mandato,  # Referencia del mandato del cliente
+                    "fecha_firma": firma_mandato,  # Fecha de la firma del mandato
+                    "nombre": invoice.customer_name,
+                    "iban": (invoice.iban or "").upper(),
+                    "concepto": invoice.name or "Pago de factura"
+                }
+                for invoice in invoices
+            ]
+            logger.debug(f"IBAN de la empresa {company}: {empresa.iban}")
+
+            # Escribir el XML conforme al estándar SEPA (pain.008.001.02)
+            xml_file_path = get_ruta_cuaderno(f"{fichero_id_value}.xml")
+            num_cobros, total_cobros = write_pain_008(xml_file_path, {
+                "msg_id": fichero_id_value,
+                "creacion": now,
+                "nombre": company_clean,
+                "nif": tax_id,
+                "pmt_inf_id": f"{tax_id} {now_format}",
+                "fecha_cobro": fecha_cobro.strftime('%Y-%m-%d'),
+                "iban": (empresa.iban or "").upper()
+            }, cobros)
+            logger.info(f"Archivo XML generado para {company}: {xml_file_path} ({num_cobros} cobros, {total_cobros} EUR)")
 
             # Validar el XML contra el XSD
-            # xsd_file_path = "/home/frappe/frappe-bench/apps/integracion/integracion/integracion/c34_xsd/pain.008.001.02.xsd"
-            # is_valid, validation_errors = validate_xml_against_xsd(xml_file_path, xsd_file_path)
-            # if is_valid:
-            #     logger.info(f"El archivo XML {xml_file_path} es válido según el XSD.")
-            # else:
-            #     logger.error(f"El archivo XML {xml_file_path} no es válido según el XSD: {validation_errors}")
-                
-            #     return {"error": "XML validation failed", "details": validation_errors}
+            validation_errors = validate_sepa(xml_file_path, XSD_PAIN_008)
+            if validation_errors:
+                # No se sube ni se remesa un fichero que el banco rechazaría
+                os.remove(xml_file_path)
+                sharepoint_urls.append({"company": company, "error": f"El XML no es válido según el XSD: {validation_errors}"})
+                continue
+            logger.info(f"El archivo XML {xml_file_path} es válido según el XSD.")
 
             # Generar el archivo Excel
             data_total = 0
             data = []
             for invoice in invoices:
                 try:
-                    customer_iban = get_customer_iban(invoice.customer, invoice.company).upper()
-                    fecha_cobro = frappe.utils.getdate(frappe.utils.nowdate()) + timedelta(days=4)
-                    customer_cif = frappe.get_value("Customer", invoice.customer, "tax_id")
-                    pais = frappe.get_value("Customer", invoice.customer, "custom_pais")
-                    ref_mandato = frappe.get_value("Customer", invoice.customer, "customer_name") or customer_cif
+                    customer_iban = (invoice.iban or "").upper()
+                    customer_cif = invoice.tercero.tax_id
+                    pais = invoice.tercero.custom_pais
+                    ref_mandato = invoice.mandato
                     residente = "S" if pais and pais.lower() == "es" else "N"
 
                     data.append({
@@ -350,7 +283,7 @@ def generate_c34_venta(invoice_data=None):
                         "Tipo Transferencia": "SEPA"
                     })
                     logger.debug(f"Datos agregados para la factura {invoice.name} del cliente {invoice.customer_name}")
-                    create_payment_entry_for_invoice(invoice)
+                    create_payment_entry_for_invoice(invoice, empresa)
                     data_total = data_total + float(invoice.grand_total)
                 except Exception as e:
                     logger.error(f"Error al procesar la factura {invoice.name}: {e}")
@@ -371,7 +304,7 @@ def generate_c34_venta(invoice_data=None):
             #         })
 
             df = pd.DataFrame(data)
-            excel_file_path = f"/home/frappe/frappe-bench/sites/erp.grupoatu.com/private/cuaderno/{fichero_id_value}.xlsx"
+            excel_file_path = get_ruta_cuaderno(f"{fichero_id_value}.xlsx")
             df.to_excel(excel_file_path, index=False)
             logger.info(f"Archivo Excel generado para {company}: {excel_file_path}")
 
@@ -388,10 +321,8 @@ def generate_c34_venta(invoice_data=None):
                 logger.debug(f"Archivo Excel subido a SharePoint: {excel_sharepoint_url}")
 
             # Crear la remesa y actualizar el estado de las facturas
-            remesa_name = create_remesa(company, invoices, excel_sharepoint_url)
-            for invoice in invoices:
-                change_status_to_remesa_emitida(invoice.name, remesa_name)
-                logger.debug(f"Estado cambiado a 'Remesa Emitida' para la factura {invoice.name}")
+            remesa_name = create_remesa(company, invoices, excel_sharepoint_url, abbr)
+            marcar_remesa_emitida(company, invoices, remesa_name)
 
             # Eliminar los archivos locales después de subirlos
             if os.path.exists(xml_file_path):
@@ -407,28 +338,14 @@ def generate_c34_venta(invoice_data=None):
     logger.info("Urls de SharePoint generadas:" + str(sharepoint_urls))
     return sharepoint_urls
 
-def validate_xml_against_xsd(xml_file_path, xsd_file_path):
-    try:
-        with open(xsd_file_path, 'rb') as schema_file:
-            schema_root = etree.XML(schema_file.read())
-        schema = etree.XMLSchema(schema_root)
-
-        with open(xml_file_path, 'rb') as xml_file:
-            xml_doc = etree.parse(xml_file)
-
-        schema.assertValid(xml_doc)
-        return True, None
-    except etree.DocumentInvalid as e:
-        return False, str(e)
-
-def create_remesa(company, invoices, sharepoint_url):
+def create_remesa(company, invoices, sharepoint_url, abbr=None):
     try:
         # Crear un nuevo documento de Remesa
         remesa_doc = frappe.get_doc({
             "doctype": "Remesa Registro",
             "remesa_de": "Sales Invoice",
             "company": company,
-            "company_abbr": frappe.get_value("Company", company, "abbr"),
+            "company_abbr": abbr or frappe.get_value("Company", company, "abbr"),
             "fecha": frappe.utils.nowdate(),
             "url": sharepoint_url,
             "facturas": [{"factura": inv.name, "importe": inv.grand_total} for inv in invoices],
@@ -446,29 +363,6 @@ def create_remesa(company, invoices, sharepoint_url):
         logger.error(f"Error al crear el documento de remesa para {company}: {e}")
         return None
 
-def create_folder_if_not_exists(ctx, folder_relative_url, folder_name):
-    try:
-        logger.info(f"Comprobando existencia de carpeta en la ruta: /{folder_relative_url}/{folder_name}")
-        parent_folder = ctx.web.get_folder_by_server_relative_url(f"{folder_relative_url}")
-        ctx.load(parent_folder)
-        ctx.execute_query()
-        logger.info(f"Conectado a parent {parent_folder}")
-
-        folders = parent_folder.folders
-        ctx.load(folders)
-        ctx.execute_query()
-
-        folder_names = [folder.properties['Name'] for folder in folders]
-
-        if (folder_name in folder_names):
-            logger.info(f"La carpeta ya existe: {folder_relative_url}/{folder_name}")
-        else:
-            new_folder = parent_folder.folders.add(folder_name).execute_query()
-            logger.info(f"Carpeta creada: {new_folder.serverRelativeUrl}")
-    except Exception as e:
-        logger.error(f"Error verificando/creando carpeta en {folder_relative_url}/{folder_name}: {e}")
-        raise
-
 def upload_file_to_sharepoint(file_path, company, fichero_id_value):
     logger.info(f"Subiendo archivo {file_path} a SharePoint para la compañía {company} con Cuaderno {fichero_id_value}")
     try:
@@ -487,56 +381,25 @@ def upload_file_to_sharepoint(file_path, company, fichero_id_value):
         logger.info(f"Ruta relativa calculada: {relative_path}")
         logger.info(f"Conectando al contexto del sitio: {site_url}")
 
-        def connect_to_sharepoint_with_token(site_url):
-            try:
-                # Usar el certificado y la huella digital para autenticarse directamente
-                logger.info(f"Conectando al contexto del sitio: {site_url} con huella digital: {cert_finger} y ruta de certificado: {cert_path}")
-
-                # Configurar el contexto de cliente con el certificado
-                ctx = ClientContext(site_url).with_client_certificate(
-                    client_id=id_cliente,
-                    thumbprint=cert_finger.replace(":", "").upper(),
-                    cert_path=cert_path,
-                    tenant=tenant_id
-                )
-                
-                # Probar la conexión accediendo a algún recurso básico
-                web = ctx.web.get().execute_query()
-                logger.info(f"Conexión exitosa al sitio SharePoint: {web.properties['Title']}")
-                
-                return ctx
-            except Exception as e:
-                logger.error(f"Error al conectar a SharePoint con certificado: {e}")
-                return None
-
-
         # credentials = UserCredential(user_email, user_password)
         # ctx = ClientContext(site_url).with_credentials(credentials)
-        ctx = connect_to_sharepoint_with_token(site_url)
+        ctx = get_sharepoint_context(site_url)
 
         company_folder_name = quote(company)
         cuaderno_folder_name = quote(fichero_id_value)
 
-        # Crear la carpeta de la compañía si no existe
-        create_folder_if_not_exists(ctx, relative_path, company_folder_name)
-
-        # Crear la carpeta del Cuaderno 34 dentro de la carpeta de la compañía
+        # Crear las carpetas de la compañía y del Cuaderno 34 en una sola petición
         company_folder_relative_url = f"{relative_path}/{company_folder_name}".strip('/')
-        create_folder_if_not_exists(ctx, company_folder_relative_url, cuaderno_folder_name)
-
-        with open(file_path, 'rb') as file_content:
-            content = file_content.read()
+        ensure_folder_path(ctx, f"{company_folder_relative_url}/{cuaderno_folder_name}")
 
         file_name = os.path.basename(file_path)
         file_url = f"{company_folder_relative_url}/{cuaderno_folder_name}/{file_name}"
         logger.info(f"Intentando subir archivo a: {file_url}")
 
         try:
-            target_folder = ctx.web.get_folder_by_server_relative_url(f"{company_folder_relative_url}/{cuaderno_folder_name}")
-            ctx.load(target_folder)
-            ctx.execute_query()
+            target_folder = ctx.web.get_folder_by_server_relative_url(normalize_path(f"{company_folder_relative_url}/{cuaderno_folder_name}"))
 
-            target_folder.upload_file(file_name, content).execute_query()
+            upload_local_file(ctx, target_folder, file_path, file_name)
             logger.info(f"Archivo subido: {file_url}")
 
             # Devolver la URL de SharePoint
@@ -550,7 +413,8 @@ def upload_file_to_sharepoint(file_path, company, fichero_id_value):
         logger.error(f"Error al subir archivo a SharePoint: {str(e)}")
         return None
 
-def create_payment_entry_for_invoice(invoice):
+def create_payment_entry_for_invoice(invoice, empresa=None):
+    # `empresa` es la fila precargada de get_empresas; si no se indica se consulta
     try:
         # Verificar si la factura ya ha sido pagada
         if invoice.outstanding_amount == 0:
@@ -561,11 +425,13 @@ def create_payment_entry_for_invoice(invoice):
         receivable_account = invoice.debit_to
         
         # Verificar que la cuenta 'receivable_account' esté configurada como "Receivable"
-        if frappe.db.get_value("Account", receivable_account, "account_type") != "Receivable":
+        if frappe.get_cached_value("Account", receivable_account, "account_type") != "Receivable":
             frappe.throw(_("La cuenta asignada no es de tipo 'Receivable'. Verifique la configuración de la cuenta."))
 
         # Obtener la cuenta bancaria de la empresa para el cobro
-        company_bank_account = frappe.get_value("Company", invoice.company, "default_bank_account")
+        if empresa is None:
+            empresa = get_empresas([invoice.company])[invoice.company]
+        company_bank_account = empresa.default_bank_account
 
         # Validar que la cuenta bancaria de la empresa esté configurada
         if not company_bank_account:
@@ -579,13 +445,13 @@ def create_payment_entry_for_invoice(invoice):
             "party_type": "Customer",
             "party": invoice.customer,
             "company": invoice.company,
-            "mode_of_payment": frappe.get_value("Customer", invoice.customer, "custom_modo_de_cobro"),
+            "mode_of_payment": invoice.get("modo_de_cobro") or frappe.get_value("Customer", invoice.customer, "custom_modo_de_cobro"),
             "paid_amount": invoice.grand_total,
             "received_amount": invoice.grand_total,
             "paid_from": receivable_account,  # Cuenta de origen del débito (cuenta por cobrar)
-            "paid_from_account_currency": frappe.get_value("Account", receivable_account, "account_currency"),
+            "paid_from_account_currency": frappe.get_cached_value("Account", receivable_account, "account_currency"),
             "paid_to": company_bank_account,  # Cuenta bancaria de la empresa para recibir el pago
-            "paid_to_account_currency": frappe.get_value("Account", company_bank_account, "account_currency"),
+            "paid_to_account_currency": frappe.get_cached_value("Account", company_bank_account, "account_currency"),
             "reference_no": invoice.name,
             "reference_date": invoice.posting_date,
             "references": [
@@ -1,12 +1,25 @@
 import frappe
 
+from integracion.integracion.indice_contable import IndiceContable
+from integracion.integracion.escritor_asientos import insert_journal_entries
+from integracion.integracion.renumerar_asientos import limpiar_numeros_transaccion
+from integracion.integracion.progreso import ReporteProgreso, get_job_progress
+from integracion.integracion.validacion_diario import init_validation_process, validate_sheet, read_validated_sheet
+
 import openpyxl
 from openpyxl import load_workbook
 
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
 
+site_config = frappe.get_site_config()
+
+# Procesos que validan hojas en paralelo (1 desactiva la validación en paralelo)
+MAX_PROCESOS_VALIDACION = int(site_config.get('procesos_validacion_diario') or min(4, os.cpu_count() or 1))
+
 # Configurar el logger
 logger = logging.getLogger(__name__)
 
@@ -19,473 +32,507 @@ logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
 @frappe.whitelist()
-def get_progress():
-	progreso = frappe.cache().hget('import_journal_entries_progreso', 'progreso')
-	total_asientos = frappe.cache().hget('import_journal_entries_progreso', 'total_asientos')
-	estado = frappe.cache().hget('import_journal_entries_progreso', 'estado')
+def get_progress(job_id=None):
+	progreso = get_job_progress("import_journal_entries_progreso", job_id)
 
-	if progreso and total_asientos and estado:
+	if progreso and progreso["total"] and progreso["estado"]:
 		return {
-            "progreso": int(progreso),
-            "total_asientos": int(total_asientos),
-			"estado": estado
-        }
+			"progreso": int(progreso["progreso"]),
+			"total_asientos": int(progreso["total"]),
+			"estado": progreso["estado"]
+		}
 
 	return None
 
 @frappe.whitelist()
 def import_journal_entries(excel_file, company: str):
-	# Cargar progreso al cache Frappe
-
-	progreso = frappe.cache().hset('import_journal_entries_progreso', 'progreso', 0)
-	total_asientos = frappe.cache().hset('import_journal_entries_progreso', 'total_asientos', 100)
-	estado = frappe.cache().hset('import_journal_entries_progreso', 'estado', "Limpiando datos...")
+	"""
+	Encola la importación del diario en la cola long: la validación de las
+	hojas puede arrancar procesos nuevos, que no deben retener un worker web.
+	El progreso y el resultado llegan por realtime con el `job_id` devuelto.
+	"""
+	job_id = f"import_journal_entries_{frappe.generate_hash(length=12)}"
+	frappe.enqueue(
+		"integracion.integracion.import_journal_entries.ejecutar_importacion",
+		queue="long",
+		timeout=3600,
+		job_id=job_id,
+		enqueue_after_commit=True,
+		excel_file=excel_file,
+		company=company,
+		progreso_id=job_id
+	)
+	return {"job_id": job_id}
+
+def ejecutar_importacion(excel_file, company: str, progreso_id=None):
+	"""
+	Trabajo en segundo plano: limpia y crea los asientos del Excel y publica el
+	resultado (y el Excel de errores, si los hay) al terminar.
+	"""
+	# Progreso de esta importación, publicado por intervalos
+	progreso = ReporteProgreso(
+		"import_journal_entries_progreso", total=100, mensaje="Limpiando datos...", job_id=progreso_id,
+		extra={"success": False}
+	)
+	try:
+		return importar_diario(excel_file, company, progreso)
+	except Exception as e:
+		frappe.db.rollback()
+		logger.error(f"Error al importar el diario de asientos: {e}")
+		progreso.finalizar({"success": False, "error": str(e)})
+		raise
+
+def importar_diario(excel_file, company: str, progreso: ReporteProgreso):
 	company_abbr = frappe.db.get_value("Company", company, "abbr")
 
-	# Cargar archivo subido
-	file_doc = frappe.get_doc("File", {"file_url": excel_file})
-	wb = load_workbook(file_doc.get_full_path(), data_only=True)
-
-	# Datos limpios
-	data = []
+	# Cuentas y terceros de la compañía, cargados una sola vez para toda la importación
+	indice = IndiceContable(company)
 
 	# Datos errados
-	errors_header = []
 	errors_rows = []
 
-	# Transferir cabecera del archivo original al Excel de errores de importación (Es siempre hasta la fila 7)
-	for row in list(wb.active.iter_rows())[:7]:
-		errors_header.append([c.value for c in row])
-
-	# Limpieza de datos y recolección de errores
-	for ws in wb.worksheets:
+	# Líneas de los asientos que llegan a crearse
+	lineas_creadas = 0
 
-		# Todas las filas después de la cabecera (Donde empiezan los datos)
-		ws_rows = list(ws.iter_rows())[7:]
+	# Cargar archivo subido en modo lectura: las hojas se recorren fila a fila sin cargarlas en memoria
+	file_doc = frappe.get_doc("File", {"file_url": excel_file})
+	wb = load_workbook(file_doc.get_full_path(), read_only=True, data_only=True)
+
+	def asientos():
+		"""
+		Asientos válidos de todas las hojas, emitidos según se limpian. Los
+		asientos con errores van a las filas erróneas.
+		"""
+		nonlocal lineas_creadas
+
+		for lineas, errores in validate_workbook(wb, file_doc.get_full_path(), indice, company, progreso):
+			if errores:
+				errors_rows.append(lineas)
+			# Los asientos con cabecera y sin líneas no se guardan
+			elif len(lineas) > 1:
+				lineas_creadas += len(lineas)
+				yield {"doc": build_journal_entry(lineas, company, company_abbr), "lineas": lineas}
+
+	def registrar_error(asiento, error):
+		nonlocal lineas_creadas
+		# El asiento fallido vuelve al Excel de errores con el motivo en su cabecera
+		asiento["lineas"][0].append(f"Error al crear el asiento | {error}")
+		errors_rows.append(asiento["lineas"])
+		lineas_creadas -= len(asiento["lineas"])
+
+	try:
+		# Transferir cabecera del archivo original al Excel de errores de importación (Es siempre hasta la fila 7)
+		errors_header = [list(row) for row in wb.active.iter_rows(max_row=7, values_only=True)]
+
+		# Limpiar y subir los asientos a Frappe por lotes a medida que se leen
+		# Los números de asiento asignados dentro de un savepoint deshecho ya no son válidos
+		resumen = insert_journal_entries(asientos(), on_error=registrar_error, on_rollback=limpiar_numeros_transaccion)
+	finally:
+		wb.close()
 
-		# Filtrar todas las filas con numero de apunte
-		ws_rows = list(filter(lambda r: r[2].value != None, ws_rows))
+	# Si encontró errores retornar el excel de errores
+	res = {
+		"errores": len(errors_rows),
+		"asientos": lineas_creadas,
+		"asientos_por_segundo": resumen["asientos_por_segundo"],
+		"success": True,
+		"error_file": None
+	}
 
-		# ACTUALIZAR PROGRESO
-		## Cambiar estado
-		estado = f"Limpiando datos hoja {ws.title}"
-		frappe.cache().hset('import_journal_entries_progreso', 'total_asientos', len(ws_rows))
-		frappe.cache().hset('import_journal_entries_progreso', 'progreso', 1)
+	if errors_rows:
+		progreso.publicar({"progress": [2, 4], "message": "Generando Excel de errores", "success": False})
 
-		## Sumar cantidad de filas de la hoja al total de asientos
-		total_asientos = frappe.cache().hget('import_journal_entries_progreso', 'total_asientos')
+		errores_excel = gen_errors_excel(errors_header, errors_rows)
 
-		date = None
-		next_journal_entry = False
-		numero_asiento = None
-		journal_entry = {"lines": [], "errors": False}
+		res["error_file"] = errores_excel
 
-		total_debit = 0
-		total_credit = 0
+	# Borrar el progreso cuando termine el proceso y publicar el resultado
+	progreso.finalizar(res)
 
-		logger.info(f"HOJA: {ws}")
-		logger.info("*"*70)
+	return res["error_file"]
 
-		# Recorrer cada fila de la hoja
-		for row in ws_rows:
-			cells = [cell.value for cell in row[:9]]
+def validate_workbook(wb, file_path: str, indice: IndiceContable, company: str, progreso: ReporteProgreso):
+	"""
+	Emite los asientos de todas las hojas como (líneas, tiene_errores) en el
+	orden del libro. Con varias hojas, cada una se valida en un proceso del
+	pool mientras el proceso principal va creando los asientos de las hojas ya
+	validadas; con una sola hoja se valida en streaming en este proceso.
+	Solo se usa desde el trabajo de la cola long (`ejecutar_importacion`).
+	"""
+	hojas = wb.sheetnames
+
+	if len(hojas) < 2 or MAX_PROCESOS_VALIDACION < 2:
+		for ws in wb.worksheets:
+			yield from clean_sheet(ws, indice, company, progreso)
+		return
+
+	progreso.set_total(len(hojas), mensaje=f"Validando {len(hojas)} hojas en paralelo")
+
+	# Procesos nuevos (spawn): este proceso tiene conexiones abiertas a la base de
+	# datos y a Redis e hilos en marcha, que no se pueden duplicar con fork. El
+	# índice se envía serializado una vez por proceso en el inicializador.
+	executor = ProcessPoolExecutor(
+		max_workers=min(MAX_PROCESOS_VALIDACION, len(hojas)),
+		mp_context=multiprocessing.get_context("spawn"),
+		initializer=init_validation_process,
+		initargs=(frappe.local.site, frappe.local.sites_path, indice, company)
+	)
+	futuros = [executor.submit(validate_sheet, file_path, hoja) for hoja in hojas]
+	try:
+		# Las hojas se leen en su orden, así los errores mantienen el orden original;
+		# cada hoja se lee asiento a asiento desde el archivo que escribió su proceso
+		for hoja, futuro in zip(hojas, futuros):
+			ruta = futuro.result()
+			progreso.avanzar(mensaje=f"Hoja {hoja} validada")
+			yield from read_validated_sheet(ruta)
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+		# Borrar los archivos de las hojas que no se llegaron a leer
+		for futuro in futuros:
+			if futuro.done() and not futuro.cancelled() and futuro.exception() is None:
+				ruta = futuro.result()
+				if os.path.exists(ruta):
+					os.remove(ruta)
+
+def iter_sheet_rows(ws):
+	"""
+	Recorre las filas de datos de la hoja (después de la cabecera de 7 filas)
+	que tienen número de apunte. Devuelve cada fila con Party Type y Party como
+	celdas extra y si es la última de la hoja.
+	"""
+	anterior = None
+	for row in ws.iter_rows(min_row=8, max_col=9, values_only=True):
+		# Filtrar todas las filas con numero de apunte
+		if len(row) < 3 or row[2] == None:
+			continue
 
-			# Agregar Party type y Party como celdas extra, por defecto None
-			cells.extend([None, None])
+		cells = list(row) + [None] * (9 - len(row))
 
-			# Mapeo de celdas
-			numero_asiento = cells[1]
-			numero_apunte = cells[2]
-			cuenta = cells[5]
-			debit = cells[7]
-			credit = cells[8]
+		# Agregar Party type y Party como celdas extra, por defecto None
+		cells.extend([None, None])
 
-			logger.info(f"Asiento: {numero_asiento} Apunte: {numero_apunte}")
+		if anterior is not None:
+			yield anterior, False
+		anterior = cells
 
-			# Si la fila es cabecera y es momento de cambiar de cabecera
-			if numero_asiento and next_journal_entry:
+	if anterior is not None:
+		yield anterior, True
 
-				# Verificar si el debe y haber del asiento coinciden
-				if round(total_credit, 2) != round(total_debit, 2):
-					journal_entry["lines"][0].append("Total debe y total haber no coinciden.")
-					journal_entry["errors"] = True
+def clean_sheet(ws, indice: IndiceContable, company: str, progreso: ReporteProgreso = None):
+	"""
+	Limpia las filas de una hoja y emite cada asiento cerrado como
+	(líneas, tiene_errores). Solo se mantiene en memoria el asiento en curso.
+	Sin `progreso` (en los procesos de validación) no se informa del avance.
+	"""
+	# ACTUALIZAR PROGRESO
+	## Cambiar estado y total de filas de la hoja
+	if progreso:
+		progreso.set_total(max((ws.max_row or 0) - 7, 0), actual=1, mensaje=f"Limpiando datos hoja {ws.title}")
 
-				# Si el asiento tienes errores, agregar a las filas erróneas
-				if journal_entry["errors"]:
-					errors_rows.append(journal_entry["lines"])
-				else:
-					# Si no, agregar a los datos limpios
-					data.extend(journal_entry["lines"])
+	date = None
+	next_journal_entry = False
+	numero_asiento = None
+	journal_entry = {"lines": [], "errors": False}
 
-				# Reiniciar estado de error y de la cabecera del asiento
-				journal_entry["errors"] = False
-				next_journal_entry = False
+	total_debit = 0
+	total_credit = 0
 
-			# Verificar si la celda tiene un formato de fecha válido
-			if cells[0] != None:
-				# Si es datetime, cambiar el valor de la fecha
-				if type(cells[0]) == datetime:
-					date = cells[0]
-				else:
-					# Si no, intentar convertirla
-					try:
-						cells[0] = datetime.strptime(cells[0], "%d-%b.-%y")
-						date = cells[0]
-					except Exception as e:					
-						# Agregar error al asiento
-						cells.append(f"Error al formatear fecha | {e}")
-						journal_entry["lines"].append(cells)
-						journal_entry["errors"] = True
+	logger.info(f"HOJA: {ws.title}")
+	logger.info("*"*70)
 
-			# Buscar DocType de la cuenta con el número de cuenta del excel original
-			account_doc = frappe.db.get_value("Account", {"account_number": cuenta, "company": company}, "name")
+	# Recorrer cada fila de la hoja
+	for cells, es_ultima in iter_sheet_rows(ws):
 
-			# Si lo encuentra, cambiar el valor de la celda de cuenta
-			if account_doc:
-				cells[5] = account_doc
-			else:
-				# Si no, buscar cuenta por el nombre de la cuenta
-				account_doc = frappe.db.get_value("Account", cuenta, "name")
-
-				# Si lo encuentra, cambiar el valor de la celda de cuenta
-				if account_doc:
-					cells[5] = account_doc
-				else:
-					# Si no, agregar error al asiento
-					cells.append(
-						f"""Cuenta "{cuenta}" no existe en compañía "{company}". Verificar el plan contable."""
-					)
-					journal_entry["errors"] = True
-
-			# Buscar Party Type y Party de la cuenta
-			if account_doc:
-				logger.info(f"Buscando Party Type y Party para {account_doc}...")
+		# Mapeo de celdas
+		numero_asiento = cells[1]
+		numero_apunte = cells[2]
+		debit = cells[7]
+		credit = cells[8]
 
-				account_name, cuenta_numero, padre, account_type = frappe.db.get_value(
-					"Account", account_doc, ["account_name", "account_number", "parent_account", "account_type"]
-				)
-				padre_numero = None
+		logger.info(f"Asiento: {numero_asiento} Apunte: {numero_apunte}")
 
-				logger.info(f"TIPO DE CUENTA {account_type}")
+		# Si la fila es cabecera y es momento de cambiar de cabecera
+		if numero_asiento and next_journal_entry:
 
-				if padre:
-					padre_numero = frappe.db.get_value("Account", padre, "account_number")
-					logger.info(f"Cuenta padre {padre}")
+			# Verificar si el debe y haber del asiento coinciden
+			if round(total_credit, 2) != round(total_debit, 2):
+				journal_entry["lines"][0].append("Total debe y total haber no coinciden.")
+				journal_entry["errors"] = True
 
-				if cuenta_numero == "40000000" or cuenta_numero == "40700200" or cuenta_numero == "40701000":
-					logger.info("""Buscando proveedor "movimientos importados"...""")
+			# Emitir el asiento: con errores va a las filas erróneas, si no a los datos limpios
+			yield journal_entry["lines"], journal_entry["errors"]
 
-					party_type = "Supplier"
+			# Reiniciar estado de error y de la cabecera del asiento
+			journal_entry["errors"] = False
+			next_journal_entry = False
 
-					supplier = frappe.db.get_value(party_type, {"name": "Movimientos Importados"})
+		# Verificar si la celda tiene un formato de fecha válido
+		if cells[0] != None:
+			# Si es datetime, cambiar el valor de la fecha
+			if type(cells[0]) == datetime:
+				date = cells[0]
+			else:
+				# Si no, intentar convertirla
+				try:
+					cells[0] = datetime.strptime(cells[0], "%d-%b.-%y")
+					date = cells[0]
+				except Exception as e:
+					# Agregar error al asiento
+					cells.append(f"Error al formatear fecha | {e}")
+					journal_entry["lines"].append(cells)
+					journal_entry["errors"] = True
 
-					if supplier:
-						cells[9] = party_type
-						cells[10] = supplier
-					else:
-						cells.append(
-							f"""No se ha encontrado el proveedor "Movimientos Importados" en compañía {company}."""
-						)
-						journal_entry["errors"] = True
+		# Resolver cuenta, Party Type y Party de la fila
+		if resolve_row_accounts(cells, indice, company):
+			journal_entry["errors"] = True
 
-				if cuenta_numero == "46500000" or cuenta_numero == "46500010" or cuenta_numero == "465000000":
-					logger.info("""Buscando empleado "movimientos importados"...""")
+		if date:
 
-					employee = frappe.db.get_value(
-						"Employee", {"employee_name": ("like", "%Movimientos Importados%")}
-					)
+			# Verificar si es cabecera
+			if numero_asiento:
 
-					if employee:
-						cells[9] = "Employee"
-						cells[10] = employee
-					else:
-						cells.append(
-							f"""No se ha encontrado el empleado "Movimientos Importados" en compañía {company}."""
-						)
-						journal_entry["errors"] = True
+				# Reiniciar valores de total crédito y total débito
+				total_credit = credit
+				total_debit = debit
 
-				if padre_numero == "4100" or padre_numero == "410" or padre_numero == "4000":
-					party_type = "Supplier"
+				journal_entry["lines"] = [cells]
+			else:
 
-					if cuenta_numero == "41000000" or cuenta_numero == "410000000":
-						supplier = frappe.db.get_value(party_type, {"name": "Movimientos Importados"})
+				# Si no, es línea
+				next_journal_entry = True
 
-						if supplier:
-							cells[9] = party_type
-							cells[10] = supplier
-						else:
-							cells.append(
-								f"""No se ha encontrado el proveedor "Movimientos Importados" en compañía {company}."""
-							)
-							journal_entry["errors"] = True
+				# Suma total de crédito y débito
+				total_credit += credit
+				total_debit += debit
 
-					else:
-						supplier_name = account_name
+				# Agregar celdas a las líneas de asientos
+				journal_entry["lines"].append(cells)
 
-						if account_name.find(" - ") != -1:
-							supplier_name = account_name.split(" - ")[1]
-							supplier_name = account_name.rstrip()
+				# Si la fila está ubicada al final de la hoja, verificar si las líneas no tienen errores
+				if es_ultima:
+					if round(total_credit, 2) != round(total_debit, 2):
+						journal_entry["lines"][0].append("Total debe y total haber no coinciden.")
+						journal_entry["errors"] = True
 
-						supplier = frappe.db.get_value(
-							party_type, {"name": ("like", f"%{supplier_name}%")}
-						)
+					yield journal_entry["lines"], journal_entry["errors"]
 
-						if not supplier:
-							supplier = frappe.db.get_value("Party Account", {"account": account_name}, "parent")
+					journal_entry["errors"] = False
 
-							if not supplier:
-								supplier = frappe.db.get_value(party_type, {"name": "Movimientos Importados"})
+		else:
 
-						if supplier:
-							cells[9] = party_type
-							cells[10] = supplier
+			# Si no tiene campo de fecha, agregar error al asiento
+			if numero_asiento:
+				cells.append("Fecha no especificada.")
+				journal_entry["errors"] = True
+
+		logger.info(f"""Tiene errores {journal_entry["errors"]}""")
+		logger.info("_"*70)
+
+		# Actualizar progreso (se publica por intervalos)
+		if progreso:
+			progreso.avanzar()
+
+def resolve_row_accounts(cells: list, indice: IndiceContable, company: str) -> bool:
+	"""
+	Sustituye la cuenta de la fila por la de la compañía y completa Party Type
+	y Party (celdas 9 y 10) usando solo el índice en memoria. Los errores se
+	añaden al final de la fila; devuelve True si la fila tiene alguno.
+	"""
+	cuenta = cells[5]
+	errores = False
+
+	# Buscar la cuenta por el número de cuenta del excel original o, si no, por su nombre
+	account_doc = indice.get_account(cuenta)
+
+	# Si lo encuentra, cambiar el valor de la celda de cuenta
+	if account_doc:
+		cells[5] = account_doc
+	else:
+		# Si no, agregar error al asiento
+		cells.append(
+			f"""Cuenta "{cuenta}" no existe en compañía "{company}". Verificar el plan contable."""
+		)
+		errores = True
 
-				if padre_numero == "4300" or padre_numero == "430" or padre_numero == "440":
-					logger.info(f"""Buscando cliente para cuenta "{account_name}"...""")
-					party_type = "Customer"
+	# Buscar Party Type y Party de la cuenta
+	if account_doc:
+		logger.info(f"Buscando Party Type y Party para {account_doc}...")
 
-					customer_name = account_name
+		account_name, cuenta_numero, padre, account_type, padre_numero = indice.get_account_details(account_doc)
 
-					if customer_name.find(" - ") != -1:
-						logger.info("Limpiando guiones")
-						customer_name = customer_name.split(" - ")[1]
-						customer_name = customer_name.rstrip()
-						logger.info(f"Resultado: {customer_name}")
+		logger.info(f"TIPO DE CUENTA {account_type}")
 
-					customer = frappe.db.get_value(
-						party_type, {"customer_name": ("like", f"%{customer_name}%")}
-					)
+		if padre:
+			logger.info(f"Cuenta padre {padre}")
 
-					if not customer:
-						customer = frappe.db.get_value("Party Account", {"account": account_name}, "parent")
+		if cuenta_numero == "40000000" or cuenta_numero == "40700200" or cuenta_numero == "40701000":
+			logger.info("""Buscando proveedor "movimientos importados"...""")
 
-						if not customer:
-							customer = frappe.db.get_value(party_type, {"name": "Movimientos Importados"})
+			party_type = "Supplier"
 
-					if customer:
-						cells[9] = party_type
-						cells[10] = customer
+			supplier = indice.proveedor_importados
 
-				if account_type in ("Payable", "Receivable") and (not cells[9] and not cells[10]):
-					party_type = None
-					party = None
+			if supplier:
+				cells[9] = party_type
+				cells[10] = supplier
+			else:
+				cells.append(
+					f"""No se ha encontrado el proveedor "Movimientos Importados" en compañía {company}."""
+				)
+				errores = True
 
-					party_account = frappe.db.get_value(
-						"Party Account", {"account": account_name}, ["parenttype", "parent"]
-					)
+		if cuenta_numero == "46500000" or cuenta_numero == "46500010" or cuenta_numero == "465000000":
+			logger.info("""Buscando empleado "movimientos importados"...""")
 
-					if party_account:
-						party_type = party_account[0]
-						party = party_account[1]
-
-					else:
-						if account_type == "Receivable":
-							party_type = "Customer"
-							customer_name = account_doc
-
-							if customer_name.find(" - ") != -1:
-								logger.info("Limpiando guiones")
-								customer_name = customer_name.split(" - ")[1]
-								customer_name = customer_name.rstrip()
-								logger.info(f"Resultado: {customer_name}")
-
-							party = frappe.db.get_value(party_type, {"customer_name": ("like", f"%{customer_name}%")})
-
-						elif account_type == "Payable":
-							party_type = "Supplier"
-							supplier_name = account_doc
-
-							if supplier_name.find(" - ") != -1:
-								logger.info("Limpiando guiones")
-								supplier_name = supplier_name.split(" - ")[1]
-								supplier_name = supplier_name.rstrip()
-								logger.info(f"Resultado: {supplier_name}")
-
-							party = frappe.db.get_value(
-								party_type, {"supplier_name": ("like", f"%{supplier_name}%")}
-							)
-
-					if party_type and party:
-						cells[9] = party_type
-						cells[10] = party
-					else:
-						cells.append(
-							f"""No se ha encontrado un proveedor/cliente para la cuenta "{account_doc}"."""
-						)
+			employee = indice.empleado_importados
 
-						journal_entry["errors"] = True
-			if date:
+			if employee:
+				cells[9] = "Employee"
+				cells[10] = employee
+			else:
+				cells.append(
+					f"""No se ha encontrado el empleado "Movimientos Importados" en compañía {company}."""
+				)
+				errores = True
 
-				# Verificar si es cabecera
-				if numero_asiento:
+		if padre_numero == "4100" or padre_numero == "410" or padre_numero == "4000":
+			party_type = "Supplier"
 
-					# Reiniciar valores de total crédito y total débito
-					total_credit = credit
-					total_debit = debit
+			if cuenta_numero == "41000000" or cuenta_numero == "410000000":
+				supplier = indice.proveedor_importados
 
-					journal_entry["lines"] = [cells]
+				if supplier:
+					cells[9] = party_type
+					cells[10] = supplier
 				else:
+					cells.append(
+						f"""No se ha encontrado el proveedor "Movimientos Importados" en compañía {company}."""
+					)
+					errores = True
 
-					# Si no, es línea
-					next_journal_entry = True
-
-					# Suma total de crédito y débito
-					total_credit += credit
-					total_debit += debit
-
-					# Agregar celdas a las líneas de asientos
-					journal_entry["lines"].append(cells)
+			else:
+				supplier_name = account_name
 
-					# Si la fila está ubicada al final de la hoja, verificar si las líneas no tienen errores
-					if row == ws_rows[-1]:
-						if round(total_credit, 2) != round(total_debit, 2):
-							journal_entry["lines"][0].append("Total debe y total haber no coinciden.")
-							journal_entry["errors"] = True
+				if account_name.find(" - ") != -1:
+					supplier_name = account_name.split(" - ")[1]
+					supplier_name = account_name.rstrip()
 
-						if journal_entry["errors"]:
-							errors_rows.append(journal_entry["lines"])
-						else:
-							data.extend(journal_entry["lines"])
+				supplier = indice.find_party(party_type, "name", supplier_name)
 
-						journal_entry["errors"] = False
+				if not supplier:
+					party_account = indice.get_party_account(account_name)
+					supplier = party_account[1] if party_account else None
 
-			else:
+					if not supplier:
+						supplier = indice.proveedor_importados
 
-				# Si no tiene campo de fecha, agregar error al asiento
-				if numero_asiento:
-					cells.append("Fecha no especificada.")
-					journal_entry["errors"] = True 
+				if supplier:
+					cells[9] = party_type
+					cells[10] = supplier
 
-			logger.info(f"""Tiene errores {journal_entry["errors"]}""")
-			logger.info("_"*70)
+		if padre_numero == "4300" or padre_numero == "430" or padre_numero == "440":
+			logger.info(f"""Buscando cliente para cuenta "{account_name}"...""")
+			party_type = "Customer"
 
-			# Actualizar progreso
-			progreso = frappe.cache().hget('import_journal_entries_progreso', 'progreso')
-			progreso += 1
-			frappe.cache().hset('import_journal_entries_progreso', 'progreso', progreso)
+			customer_name = account_name
 
-			frappe.publish_realtime(
-				"import_journal_entries_progreso", {
-					"progress": [progreso, total_asientos], "message": estado, "success": False
-				},
-				user=frappe.session.user
-			)
+			if customer_name.find(" - ") != -1:
+				logger.info("Limpiando guiones")
+				customer_name = customer_name.split(" - ")[1]
+				customer_name = customer_name.rstrip()
+				logger.info(f"Resultado: {customer_name}")
 
-	# Booleano para verificar si está listo el asiento para guardarlo en Frappe
-	commit_journal_entry = False
+			customer = indice.find_party(party_type, "customer_name", customer_name)
 
-	# Variable para almacenar cabecera y líneas del asiento a guardar en Frappe
-	journal_entry = None
+			if not customer:
+				party_account = indice.get_party_account(account_name)
+				customer = party_account[1] if party_account else None
 
-	# Recorrer datos limpios para subirlos a asientos aontables en Frappe
+				if not customer:
+					customer = indice.cliente_importados
 
-	progreso = 0
-	total_asientos = len(data)
+			if customer:
+				cells[9] = party_type
+				cells[10] = customer
 
-	for cells in data:
-		progreso += 1
+		if account_type in ("Payable", "Receivable") and (not cells[9] and not cells[10]):
+			party_type = None
+			party = None
 
-		logger.info(f"Creando... {cells}")
+			party_account = indice.get_party_account(account_name)
 
-		frappe.publish_realtime(
-			"import_journal_entries_progreso", {
-				"progress": [progreso, total_asientos], 
-				"message": f"Creando línea de asiento {progreso} de {total_asientos}",
-				"success": False
-			},
-			user=frappe.session.user
-		)
+			if party_account:
+				party_type = party_account[0]
+				party = party_account[1]
 
-		# Mapeo campos de fila
-		date = cells[0]
-		numero_asiento = cells[1]
-		concepto = cells[3]
-		documento = cells[4]
-		cuenta = cells[5]
-		debit = cells[7]
-		credit = cells[8]
-		party_type = cells[9]
-		party = cells[10]
-
-		# Verificar si es apertura
-		apertura = False
-
-		if documento and documento.lower() == "apertura":
-			apertura = True
-
-		# Si tiene número asiento es cabecera
-		if numero_asiento != None:
-
-			# Chequear si tiene que guardar Journal Entry anterior
-			if commit_journal_entry:
-				journal_entry.insert(ignore_permissions=True)
-				frappe.db.commit()
-				commit_journal_entry = False
-
-			# Crear cabecera de asiento con primera línea
-			journal_entry = frappe.get_doc({
-				"doctype": "Journal Entry",
-
-				# Cambiar a Opening Entry si es apertura
-				"voucher_type": "Opening Entry" if apertura else "Journal Entry",
-				"title": f"""Apertura {numero_asiento} - {date.strftime("%d/%m/%Y")} {concepto} - {company_abbr}"""[:139] if apertura else f"""Asiento {numero_asiento} - {date.strftime("%d/%m/%Y")} {concepto} - {company_abbr}"""[:139],
-				"company": company,
-				"number": numero_asiento,
-				"posting_date": date,
-				"is_opening": apertura,
-				"accounts": [{
-					"account": cuenta,
-					"party_type": party_type,
-					"party": party,
-					"debit_in_account_currency": debit,
-					"credit_in_account_currency": credit,
-				}]
-			})
-
-		else:
-			# Agregar línea a cabecera anteriormente creada
-			journal_entry.append("accounts", {
-				"account": cuenta,
-				"party_type": party_type,
-				"party": party,
-				"debit_in_account_currency": debit,
-				"credit_in_account_currency": credit,
-			})
-
-			# Si la línea se encuentra al final de la hoja, guardar asiento actual a asientos contables de Frappe
-			if cells == data[-1]:
-				journal_entry.insert(ignore_permissions=True)
-				frappe.db.commit()
 			else:
-				commit_journal_entry = True
+				if account_type == "Receivable":
+					party_type = "Customer"
+					customer_name = account_doc
 
-	# Borrar cache cuando termine el proceso
-	frappe.cache().hdel('import_journal_entries_progreso', 'progreso')
-	frappe.cache().hdel('import_journal_entries_progreso', 'total_asientos')
-	frappe.cache().hdel('import_journal_entries_progreso', 'estado')
+					if customer_name.find(" - ") != -1:
+						logger.info("Limpiando guiones")
+						customer_name = customer_name.split(" - ")[1]
+						customer_name = customer_name.rstrip()
+						logger.info(f"Resultado: {customer_name}")
 
-	# Si encontró errores retornar el excel de errores
-	res = {"errores": len(errors_rows), "asientos": len(data), "success": True, "error_file": None}
+					party = indice.find_party(party_type, "customer_name", customer_name)
 
-	if errors_rows:
-		frappe.publish_realtime(
-			"import_journal_entries_progreso", {
-				"progress": [2, 4], "message": "Generando Excel de errores", "success": False
-			},
-			user=frappe.session.user
-		)
+				elif account_type == "Payable":
+					party_type = "Supplier"
+					supplier_name = account_doc
 
-		errores_excel = gen_errors_excel(errors_header, errors_rows)
+					if supplier_name.find(" - ") != -1:
+						logger.info("Limpiando guiones")
+						supplier_name = supplier_name.split(" - ")[1]
+						supplier_name = supplier_name.rstrip()
+						logger.info(f"Resultado: {supplier_name}")
 
-		res["error_file"] = errores_excel
+					party = indice.find_party(party_type, "supplier_name", supplier_name)
 
-	frappe.publish_realtime(
-		"import_journal_entries_progreso",
-		res,
-		user=frappe.session.user
-	)
+			if party_type and party:
+				cells[9] = party_type
+				cells[10] = party
+			else:
+				cells.append(
+					f"""No se ha encontrado un proveedor/cliente para la cuenta "{account_doc}"."""
+				)
 
-	return res["error_file"]
+				errores = True
+
+	return errores
+
+def build_journal_entry(lineas: list, company: str, company_abbr: str) -> dict:
+	"""
+	Construye el diccionario del Journal Entry de un asiento a partir de sus filas.
+	"""
+	# Mapeo campos de la cabecera
+	date = lineas[0][0]
+	numero_asiento = lineas[0][1]
+	concepto = lineas[0][3]
+	documento = lineas[0][4]
+
+	# Verificar si es apertura
+	apertura = bool(documento and documento.lower() == "apertura")
+
+	return {
+		"doctype": "Journal Entry",
+
+		# Cambiar a Opening Entry si es apertura
+		"voucher_type": "Opening Entry" if apertura else "Journal Entry",
+		"title": f"""Apertura {numero_asiento} - {date.strftime("%d/%m/%Y")} {concepto} - {company_abbr}"""[:139] if apertura else f"""Asiento {numero_asiento} - {date.strftime("%d/%m/%Y")} {concepto} - {company_abbr}"""[:139],
+		"company": company,
+		"number": numero_asiento,
+		"posting_date": date,
+		"is_opening": apertura,
+		"accounts": [{
+			"account": cells[5],
+			"party_type": cells[9],
+			"party": cells[10],
+			"debit_in_account_currency": cells[7],
+			"credit_in_account_currency": cells[8],
+		} for cells in lineas]
+	}
 
 def gen_errors_excel(header: list, data: list) -> str:
 	# Crear un archivo Excel
@@ -0,0 +1,137 @@
+import re
+import unicodedata
+import frappe
+
+# Cuentas que siempre se asignan al proveedor/empleado "Movimientos Importados"
+MOVIMIENTOS_IMPORTADOS = "Movimientos Importados"
+
+
+def normalize_party_name(nombre):
+    """
+    Normaliza un nombre para compararlo como lo haría un LIKE de MariaDB:
+    sin distinguir mayúsculas ni acentos y con los espacios colapsados.
+    """
+    nombre = unicodedata.normalize("NFKD", str(nombre or ""))
+    nombre = "".join(c for c in nombre if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", nombre).strip().lower()
+
+
+def tokenize(nombre):
+    return set(re.findall(r"\w+", nombre))
+
+
+class IndiceTerceros:
+    """
+    Índice de nombres de un campo de Supplier/Customer para sustituir las
+    búsquedas `LIKE '%nombre%'`. Los candidatos se obtienen intersecando las
+    palabras completas del texto buscado y se confirman con la subcadena.
+    """
+
+    def __init__(self, registros):
+        # registros: lista de (name, valor del campo) en el orden de la consulta
+        self.nombres = []
+        self.por_token = {}
+        self.resueltos = {}
+
+        for posicion, (name, valor) in enumerate(registros):
+            normalizado = normalize_party_name(valor)
+            self.nombres.append((name, normalizado))
+            for token in tokenize(normalizado):
+                self.por_token.setdefault(token, []).append(posicion)
+
+    def buscar(self, texto):
+        texto = normalize_party_name(texto)
+        if texto in self.resueltos:
+            return self.resueltos[texto]
+
+        resultado = None
+        if texto:
+            # Las palabras de los extremos pueden ser parciales en un LIKE, se buscan solo las interiores
+            tokens = re.findall(r"\w+", texto)[1:-1]
+            candidatos = None
+            for token in tokens:
+                posiciones = set(self.por_token.get(token, []))
+                candidatos = posiciones if candidatos is None else candidatos & posiciones
+
+            if candidatos is None:
+                posiciones = range(len(self.nombres))
+            else:
+                posiciones = sorted(candidatos)
+
+            resultado = next((self.nombres[p][0] for p in posiciones if texto in self.nombres[p][1]), None)
+
+        self.resueltos[texto] = resultado
+        return resultado
+
+
+class IndiceContable:
+    """
+    Índice en memoria con lo que la limpieza de un diario necesita de la base
+    de datos: cuentas de la empresa por número y por nombre (con padre y tipo),
+    terceros por nombre y el mapa de 'Party Account'. Se construye una vez por
+    importación y es de solo lectura.
+    """
+
+    def __init__(self, company):
+        self.company = company
+
+        cuentas = frappe.get_all(
+            "Account",
+            filters={"company": company},
+            fields=["name", "account_name", "account_number", "parent_account", "account_type"]
+        )
+        self.cuentas = {c.name: frappe._dict(c) for c in cuentas}
+        self.por_numero = {}
+        for cuenta in cuentas:
+            if cuenta.account_number:
+                self.por_numero.setdefault(str(cuenta.account_number).strip(), cuenta.name)
+
+        self.party_accounts = {}
+        for party_account in frappe.get_all("Party Account", fields=["account", "parenttype", "parent"]):
+            self.party_accounts.setdefault(party_account.account, (party_account.parenttype, party_account.parent))
+
+        self.proveedor_importados = frappe.db.get_value("Supplier", {"name": MOVIMIENTOS_IMPORTADOS})
+        self.cliente_importados = frappe.db.get_value("Customer", {"name": MOVIMIENTOS_IMPORTADOS})
+        self.empleado_importados = frappe.db.get_value(
+            "Employee", {"employee_name": ("like", f"%{MOVIMIENTOS_IMPORTADOS}%")}
+        )
+
+        proveedores = frappe.get_all("Supplier", fields=["name", "supplier_name"], order_by="creation desc")
+        clientes = frappe.get_all("Customer", fields=["name", "customer_name"], order_by="creation desc")
+        self.terceros = {
+            ("Supplier", "name"): IndiceTerceros([(p.name, p.name) for p in proveedores]),
+            ("Supplier", "supplier_name"): IndiceTerceros([(p.name, p.supplier_name) for p in proveedores]),
+            ("Customer", "customer_name"): IndiceTerceros([(c.name, c.customer_name) for c in clientes])
+        }
+
+    def get_account(self, cuenta):
+        """
+        Devuelve el nombre de la cuenta a partir de su número o, si no existe,
+        de su nombre en la empresa.
+        """
+        if cuenta is None:
+            return None
+        name = self.por_numero.get(str(cuenta).strip())
+        if name:
+            return name
+        return cuenta if cuenta in self.cuentas else None
+
+    def get_account_details(self, account):
+        """
+        Devuelve (account_name, account_number, parent_account, account_type, número del padre).
+        """
+        cuenta = self.cuentas[account]
+        padre = self.cuentas.get(cuenta.parent_account)
+        return (
+            cuenta.account_name,
+            cuenta.account_number,
+            cuenta.parent_account,
+            cuenta.account_type,
+            padre.account_number if padre else None
+        )
+
+    def get_party_account(self, account):
+        return self.party_accounts.get(account)
+
+    def find_party(self, party_type, fieldname, texto):
+        return self.terceros[(party_type, fieldname)].buscar(texto)
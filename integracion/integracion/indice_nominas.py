@@ -0,0 +1,80 @@
+import frappe
+
+
+class IndiceNominas:
+    """
+    Índice en memoria para resolver un XML de nóminas de una empresa:
+    empleados por NIF/NIE, cuentas por número (con su tipo) y, para cada cuenta
+    de grupo, sus subcuentas por empleado y su subcuenta de número más bajo.
+    Se construye una vez por archivo con tres consultas.
+    """
+
+    def __init__(self, company):
+        self.company = company
+
+        empleados = frappe.get_all(
+            "Employee",
+            fields=["name", "employee_name", "custom_dninie_id", "custom_dninie"],
+            order_by="creation asc"
+        )
+        self.nombres_empleado = {e.name: e.employee_name for e in empleados}
+        self.por_dninie_id = {}
+        self.por_dninie = {}
+        for empleado in empleados:
+            if empleado.custom_dninie_id:
+                self.por_dninie_id.setdefault(empleado.custom_dninie_id, empleado.name)
+            if empleado.custom_dninie:
+                self.por_dninie.setdefault(empleado.custom_dninie, empleado.name)
+
+        cuentas = frappe.get_all(
+            "Account",
+            filters={"company": company},
+            fields=["name", "account_number", "account_type", "parent_account", "is_group", "custom_empleado"],
+            order_by="creation asc"
+        )
+        self.por_numero = {}
+        self.grupos = {}
+        self.hijas = {}
+        for cuenta in cuentas:
+            if cuenta.account_number:
+                self.por_numero.setdefault(cuenta.account_number, cuenta)
+                if cuenta.is_group:
+                    self.grupos.setdefault(cuenta.account_number, cuenta)
+            if cuenta.parent_account:
+                self.hijas.setdefault(cuenta.parent_account, []).append(cuenta)
+
+        # Subcuentas ordenadas por número como en un ORDER BY account_number ASC (los nulos primero)
+        for hijas in self.hijas.values():
+            hijas.sort(key=lambda c: (c.account_number is not None, c.account_number or ""))
+
+    def get_employee(self, nif):
+        """
+        Devuelve el empleado del NIF buscando por 'custom_dninie_id', luego por
+        'custom_dninie' y por último por el nombre del documento.
+        """
+        return (
+            self.por_dninie_id.get(nif)
+            or self.por_dninie.get(nif)
+            or (nif if nif in self.nombres_empleado else None)
+        )
+
+    def get_employee_name(self, nif):
+        empleado = self.por_dninie_id.get(nif) or self.por_dninie.get(nif)
+        return self.nombres_empleado.get(empleado, "")
+
+    def get_group_account(self, account_number):
+        return self.grupos.get(account_number)
+
+    def get_employee_account(self, parent_account, nif):
+        return next((c for c in self.hijas.get(parent_account.name, []) if c.custom_empleado == nif), None)
+
+    def get_lowest_child_account(self, parent_account):
+        hijas = self.hijas.get(parent_account.name)
+        return hijas[0] if hijas else None
+
+    def get_account(self, account_number):
+        """
+        Devuelve (name, account_type) de la cuenta con ese número o None.
+        """
+        cuenta = self.por_numero.get(account_number)
+        return (cuenta.name, cuenta.account_type) if cuenta else None
@@ -6,6 +6,7 @@ from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
 from dataclasses import dataclass
 import frappe
+from integracion.integracion.conexion_sp import get_sharepoint_context
 import re
 import requests
 
@@ -25,42 +26,13 @@ id_cliente = site_config.get('id_sp_client')
 secret_sp = site_config.get('secret_sp')
 tenant_id = site_config.get('tenant_sp')
 auth_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-# Función para obtener el token de acceso
-
-@dataclass
-class Token:
-    tokenType: str
-    accessToken: str
-
-# Función para obtener el token de acceso
-def obtener_token_de_acceso():
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': id_cliente,
-        'client_secret': secret_sp,
-        'scope': 'https://graph.microsoft.com/.default'
-    }
-
-    response = requests.post(auth_url, data=data)
-    if response.status_code == 200:
-        token_info = response.json()
-        access_token = Token(tokenType="Bearer", accessToken=token_info['access_token'])
-        logger.info("Autenticación exitosa. Token obtenido.")
-        return access_token
-    else:
-        logger.error(f"Error de autenticación: {response.json()}")
-        return None: {response.json()}")
-        return None
 
-# Modificar la conexión a SharePoint para usar el token
+# Modificar la conexión a SharePoint para usar el contexto compartido del proceso
 def connect_to_sharepoint_with_token(site_url):
-    access_token = obtener_token_de_acceso()
-    if access_token:
-        ctx = ClientContext(site_url).with_access_token(access_token)
-        return ctx
-    else:
-        logger.error("No se pudo obtener el token de acceso.")
-        return None
+    ctx = get_sharepoint_context(site_url)
+    if not ctx:
+        logger.error("No se pudo obtener el contexto de SharePoint.")
+    return ctx
 
 
 # Obtener la URL base y la ruta relativa desde 'Bibliotecas SP' para 'Job Offer'
@@ -0,0 +1,118 @@
+import time
+import frappe
+
+site_config = frappe.get_site_config()
+
+# Segundos mínimos entre dos publicaciones de progreso
+INTERVALO_PROGRESO = float(site_config.get('intervalo_progreso') or 0.5)
+# Porcentaje de avance que fuerza una publicación aunque no haya pasado el intervalo
+PASO_PROGRESO = 5
+# Segundos que se conserva el progreso de un trabajo en la caché
+TTL_PROGRESO = 24 * 60 * 60
+
+
+def progress_key(evento, job_id):
+    return f"progreso|{evento}|{job_id}"
+
+
+def user_job_key(evento, user):
+    return f"progreso|{evento}|usuario|{user}"
+
+
+class ReporteProgreso:
+    """
+    Progreso de un trabajo largo. Los contadores se llevan en el proceso y solo
+    se escriben en la caché y se publican por realtime cada `intervalo`
+    segundos o cada `paso` por ciento de avance.
+
+    Cada trabajo guarda su progreso en su propia clave (por `job_id`), así que
+    dos importaciones a la vez no se pisan. La última de cada usuario queda
+    registrada para que el cliente pueda recuperarla al recargar.
+    """
+
+    def __init__(self, evento, total=0, mensaje=None, job_id=None, user=None, extra=None,
+                 intervalo=INTERVALO_PROGRESO, paso=PASO_PROGRESO):
+        self.evento = evento
+        self.job_id = job_id or frappe.generate_hash(length=12)
+        self.user = user or frappe.session.user
+        # Campos fijos que se añaden a cada publicación (p. ej. {"success": False})
+        self.extra = extra or {}
+        self.intervalo = intervalo
+        self.paso = paso
+
+        self.total = total
+        self.actual = 0
+        self.mensaje = mensaje
+        self.publicado_en = 0
+        self.porcentaje_publicado = None
+
+        frappe.cache().set_value(user_job_key(evento, self.user), self.job_id, expires_in_sec=TTL_PROGRESO)
+
+    def porcentaje(self):
+        return int(self.actual * 100 / self.total) if self.total else 0
+
+    def set_total(self, total, actual=0, mensaje=None):
+        self.total = total
+        self.actual = actual
+        if mensaje is not None:
+            self.mensaje = mensaje
+        self.flush(forzar=True)
+
+    def set_mensaje(self, mensaje):
+        self.mensaje = mensaje
+
+    def avanzar(self, cantidad=1, mensaje=None):
+        self.actual += cantidad
+        if mensaje is not None:
+            self.mensaje = mensaje
+        self.flush()
+
+    def flush(self, forzar=False):
+        ahora = time.monotonic()
+        porcentaje = self.porcentaje()
+        if not forzar and ahora - self.publicado_en < self.intervalo and (
+            self.porcentaje_publicado is not None and porcentaje - self.porcentaje_publicado < self.paso
+        ):
+            return
+
+        self.publicado_en = ahora
+        self.porcentaje_publicado = porcentaje
+
+        frappe.cache().set_value(progress_key(self.evento, self.job_id), {
+            "progreso": self.actual,
+            "total": self.total,
+            "estado": self.mensaje
+        }, expires_in_sec=TTL_PROGRESO)
+
+        frappe.publish_realtime(
+            self.evento,
+            {"progress": [self.actual, self.total], "message": self.mensaje, "job_id": self.job_id, **self.extra},
+            user=self.user
+        )
+
+    def publicar(self, datos):
+        """
+        Publica un mensaje fuera de la cuenta de progreso (resultado final, errores...).
+        """
+        frappe.publish_realtime(self.evento, {"job_id": self.job_id, **datos}, user=self.user)
+
+    def finalizar(self, datos=None):
+        """
+        Publica el estado final pendiente, borra el progreso de la caché y,
+        si se indican, publica los `datos` de cierre.
+        """
+        self.flush(forzar=True)
+        frappe.cache().delete_value(progress_key(self.evento, self.job_id))
+        if datos is not None:
+            self.publicar(datos)
+
+
+def get_job_progress(evento, job_id=None):
+    """
+    Devuelve el progreso guardado de `job_id` o, si no se indica, el del
+    último trabajo del usuario para ese evento.
+    """
+    job_id = job_id or frappe.cache().get_value(user_job_key(evento, frappe.session.user))
+    if not job_id:
+        return None
+    return frappe.cache().get_value(progress_key(evento, job_id))
@@ -1,5 +1,7 @@
 import frappe
 from frappe import _
+from frappe.utils import cint, getdate, now
+from integracion.integracion.progreso import ReporteProgreso
 
 # Para la asignación automática al crear GL Entry
 def before_insert(doc, method):
@@ -7,221 +9,342 @@ def before_insert(doc, method):
     Asignar número de asiento al crear un GL Entry de forma correlativa
     """
     try:
-        # Obtener el número existente si ya hay GL Entries para este voucher
-        existing_number = frappe.db.get_value("GL Entry", {
-            "voucher_type": doc.voucher_type,
-            "voucher_no": doc.voucher_no,
-            "company": doc.company
-        }, "custom_numero")
-
-        if existing_number:
-            doc.custom_numero = existing_number
-        else:
-            # Si no existe, obtener el último número usado para cualquier asiento de ese año
-            last_number = frappe.db.sql("""
-                SELECT MAX(custom_numero) 
-                FROM `tabGL Entry`
-                WHERE YEAR(posting_date) = YEAR(%s)
-                AND company = %s
-            """, (doc.posting_date, doc.company))[0][0] or 0
-            
-            # Asignar nuevo número
-            nuevo_numero = last_number + 1
-            doc.custom_numero = nuevo_numero
-            
-            # Si es un Journal Entry, actualizar también su número
-            if doc.voucher_type == "Journal Entry":
-                frappe.db.set_value("Journal Entry", doc.voucher_no, "number", nuevo_numero)
-
+        doc.custom_numero = asignar_numero_asiento(doc.company, doc.posting_date, doc.voucher_type, doc.voucher_no)
     except Exception as e:
         frappe.log_error(f"Error al asignar número de asiento: {str(e)}")
         raise
 
-# Para renumerar asientos existentes
-@frappe.whitelist()
-def renumerar_asientos_gl(company, year):
+
+def asignar_numero_asiento(company, posting_date, voucher_type, voucher_no):
     """
-    Renumera los GL Entries por Empresa y Año, ordenando por fecha contable (posting_date)
-    y en caso de empate por fecha de creación (creation).
+    Devuelve el número de asiento del voucher. Las líneas de un mismo voucher
+    comparten número: la primera lo obtiene (del GL existente o del contador) y
+    las siguientes lo leen de la memoria de la transacción sin consultar la base de datos.
+    """
+    numeros = get_numeros_transaccion()
+    clave = (voucher_type, voucher_no, company)
+    if clave in numeros:
+        return numeros[clave]
+
+    # Obtener el número existente si ya hay GL Entries para este voucher
+    numero = frappe.db.get_value("GL Entry", {
+        "voucher_type": voucher_type,
+        "voucher_no": voucher_no,
+        "company": company
+    }, "custom_numero")
+
+    if not numero:
+        numero = siguiente_numero(company, getdate(posting_date).year)
+
+        # Si es un Journal Entry, actualizar también su número
+        if voucher_type == "Journal Entry":
+            frappe.db.set_value("Journal Entry", voucher_no, "number", numero)
+
+    numeros[clave] = numero
+    return numero
+
+
+def get_numeros_transaccion():
+    """
+    Memoria voucher -> número de la transacción en curso. Se vacía al hacer
+    commit o rollback para no reutilizar números de una transacción deshecha.
+    """
+    if frappe.flags.numeros_asiento is None:
+        frappe.flags.numeros_asiento = {}
+        frappe.db.after_commit.add(limpiar_numeros_transaccion)
+        frappe.db.after_rollback.add(limpiar_numeros_transaccion)
+    return frappe.flags.numeros_asiento
+
+
+def limpiar_numeros_transaccion():
+    frappe.flags.numeros_asiento = None
+
+
+def clave_contador(company, year):
+    return f"{company}-{year}"
+
+
+def siguiente_numero(company, year):
+    """
+    Incrementa y devuelve el contador de asientos de la empresa y el año.
+    La fila del contador se bloquea con FOR UPDATE hasta el final de la
+    transacción, así dos envíos simultáneos nunca obtienen el mismo número.
+    """
+    clave = clave_contador(company, year)
+    ultimo = get_contador_bloqueado(clave)
+
+    if ultimo is None:
+        # Primera vez para la empresa y el año: se parte del máximo ya asignado en el libro
+        inicial = frappe.db.sql("""
+            SELECT MAX(custom_numero)
+            FROM `tabGL Entry`
+            WHERE company = %s
+            AND posting_date BETWEEN %s AND %s
+        """, (company, f"{year}-01-01", f"{year}-12-31"))[0][0] or 0
+        crear_contador(company, year, inicial)
+        ultimo = get_contador_bloqueado(clave)
+
+    numero = ultimo + 1
+    frappe.db.sql("""
+        UPDATE `tabContador Asientos`
+        SET ultimo_numero = %s, modified = %s
+        WHERE name = %s
+    """, (numero, now(), clave))
+    return numero
+
+
+def get_contador_bloqueado(clave):
+    resultado = frappe.db.sql("""
+        SELECT ultimo_numero
+        FROM `tabContador Asientos`
+        WHERE name = %s
+        FOR UPDATE
+    """, (clave,))
+    return resultado[0][0] if resultado else None
+
+
+def crear_contador(company, year, ultimo_numero):
+    # INSERT IGNORE: si otro proceso lo ha creado a la vez, se conserva el suyo
+    ahora = now()
+    frappe.db.sql("""
+        INSERT IGNORE INTO `tabContador Asientos`
+            (name, clave, company, anio, ultimo_numero, creation, modified, owner, modified_by, docstatus)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 0)
+    """, (clave_contador(company, year), clave_contador(company, year), company, year, ultimo_numero,
+          ahora, ahora, frappe.session.user, frappe.session.user))
+
+
+def fijar_contador(company, year, ultimo_numero):
     """
-    if not frappe.has_permission("GL Entry", "write"):
+    Deja el contador de la empresa y el año en `ultimo_numero` (tras una renumeración).
+    """
+    clave = clave_contador(company, year)
+    if get_contador_bloqueado(clave) is None:
+        crear_contador(company, year, ultimo_numero)
+    frappe.db.sql("""
+        UPDATE `tabContador Asientos`
+        SET ultimo_numero = %s, modified = %s
+        WHERE name = %s
+    """, (ultimo_numero, now(), clave))
+
+# Para renumerar asientos existentes
+
+# Vouchers actualizados por cada UPDATE ... JOIN (y por cada commit)
+TAMANO_LOTE_RENUMERACION = 5000
+# Cambios de ejemplo devueltos en el modo de simulación
+MUESTRA_SIMULACION = 50
+
+# Qué se renumera en cada modo y con qué evento se informa del progreso
+RENUMERACIONES = {
+    "gl": {
+        "permiso": "GL Entry",
+        "evento": "renumerar_asientos_progress",
+        "error": "Error al renumerar asientos",
+        "vacio": "No se encontraron asientos para renumerar en el año {0}"
+    },
+    "journal": {
+        "permiso": "Journal Entry",
+        "evento": "renumerar_journal_entries_progress",
+        "error": "Error al renumerar Journal Entries",
+        "vacio": "No se encontraron Journal Entries para renumerar en el año {0}"
+    }
+}
+
+
+def validar_renumeracion(modo, company, year):
+    if not frappe.has_permission(RENUMERACIONES[modo]["permiso"], "write"):
         frappe.throw(_("No tiene permisos para renumerar asientos"))
-        
+
+    # Validar entradas
+    if not company or not year:
+        frappe.throw(_("Debe proporcionar Empresa y Año."))
+
+    # Validar año
     try:
-        # Validar entradas
-        if not company or not year:
-            frappe.throw(_("Debe proporcionar Empresa y Año."))
-        
-        # Validar año
-        try:
-            year = int(year)
-            if year < 1900 or year > 2100:
-                frappe.throw(_("El año debe estar entre 1900 y 2100"))
-        except ValueError:
-            frappe.throw(_("El año debe ser un número válido"))
-            
-        # Obtener los vouchers únicos ordenados por fecha
-        vouchers = frappe.db.sql("""
-            SELECT DISTINCT voucher_type, voucher_no, MIN(posting_date) as posting_date,
-                          MIN(creation) as creation
+        year = int(year)
+    except ValueError:
+        frappe.throw(_("El año debe ser un número válido"))
+    if year < 1900 or year > 2100:
+        frappe.throw(_("El año debe estar entre 1900 y 2100"))
+    return year
+
+
+def calcular_numeracion(modo, company, year):
+    """
+    Calcula en una tabla temporal el número que corresponde a cada voucher
+    con ROW_NUMBER(), ordenando por fecha contable (posting_date) y en caso
+    de empate por fecha de creación (creation). Devuelve el total de vouchers.
+    """
+    frappe.db.sql_ddl("DROP TEMPORARY TABLE IF EXISTS `tmp_renumeracion_asientos`")
+    frappe.db.sql_ddl("""
+        CREATE TEMPORARY TABLE `tmp_renumeracion_asientos` (
+            numero INT NOT NULL PRIMARY KEY,
+            voucher_type VARCHAR(140) NOT NULL,
+            voucher_no VARCHAR(140) NOT NULL,
+            posting_date DATE,
+            numero_actual INT,
+            KEY voucher (voucher_type, voucher_no)
+        )
+    """)
+
+    desde, hasta = f"{year}-01-01", f"{year}-12-31"
+    if modo == "gl":
+        frappe.db.sql("""
+            INSERT INTO `tmp_renumeracion_asientos` (numero, voucher_type, voucher_no, posting_date, numero_actual)
+            SELECT ROW_NUMBER() OVER (ORDER BY MIN(posting_date) ASC, MIN(creation) ASC),
+                voucher_type, voucher_no, MIN(posting_date), MAX(custom_numero)
             FROM `tabGL Entry`
             WHERE company = %s
-            AND YEAR(posting_date) = %s
+            AND posting_date BETWEEN %s AND %s
             GROUP BY voucher_type, voucher_no
-            ORDER BY MIN(posting_date) ASC, MIN(creation) ASC
-        """, (company, year), as_dict=1)
-        
-        if not vouchers:
-            frappe.throw(_("No se encontraron asientos para renumerar en el año {0}").format(year))
-        
-        total_vouchers = len(vouchers)
-        
+        """, (company, desde, hasta))
+    else:
+        frappe.db.sql("""
+            INSERT INTO `tmp_renumeracion_asientos` (numero, voucher_type, voucher_no, posting_date, numero_actual)
+            SELECT ROW_NUMBER() OVER (ORDER BY posting_date ASC, creation ASC),
+                'Journal Entry', name, posting_date, number
+            FROM `tabJournal Entry`
+            WHERE company = %s
+            AND posting_date BETWEEN %s AND %s
+            AND docstatus = 1
+        """, (company, desde, hasta))
+
+    return frappe.db.sql("SELECT COUNT(*) FROM `tmp_renumeracion_asientos`")[0][0]
+
+
+def aplicar_lote(modo, company, desde, hasta):
+    # Solo se escriben las filas cuyo número cambia
+    if modo == "gl":
+        frappe.db.sql("""
+            UPDATE `tabGL Entry` gle
+            JOIN `tmp_renumeracion_asientos` t
+                ON t.voucher_type = gle.voucher_type AND t.voucher_no = gle.voucher_no
+            SET gle.custom_numero = t.numero
+            WHERE gle.company = %s
+            AND t.numero BETWEEN %s AND %s
+            AND (gle.custom_numero IS NULL OR gle.custom_numero <> t.numero)
+        """, (company, desde, hasta))
+
+    # Los Journal Entry guardan también su número
+    frappe.db.sql("""
+        UPDATE `tabJournal Entry` je
+        JOIN `tmp_renumeracion_asientos` t
+            ON t.voucher_type = 'Journal Entry' AND t.voucher_no = je.name
+        SET je.number = t.numero
+        WHERE t.numero BETWEEN %s AND %s
+        AND (je.number IS NULL OR je.number <> t.numero)
+    """, (desde, hasta))
+
+
+def simular_renumeracion(modo, company, year):
+    """
+    Modo de simulación: calcula la numeración y devuelve cuántos vouchers
+    cambiarían y una muestra de los cambios, sin escribir nada.
+    """
+    total = calcular_numeracion(modo, company, year)
+    cambios = frappe.db.sql("""
+        SELECT COUNT(*)
+        FROM `tmp_renumeracion_asientos`
+        WHERE numero_actual IS NULL OR numero_actual <> numero
+    """)[0][0]
+    muestra = frappe.db.sql("""
+        SELECT voucher_type, voucher_no, posting_date, numero_actual, numero AS numero_nuevo
+        FROM `tmp_renumeracion_asientos`
+        WHERE numero_actual IS NULL OR numero_actual <> numero
+        ORDER BY numero
+        LIMIT %s
+    """, (MUESTRA_SIMULACION,), as_dict=1)
+    frappe.db.sql_ddl("DROP TEMPORARY TABLE IF EXISTS `tmp_renumeracion_asientos`")
+
+    return {"dry_run": True, "total": total, "cambios": cambios, "muestra": muestra}
+
+
+def ejecutar_renumeracion(modo, company, year, progreso_id=None):
+    """
+    Trabajo en segundo plano: calcula la numeración en la tabla temporal y la
+    aplica por lotes de `TAMANO_LOTE_RENUMERACION` vouchers con UPDATE ... JOIN,
+    haciendo commit tras cada lote. Si se interrumpe, puede relanzarse: los
+    lotes ya aplicados no vuelven a escribirse.
+    """
+    year = int(year)
+    progreso = ReporteProgreso(RENUMERACIONES[modo]["evento"], job_id=progreso_id)
+
+    try:
+        total = calcular_numeracion(modo, company, year)
+        if not total:
+            frappe.throw(_(RENUMERACIONES[modo]["vacio"]).format(year))
+
         # Emitir el total de asientos a procesar
-        frappe.publish_realtime(
-            "renumerar_asientos_progress",
-            {"progress": [0, total_vouchers], "message": _("Iniciando renumeración...")}
-        )
-            
-        # Renumerar secuencialmente
-        for idx, voucher in enumerate(vouchers, start=1):
-            # Actualizar todos los GL Entries del mismo voucher con el mismo número
-            frappe.db.sql("""
-                UPDATE `tabGL Entry`
-                SET custom_numero = %s
-                WHERE voucher_type = %s
-                AND voucher_no = %s
-                AND company = %s
-            """, (idx, voucher.voucher_type, voucher.voucher_no, company))
-            
-            # Si es un Journal Entry, actualizar también su número
-            if voucher.voucher_type == "Journal Entry":
-                frappe.db.set_value("Journal Entry", voucher.voucher_no, "number", idx)
-            
-            # Actualizar progreso cada 10 asientos o en el último
-            if idx % 10 == 0 or idx == total_vouchers:
-                frappe.publish_realtime(
-                    "renumerar_asientos_progress",
-                    {
-                        "progress": [idx, total_vouchers],
-                        "message": _("Renumerando asiento {0} de {1} - Fecha: {2}").format(
-                            idx, 
-                            total_vouchers,
-                            frappe.format(voucher.posting_date, {'fieldtype': 'Date'})
-                        )
-                    }
-                )
-                
-        frappe.db.commit()
-        
+        progreso.set_total(total, mensaje=_("Iniciando renumeración..."))
+
+        for desde in range(1, total + 1, TAMANO_LOTE_RENUMERACION):
+            hasta = min(desde + TAMANO_LOTE_RENUMERACION - 1, total)
+            aplicar_lote(modo, company, desde, hasta)
+            frappe.db.commit()
+
+            progreso.avanzar(hasta - desde + 1, mensaje=_("Renumerando asiento {0} de {1}").format(hasta, total))
+
+        # El siguiente asiento que se cree continúa tras el último renumerado
+        if modo == "gl":
+            fijar_contador(company, year, total)
+            frappe.db.commit()
+
+        frappe.db.sql_ddl("DROP TEMPORARY TABLE IF EXISTS `tmp_renumeracion_asientos`")
+
         # Mensaje final
-        frappe.publish_realtime(
-            "renumerar_asientos_progress",
-            {
-                "success": True,
-                "message": _("Renumeración completada"),
-                "total_renumerados": total_vouchers
-            }
-        )
-        
-        return True
-        
+        progreso.finalizar({
+            "success": True,
+            "message": _("Renumeración completada"),
+            "total_renumerados": total
+        })
+
     except Exception as e:
         frappe.db.rollback()
-        frappe.log_error(frappe.get_traceback(), _("Error al renumerar asientos"))
-        frappe.publish_realtime(
-            "renumerar_asientos_progress",
-            {
-                "success": False,
-                "message": str(e)
-            }
-        )
-        frappe.throw(_("Error al renumerar: {0}").format(str(e)))
+        frappe.log_error(frappe.get_traceback(), _(RENUMERACIONES[modo]["error"]))
+        progreso.publicar({
+            "success": False,
+            "message": str(e)
+        })
+        raise
+
+
+def renumerar(modo, company, year, dry_run=False):
+    year = validar_renumeracion(modo, company, year)
+
+    if cint(dry_run):
+        return simular_renumeracion(modo, company, year)
+
+    job_id = f"renumerar_asientos_{modo}_{company}_{year}"
+    frappe.enqueue(
+        "integracion.integracion.renumerar_asientos.ejecutar_renumeracion",
+        queue="long",
+        timeout=3600,
+        job_id=job_id,
+        deduplicate=True,
+        enqueue_after_commit=True,
+        modo=modo,
+        company=company,
+        year=year,
+        progreso_id=job_id
+    )
+    return {"dry_run": False, "job_id": job_id}
+
+
+@frappe.whitelist()
+def renumerar_asientos_gl(company, year, dry_run=False):
+    """
+    Renumera los GL Entries por Empresa y Año, ordenando por fecha contable (posting_date)
+    y en caso de empate por fecha de creación (creation).
+    Con `dry_run` devuelve los cambios sin aplicarlos; si no, encola la renumeración.
+    """
+    return renumerar("gl", company, year, dry_run)
+
 
 @frappe.whitelist()
-def renumerar_asientos(company, year):
+def renumerar_asientos(company, year, dry_run=False):
     """
     Renumera los Journal Entries por Empresa y Año, ordenando por fecha contable (posting_date)
     y en caso de empate por fecha de creación (creation).
+    Con `dry_run` devuelve los cambios sin aplicarlos; si no, encola la renumeración.
     """
-    if not frappe.has_permission("Journal Entry", "write"):
-        frappe.throw(_("No tiene permisos para renumerar Journal Entries"))
-        
-    try:
-        # Validar entradas
-        if not company or not year:
-            frappe.throw(_("Debe proporcionar Empresa y Año."))
-        
-        # Validar año
-        try:
-            year = int(year)
-            if year < 1900 or year > 2100:
-                frappe.throw(_("El año debe estar entre 1900 y 2100"))
-        except ValueError:
-            frappe.throw(_("El año debe ser un número válido"))
-            
-        # Obtener los registros filtrados por Empresa y Año
-        journal_entries = frappe.get_all(
-            "Journal Entry",
-            filters={
-                "company": company,
-                "posting_date": ["between", [f"{year}-01-01", f"{year}-12-31"]],
-                "docstatus": 1
-            },
-            fields=["name", "posting_date", "creation"],
-            order_by="posting_date ASC, creation ASC"  # Primero ordenar por posting_date, luego por creation
-        )
-        
-        if not journal_entries:
-            frappe.throw(_("No se encontraron Journal Entries para renumerar en el año {0}").format(year))
-        
-        total_entries = len(journal_entries)
-        
-        # Emitir el total de asientos a procesar
-        frappe.publish_realtime(
-            "renumerar_journal_entries_progress",
-            {"progress": [0, total_entries], "message": _("Iniciando renumeración...")}
-        )
-            
-        # Renumerar secuencialmente
-        for idx, entry in enumerate(journal_entries, start=1):
-            frappe.db.set_value("Journal Entry", entry.name, "number", idx)
-            
-            # Actualizar progreso cada 10 asientos o en el último
-            if idx % 10 == 0 or idx == total_entries:
-                frappe.publish_realtime(
-                    "renumerar_journal_entries_progress",
-                    {
-                        "progress": [idx, total_entries],
-                        "message": _("Renumerando asiento {0} de {1} - Fecha: {2}").format(
-                            idx, 
-                            total_entries,
-                            frappe.format(entry.posting_date, {'fieldtype': 'Date'})
-                        )
-                    }
-                )
-                
-        frappe.db.commit()
-        
-        # Mensaje final
-        frappe.publish_realtime(
-            "renumerar_journal_entries_progress",
-            {
-                "success": True,
-                "message": _("Renumeración completada"),
-                "total_renumerados": total_entries
-            }
-        )
-        
-        return True
-        
-    except Exception as e:
-        frappe.db.rollback()
-        frappe.log_error(frappe.get_traceback(), _("Error al renumerar Journal Entries"))
-        frappe.publish_realtime(
-            "renumerar_journal_entries_progress",
-            {
-                "success": False,
-                "message": str(e)
-            }
-        )
-        frappe.throw(_("Error al renumerar: {0}").format(str(e)))
\ No newline at end of file
+    return renumerar("journal", company, year, dry_run)
@@ -0,0 +1,232 @@
+import os
+import logging
+from decimal import Decimal
+from lxml import etree
+import frappe
+from frappe.utils import flt
+from integracion.integracion.sii.method.runtime_sii import get_schema
+
+NS_PAIN_008 = "urn:iso:std:iso:20022:tech:xsd:pain.008.001.02"
+NS_PAIN_001 = "urn:iso:std:iso:20022:tech:xsd:pain.001.001.03"
+
+C34_XSD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "c34_xsd")
+XSD_PAIN_008 = os.path.join(C34_XSD, "pain.008.001.02.xsd")
+XSD_PAIN_001 = os.path.join(C34_XSD, "pain.001.001.03.xsd")
+
+CENTIMOS = Decimal("0.01")
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = logging.FileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/sepa_xml.log')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+
+def get_ruta_cuaderno(nombre):
+    """
+    Ruta del archivo `nombre` en la carpeta private/cuaderno del sitio actual.
+    """
+    carpeta = frappe.get_site_path("private", "cuaderno")
+    os.makedirs(carpeta, exist_ok=True)
+    return os.path.join(carpeta, nombre)
+
+
+def importe(valor):
+    """
+    Importe redondeado a céntimos, el mismo que se escribe en el XML.
+    """
+    return Decimal(str(flt(valor, 2))).quantize(CENTIMOS)
+
+
+def resumen(operaciones):
+    """
+    NbOfTxs y CtrlSum de las operaciones en una sola pasada. El total es la
+    suma de los importes ya redondeados, así que cuadra con las líneas.
+    """
+    numero = 0
+    total = Decimal(0)
+    for operacion in operaciones:
+        numero += 1
+        total += importe(operacion["importe"])
+    return str(numero), f"{total:.2f}"
+
+
+def write_element(xf, ns, nombre, valor, sangria=None):
+    """
+    Escribe `valor` como el elemento `nombre` del mensaje directamente en el
+    archivo abierto: los diccionarios son elementos con hijos en el mismo
+    orden, una tupla (texto, atributos) un elemento con atributos y el resto
+    texto. No se construye ningún árbol, así que el espacio de nombres es el
+    que declara el Document una sola vez.
+
+    `sangria` es el salto de línea y la indentación del elemento, o None para
+    escribirlo sin indentar.
+    """
+    atributos = None
+    if isinstance(valor, tuple):
+        valor, atributos = valor
+
+    if sangria is not None:
+        xf.write(sangria)
+    with xf.element(f"{{{ns}}}{nombre}", atributos):
+        if isinstance(valor, dict):
+            sangria_hijos = None if sangria is None else sangria + "  "
+            for hijo, valor_hijo in valor.items():
+                write_element(xf, ns, hijo, valor_hijo, sangria_hijos)
+            if valor and sangria is not None:
+                xf.write(sangria)
+        else:
+            xf.write(valor)
+
+
+def write_document(destino, ns, mensaje, grp_hdr, pmt_inf, transaccion, transacciones, pretty_print=None):
+    """
+    Escribe el Document SEPA en `destino` (ruta o archivo) con escritura
+    incremental: la cabecera de grupo, la del pago y cada transacción se
+    escriben elemento a elemento. `transacciones` son los contenidos de los
+    elementos `transaccion` del pago. Solo se indenta en modo desarrollador.
+    """
+    if pretty_print is None:
+        pretty_print = bool(frappe.conf.developer_mode)
+    sangria = "\n  " if pretty_print else None
+    sangria_pago = None if sangria is None else sangria + "    "
+
+    with etree.xmlfile(destino, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(f"{{{ns}}}Document", nsmap={None: ns}):
+            if sangria is not None:
+                xf.write(sangria)
+            with xf.element(f"{{{ns}}}{mensaje}"):
+                write_element(xf, ns, "GrpHdr", grp_hdr, None if sangria is None else sangria + "  ")
+                if sangria is not None:
+                    xf.write(sangria + "  ")
+                with xf.element(f"{{{ns}}}PmtInf"):
+                    for nombre, valor in pmt_inf.items():
+                        write_element(xf, ns, nombre, valor, sangria_pago)
+                    for valor in transacciones:
+                        write_element(xf, ns, transaccion, valor, sangria_pago)
+                    if sangria is not None:
+                        xf.write(sangria + "  ")
+                if sangria is not None:
+                    xf.write(sangria)
+            if pretty_print:
+                xf.write("\n")
+
+
+def write_pain_008(destino, cabecera, cobros, pretty_print=None):
+    """
+    Escribe la remesa de adeudos directos (pain.008.001.02).
+
+    `cabecera`: msg_id, creacion, nombre, nif, pmt_inf_id, fecha_cobro, iban.
+    `cobros`: filas con id, importe, mandato, fecha_firma, nombre, iban, concepto.
+    Devuelve (NbOfTxs, CtrlSum).
+    """
+    numero, total = resumen(cobros)
+
+    grp_hdr = {
+        "MsgId": cabecera["msg_id"],
+        "CreDtTm": cabecera["creacion"],
+        "NbOfTxs": numero,
+        "CtrlSum": total,
+        "InitgPty": {
+            "Nm": cabecera["nombre"],
+            "Id": {"OrgId": {"Othr": {"Id": cabecera["nif"], "SchmeNm": {"Prtry": "ES"}}}}
+        }
+    }
+    pmt_inf = {
+        "PmtInfId": cabecera["pmt_inf_id"],
+        "PmtMtd": "DD",
+        "NbOfTxs": numero,
+        "CtrlSum": total,
+        "PmtTpInf": {"SvcLvl": {"Cd": "SEPA"}, "LclInstrm": {"Cd": "CORE"}, "SeqTp": "RCUR"},
+        "ReqdColltnDt": cabecera["fecha_cobro"],
+        "Cdtr": {"Nm": cabecera["nombre"]},
+        "CdtrAcct": {"Id": {"IBAN": cabecera["iban"]}},
+        "CdtrAgt": {"FinInstnId": {}},
+        "ChrgBr": "SLEV",
+        "CdtrSchmeId": {"Id": {"PrvtId": {"Othr": {"Id": cabecera["nif"], "SchmeNm": {"Prtry": "ES"}}}}}
+    }
+    transacciones = (
+        {
+            "PmtId": {"EndToEndId": cobro["id"]},
+            "InstdAmt": (f"{importe(cobro['importe']):.2f}", {"Ccy": "EUR"}),
+            "DrctDbtTx": {"MndtRltdInf": {"MndtId": cobro["mandato"], "DtOfSgntr": cobro["fecha_firma"]}},
+            "DbtrAgt": {"FinInstnId": {}},
+            "Dbtr": {"Nm": cobro["nombre"]},
+            "DbtrAcct": {"Id": {"IBAN": cobro["iban"]}},
+            "RmtInf": {"Ustrd": cobro["concepto"]}
+        }
+        for cobro in cobros
+    )
+
+    write_document(destino, NS_PAIN_008, "CstmrDrctDbtInitn", grp_hdr, pmt_inf, "DrctDbtTxInf", transacciones, pretty_print)
+    return numero, total
+
+
+def write_pain_001(destino, cabecera, pagos, pretty_print=None):
+    """
+    Escribe la remesa de transferencias (pain.001.001.03).
+
+    `cabecera`: msg_id, creacion, nombre, nif, pmt_inf_id, fecha_ejecucion, iban.
+    `pagos`: filas con id, importe, nombre, iban, concepto.
+    Devuelve (NbOfTxs, CtrlSum).
+    """
+    numero, total = resumen(pagos)
+
+    grp_hdr = {
+        "MsgId": cabecera["msg_id"],
+        "CreDtTm": cabecera["creacion"],
+        "NbOfTxs": numero,
+        "CtrlSum": total,
+        "InitgPty": {"Nm": cabecera["nombre"], "Id": {"OrgId": {"Othr": {"Id": cabecera["nif"]}}}}
+    }
+    pmt_inf = {
+        "PmtInfId": cabecera["pmt_inf_id"],
+        "PmtMtd": "TRF",
+        "BtchBookg": "false",
+        "NbOfTxs": numero,
+        "CtrlSum": total,
+        "PmtTpInf": {"InstrPrty": "NORM", "SvcLvl": {"Cd": "SEPA"}},
+        "ReqdExctnDt": cabecera["fecha_ejecucion"],
+        "Dbtr": {
+            "Nm": cabecera["nombre"],
+            "PstlAdr": {"Ctry": "ES"},
+            "Id": {"OrgId": {"Othr": {"Id": cabecera["nif"]}}}
+        },
+        "DbtrAcct": {"Id": {"IBAN": cabecera["iban"]}},
+        "DbtrAgt": {"FinInstnId": {}}
+    }
+    transacciones = (
+        {
+            "PmtId": {"EndToEndId": pago["id"]},
+            "Amt": {"InstdAmt": (f"{importe(pago['importe']):.2f}", {"Ccy": "EUR"})},
+            "Cdtr": {"Nm": pago["nombre"]},
+            "CdtrAcct": {"Id": {"IBAN": pago["iban"]}},
+            "RmtInf": {"Ustrd": pago["concepto"]}
+        }
+        for pago in pagos
+    )
+
+    write_document(destino, NS_PAIN_001, "CstmrCdtTrfInitn", grp_hdr, pmt_inf, "CdtTrfTxInf", transacciones, pretty_print)
+    return numero, total
+
+
+def validate_sepa(xml_path, xsd_path):
+    """
+    Valida el XML contra el esquema compilado de la caché del proceso.
+    Devuelve None si es válido o el texto con los errores. Sin el XSD el
+    archivo no se da por válido: no debe llegar al banco sin validar.
+    """
+    if not os.path.exists(xsd_path):
+        logger.error(f"No se encuentra el XSD {xsd_path}, no se puede validar {xml_path}")
+        return f"No se encuentra el XSD {os.path.basename(xsd_path)} para validar el archivo"
+
+    schema = get_schema(xsd_path)
+    if schema.validate(etree.parse(xml_path)):
+        return None
+
+    errores = "; ".join(f"Línea {error.line}: {error.message}" for error in list(schema.error_log)[:20])
+    logger.error(f"El archivo XML {xml_path} no es válido según el XSD: {errores}")
+    return errores
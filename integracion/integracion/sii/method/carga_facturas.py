@@ -0,0 +1,90 @@
+import frappe
+from integracion.integracion.consultas import get_hijos
+
+# Campos de cabecera que usan el XML y el registro de cada libro
+CAMPOS_EMITIDAS = [
+    "name", "company", "posting_date", "customer", "customer_name",
+    "grand_total", "total", "net_total",
+    "custom_tipo_comunicacion", "custom_tipo_factura", "custom_clave_regimen",
+    "custom_descripcion_factura", "custom_tipo_no_exenta"
+]
+CAMPOS_RECIBIDAS = [
+    "name", "company", "posting_date", "bill_no", "bill_date", "supplier_name", "tax_id",
+    "net_total", "custom_tipo_factura", "custom_clave_regimen", "custom_descripcion_factura"
+]
+
+
+def get_cabeceras(doctype, docnames, fields):
+    """
+    Cabeceras de las facturas en el orden de `docnames`. Devuelve la lista y
+    los nombres que no existen.
+    """
+    por_nombre = {f.name: f for f in frappe.get_all(doctype, filters={"name": ["in", docnames]}, fields=fields)}
+    return [por_nombre[d] for d in docnames if d in por_nombre], [d for d in docnames if d not in por_nombre]
+
+
+def asignar_lineas(facturas, productos, impuestos):
+    """
+    Añade a cada factura sus productos en `productos` y sus impuestos en
+    `taxes`. Las facturas son frappe._dict, así que los productos no pueden ir
+    en `items`: `factura.items` devolvería el método de dict.
+    """
+    for factura in facturas:
+        factura.productos = productos[factura.name]
+        factura.taxes = impuestos[factura.name]
+
+
+def load_facturas_emitidas(docnames):
+    """
+    Carga las facturas de venta con solo los datos del SII: cabeceras en una
+    consulta, productos e impuestos en otra cada uno e identificación de los
+    clientes (con el código de su país) en otra. Cada factura lleva sus
+    productos en `productos`, sus impuestos en `taxes` y los datos de su cliente
+    en `cliente`.
+    """
+    facturas, no_encontradas = get_cabeceras("Sales Invoice", docnames, CAMPOS_EMITIDAS)
+    if no_encontradas:
+        return facturas, no_encontradas
+
+    nombres = [f.name for f in facturas]
+    productos = get_hijos("Sales Invoice Item", "Sales Invoice", nombres, ["item_code", "net_amount", "item_tax_template"])
+    impuestos = get_hijos("Sales Taxes and Charges", "Sales Invoice", nombres, ["rate", "tax_amount"])
+
+    clientes = {c.name: c for c in frappe.db.sql("""
+        SELECT c.name, c.tax_id, c.custom_tipo_de_identificacion, UPPER(co.code) AS codigo_pais
+        FROM `tabCustomer` c
+        LEFT JOIN `tabCountry` co ON co.name = c.custom_pais
+        WHERE c.name IN %(clientes)s
+    """, {"clientes": tuple({f.customer for f in facturas})}, as_dict=True)}
+
+    asignar_lineas(facturas, productos, impuestos)
+    for factura in facturas:
+        factura.cliente = clientes.get(factura.customer) or frappe._dict()
+    return facturas, []
+
+
+def load_facturas_recibidas(docnames):
+    """
+    Carga las facturas de compra con solo los datos del SII: cabeceras,
+    productos e impuestos en una consulta cada uno.
+    """
+    facturas, no_encontradas = get_cabeceras("Purchase Invoice", docnames, CAMPOS_RECIBIDAS)
+    if no_encontradas:
+        return facturas, no_encontradas
+
+    nombres = [f.name for f in facturas]
+    productos = get_hijos("Purchase Invoice Item", "Purchase Invoice", nombres, ["item_code", "net_amount", "item_tax_template"])
+    impuestos = get_hijos("Purchase Taxes and Charges", "Purchase Invoice", nombres, ["rate", "add_deduct_tax"])
+
+    asignar_lineas(facturas, productos, impuestos)
+    return facturas, []
+
+
+def get_titulares(empresas):
+    """
+    Nombre y NIF de cada empresa titular en una consulta.
+    """
+    return {
+        c.name: c
+        for c in frappe.get_all("Company", filters={"name": ["in", list(empresas)]}, fields=["name", "company_name", "tax_id"])
+    }
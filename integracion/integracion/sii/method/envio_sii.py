@@ -0,0 +1,293 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import frappe
+from .runtime_sii import get_company_certificate, get_client
+from .carga_facturas import get_titulares
+from .xml_sii import write_and_validate
+
+site_config = frappe.get_site_config()
+
+# Registros por envío; la AEAT no admite más de 10.000 por petición
+TAMANO_LOTE_SII = min(int(site_config.get('sii_tamano_lote') or 10000), 10000)
+# Empresas (titulares) que se envían a la vez; los lotes de un mismo titular van uno tras otro
+MAX_ENVIOS_SII = int(site_config.get('sii_envios_concurrentes') or 2)
+# Espera mínima entre dos envíos del mismo titular si la AEAT no indica TiempoEsperaEnvio
+ESPERA_MINIMA_SII = 0
+
+# Estado que se guarda en la factura cuando el lote no llega a la AEAT
+ESTADO_ERROR_ENVIO = "Error de envío"
+# Estados de registro con los que la AEAT da la factura por presentada
+ESTADOS_ACEPTADOS = ("Correcto", "AceptadoConErrores")
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = logging.FileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/sii/logs/envio_sii.log')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+
+def parse_docnames(docnames):
+    # Asegurarse de que docnames sea una lista
+    if isinstance(docnames, str):
+        # Si se recibe una cadena, quita los corchetes y descompónla en una lista
+        docnames = docnames.strip("[]").replace('"', '').replace("'", "").split(",")
+    return [docname.strip() for docname in docnames if docname.strip()]
+
+
+def clave_registro(registro):
+    """
+    Identifica una factura en la respuesta de la AEAT: NIF del emisor y número.
+    """
+    id_factura = registro['IDFactura']
+    return (id_factura['IDEmisorFactura']['NIF'], id_factura['NumSerieFacturaEmisor'])
+
+
+def agrupar_facturas(facturas, libro):
+    """
+    Agrupa las facturas por empresa y tipo de comunicación, que van en la
+    cabecera de cada envío, y divide cada grupo en lotes de `TAMANO_LOTE_SII`.
+    """
+    grupos = {}
+    for factura in facturas:
+        clave = (factura.company, libro["get_tipo_comunicacion"](factura))
+        grupos.setdefault(clave, []).append(factura)
+
+    lotes = []
+    for (empresa, tipo_comunicacion), grupo in grupos.items():
+        for inicio in range(0, len(grupo), TAMANO_LOTE_SII):
+            lotes.append({
+                "empresa": empresa,
+                "tipo_comunicacion": tipo_comunicacion,
+                "facturas": grupo[inicio:inicio + TAMANO_LOTE_SII]
+            })
+    return lotes
+
+
+def build_datos(libro, facturas, titular, tipo_comunicacion):
+    """
+    Construye el diccionario que se pasa a zeep (y del que se escribe el XML)
+    directamente desde los datos de las facturas.
+    """
+    return {
+        'Cabecera': {
+            'IDVersionSii': "1.1",
+            'Titular': {
+                'NombreRazon': titular.company_name,
+                'NIF': titular.tax_id
+            },
+            'TipoComunicacion': tipo_comunicacion
+        },
+        libro["registro"]: [libro["build_registro"](factura, titular.tax_id) for factura in facturas]
+    }
+
+
+def preparar_lote(lote, libro, titulares):
+    """
+    Prepara los datos del lote y el mapa (NIF emisor, número) -> factura para
+    casar la respuesta.
+    """
+    lote["datos"] = build_datos(libro, lote["facturas"], titulares[lote["empresa"]], lote["tipo_comunicacion"])
+    lote["por_clave"] = {
+        clave_registro(registro): factura.name
+        for factura, registro in zip(lote["facturas"], lote["datos"][libro["registro"]])
+    }
+
+
+def enviar_lotes_titular(lotes, libro):
+    """
+    Envía uno tras otro los lotes de un mismo titular respetando el
+    TiempoEsperaEnvio que devuelve la AEAT. Se ejecuta en un hilo del pool, así
+    que no toca la base de datos: solo llama al servicio web.
+    """
+    espera_hasta = 0
+    for lote in lotes:
+        pausa = espera_hasta - time.monotonic()
+        if pausa > 0:
+            logger.info(f"Esperando {round(pausa, 1)} s antes del siguiente envío de {lote['empresa']}")
+            time.sleep(pausa)
+
+        inicio = time.perf_counter()
+        try:
+            client = get_client(libro["wsdl"], lote["p12_file_path"], lote["p12_password"])
+            lote["respuesta"] = getattr(client.service, libro["servicio"])(**lote["datos"])
+            espera = getattr(lote["respuesta"], 'TiempoEsperaEnvio', None) or ESPERA_MINIMA_SII
+        except Exception as e:
+            logger.error(f"Error al enviar el lote de {len(lote['facturas'])} facturas de {lote['empresa']}: {e}")
+            lote["error"] = str(e)
+            espera = ESPERA_MINIMA_SII
+
+        espera_hasta = time.monotonic() + int(espera)
+        estado = getattr(lote.get("respuesta"), 'EstadoEnvio', None) or lote.get("error")
+        logger.info(f"Lote de {len(lote['facturas'])} facturas de {lote['empresa']} enviado en {round(time.perf_counter() - inicio, 2)} s: {estado}")
+
+
+def iter_resultados_lote(lote):
+    """
+    Recorre la respuesta del lote línea a línea sin serializarla entera y
+    devuelve el resultado de cada factura (estado, CSV y error).
+    """
+    base = {"company": lote["empresa"], "estado_envio": None, "csv": None, "codigo_error": None, "error": None}
+    if lote.get("error"):
+        for name in lote["por_clave"].values():
+            yield name, dict(base, estado=ESTADO_ERROR_ENVIO, error=lote["error"])
+        return
+
+    respuesta = lote["respuesta"]
+    base["estado_envio"] = getattr(respuesta, 'EstadoEnvio', None)
+    csv = getattr(respuesta, 'CSV', None)
+    pendientes = set(lote["por_clave"].values())
+
+    for linea in getattr(respuesta, 'RespuestaLinea', None) or []:
+        name = lote["por_clave"].get(clave_registro(linea))
+        if not name:
+            logger.warning(f"Línea de respuesta sin factura: {clave_registro(linea)}")
+            continue
+
+        estado = getattr(linea, 'EstadoRegistro', None)
+        pendientes.discard(name)
+        yield name, dict(
+            base,
+            estado=estado,
+            csv=csv if estado != "Incorrecto" else None,
+            codigo_error=str(linea.CodigoErrorRegistro) if getattr(linea, 'CodigoErrorRegistro', None) else None,
+            error=getattr(linea, 'DescripcionErrorRegistro', None)
+        )
+
+    # Facturas enviadas sin línea de respuesta
+    for name in pendientes:
+        yield name, dict(base, estado=base["estado_envio"] or ESTADO_ERROR_ENVIO, csv=csv)
+
+
+def registrar_resultados(doctype, resultados):
+    """
+    Guarda el último estado en cada factura y añade en bloque una fila por
+    factura al 'Registro Envio SII'.
+    """
+    ahora = frappe.utils.now_datetime()
+    usuario = frappe.session.user
+    filas = []
+
+    for name, resultado in resultados.items():
+        frappe.db.set_value(doctype, name, {
+            "custom_estado_sii": resultado["estado"],
+            "custom_csv_sii": resultado["csv"],
+            "custom_error_sii": resultado["error"],
+            "custom_fecha_envio_sii": ahora
+        }, update_modified=False)
+
+        filas.append((
+            frappe.generate_hash(length=10), ahora, ahora, usuario, usuario, 0,
+            doctype, name, resultado["company"], ahora, resultado["estado"], resultado["estado_envio"],
+            resultado["csv"], resultado["codigo_error"], resultado["error"]
+        ))
+
+    frappe.db.bulk_insert(
+        "Registro Envio SII",
+        fields=[
+            "name", "creation", "modified", "owner", "modified_by", "docstatus",
+            "tipo_documento", "factura", "company", "fecha_envio", "estado", "estado_envio",
+            "csv", "codigo_error", "error"
+        ],
+        values=filas,
+        chunk_size=5000
+    )
+    frappe.db.commit()
+
+
+def enviar_facturas_sii(libro, facturas):
+    """
+    Motor de envío al SII: agrupa las facturas por empresa y tipo de
+    comunicación, las divide en lotes del tamaño que admite la AEAT, envía en
+    paralelo los lotes de distintos titulares y guarda en cada factura si fue
+    aceptada o rechazada.
+
+    `libro` describe el libro de registro (doctype, WSDL, operación, nombre del
+    registro y las funciones que construyen cada registro).
+    """
+    lotes = agrupar_facturas(facturas, libro)
+    titulares = get_titulares({lote["empresa"] for lote in lotes})
+
+    por_titular = {}
+    for lote in lotes:
+        certificado = get_company_certificate(lote["empresa"])
+        if not certificado:
+            logger.error(f"No se encontró un certificado para la empresa {lote['empresa']}")
+            return {"error": f"No se encontró un certificado para la empresa {lote['empresa']}"}
+
+        lote["p12_file_path"], lote["p12_password"], _ = certificado
+        preparar_lote(lote, libro, titulares)
+
+        # Construir el XML del lote con los mismos datos y validarlo contra el XSD antes de enviarlo
+        error = write_and_validate(libro["servicio"], libro["registro"], lote["datos"])
+        if error:
+            return {"error": error}
+
+        por_titular.setdefault(lote["empresa"], []).append(lote)
+
+    logger.info(f"Enviando {len(facturas)} facturas de {libro['doctype']} en {len(lotes)} lotes de {len(por_titular)} empresas")
+    with ThreadPoolExecutor(max_workers=MAX_ENVIOS_SII, thread_name_prefix="envio_sii") as executor:
+        list(executor.map(lambda lotes_titular: enviar_lotes_titular(lotes_titular, libro), por_titular.values()))
+
+    resultados = {}
+    for lote in lotes:
+        resultados.update(iter_resultados_lote(lote))
+        # La respuesta ya está reflejada en los resultados
+        lote.pop("respuesta", None)
+        lote.pop("datos", None)
+    registrar_resultados(libro["doctype"], resultados)
+
+    aceptadas = [name for name, resultado in resultados.items() if resultado["estado"] in ESTADOS_ACEPTADOS]
+    rechazadas = [
+        {"factura": name, "estado": resultado["estado"], "error": resultado["error"]}
+        for name, resultado in resultados.items() if resultado["estado"] not in ESTADOS_ACEPTADOS
+    ]
+    logger.info(f"Envío SII finalizado: {len(aceptadas)} facturas aceptadas y {len(rechazadas)} rechazadas")
+
+    # Solo el resumen: el detalle de cada factura queda en el 'Registro Envio SII'
+    return {
+        "success": True,
+        "aceptadas": len(aceptadas),
+        "rechazadas": rechazadas,
+        "lotes": [
+            {"empresa": lote["empresa"], "facturas": len(lote["facturas"]), "error": lote.get("error")}
+            for lote in lotes
+        ]
+    }
+
+
+@frappe.whitelist()
+def get_facturas_pendientes_sii(tipo_documento, desde, company=None, incluir_no_enviadas=0):
+    """
+    Facturas validadas desde `desde` cuyo último envío al SII no fue aceptado,
+    con el estado, el error y la fecha que guarda la propia factura.
+
+    Las facturas sin envío registrado (entre ellas las presentadas antes de
+    existir estos campos) solo se devuelven con `incluir_no_enviadas`, porque
+    reenviarlas como alta las duplicaría en la AEAT.
+    """
+    if tipo_documento not in ("Sales Invoice", "Purchase Invoice"):
+        frappe.throw(f"Tipo de documento no válido para el SII: {tipo_documento}")
+    frappe.has_permission(tipo_documento, "read", throw=True)
+
+    filtros = {
+        "docstatus": 1,
+        "posting_date": [">=", desde],
+        "custom_estado_sii": ["not in", ESTADOS_ACEPTADOS]
+    }
+    if company:
+        filtros["company"] = company
+    if not frappe.utils.cint(incluir_no_enviadas):
+        filtros["custom_fecha_envio_sii"] = ["is", "set"]
+
+    return frappe.get_all(
+        tipo_documento,
+        filters=filtros,
+        fields=[
+            "name as factura", "company", "posting_date", "custom_estado_sii as estado",
+            "custom_error_sii as error", "custom_fecha_envio_sii as fecha_envio"
+        ],
+        order_by="posting_date asc, name asc"
+    )
@@ -0,0 +1,146 @@
+import os
+import logging
+import threading
+from dataclasses import dataclass
+from zeep import Client, Transport
+from requests import Session
+from requests_pkcs12 import Pkcs12Adapter
+from lxml import etree
+import frappe
+from cryptography.hazmat.primitives.serialization import pkcs12, Encoding, PrivateFormat, NoEncryption
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = logging.FileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/sii/logs/runtime_sii.log')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+site_config = frappe.get_site_config()
+
+# Certificados por empresa, en site_config.json:
+# "sii_certificados": {"<empresa>": {"ruta": "<ruta del .pfx>", "password": "<contraseña>"}}
+certificados = site_config.get('sii_certificados') or {}
+
+
+@dataclass
+class MaterialCertificado:
+    private_key: object
+    certificate: object
+    private_key_pem: str
+    cert_pem: str
+    p12_data: bytes
+
+
+# Estado compartido por todo el proceso (worker). Cada entrada guarda la fecha
+# de modificación del archivo del que sale, así que un esquema o un certificado
+# sustituido en disco se vuelve a cargar sin reiniciar.
+_lock = threading.RLock()
+_esquemas = {}
+_certificados = {}
+_clientes = {}
+
+
+def get_mtime(path):
+    return os.path.getmtime(path)
+
+
+def get_schema(xsd_path):
+    """
+    Devuelve el esquema XSD compilado, que solo se vuelve a compilar si el
+    archivo cambia.
+    """
+    mtime = get_mtime(xsd_path)
+    with _lock:
+        entrada = _esquemas.get(xsd_path)
+        if entrada and entrada[0] == mtime:
+            return entrada[1]
+
+        logger.info(f"Compilando el esquema XSD {xsd_path}")
+        schema = etree.XMLSchema(etree.parse(xsd_path))
+        _esquemas[xsd_path] = (mtime, schema)
+        return schema
+
+
+def get_certificate(p12_file_path, p12_password):
+    """
+    Devuelve la clave, el certificado y sus PEM descifrados del PKCS#12. El
+    archivo solo se vuelve a leer y descifrar si cambia (rotación del certificado).
+    """
+    mtime = get_mtime(p12_file_path)
+    with _lock:
+        entrada = _certificados.get(p12_file_path)
+        if entrada and entrada[0] == mtime:
+            return entrada[1]
+
+        logger.info(f"Cargando el certificado desde {p12_file_path}")
+        with open(p12_file_path, 'rb') as f:
+            p12_data = f.read()
+        private_key, certificate, _ = pkcs12.load_key_and_certificates(p12_data, p12_password.encode())
+
+        material = MaterialCertificado(
+            private_key=private_key,
+            certificate=certificate,
+            private_key_pem=private_key.private_bytes(
+                encoding=Encoding.PEM,
+                format=PrivateFormat.TraditionalOpenSSL,
+                encryption_algorithm=NoEncryption()
+            ).decode('utf-8'),
+            cert_pem=certificate.public_bytes(Encoding.PEM).decode('utf-8'),
+            p12_data=p12_data
+        )
+        _certificados[p12_file_path] = (mtime, material)
+        logger.info("Certificado cargado con éxito")
+        return material
+
+
+def get_company_certificate(empresa):
+    """
+    Devuelve (ruta, password, material) del certificado de la empresa o None
+    si la empresa no tiene certificado configurado.
+    """
+    certificado_info = certificados.get(empresa)
+    if not certificado_info or not certificado_info.get('ruta') or not certificado_info.get('password'):
+        logger.error(f"La empresa {empresa} no tiene ruta y password de certificado en 'sii_certificados'")
+        return None
+
+    material = get_certificate(certificado_info['ruta'], certificado_info['password'])
+    return certificado_info['ruta'], certificado_info['password'], material
+
+
+def get_client(wsdl, p12_file_path, p12_password):
+    """
+    Devuelve el cliente zeep del WSDL autenticado con el certificado. La sesión
+    de requests (con su pool de conexiones y el Pkcs12Adapter) se reutiliza
+    entre envíos; el cliente se vuelve a crear si cambia el WSDL o el certificado.
+    """
+    clave = (wsdl, p12_file_path)
+    version = (get_mtime(wsdl), get_mtime(p12_file_path))
+    with _lock:
+        entrada = _clientes.get(clave)
+        if entrada and entrada[0] == version:
+            return entrada[1]
+
+        material = get_certificate(p12_file_path, p12_password)
+        session = Session()
+        session.mount('https://', Pkcs12Adapter(pkcs12_data=material.p12_data, pkcs12_password=p12_password))
+        client = Client(wsdl=wsdl, transport=Transport(session=session))
+
+        if entrada:
+            entrada[1].transport.session.close()
+        _clientes[clave] = (version, client)
+        logger.info(f"Cliente SII creado para {os.path.basename(wsdl)} con {os.path.basename(p12_file_path)}")
+        return client
+
+
+def clear_sii_cache():
+    """
+    Olvida los esquemas, certificados y clientes del proceso.
+    """
+    with _lock:
+        for _, client in _clientes.values():
+            client.transport.session.close()
+        _esquemas.clear()
+        _certificados.clear()
+        _clientes.clear()
@@ -0,0 +1,71 @@
+# Copyright (c) 2024, Xappiens and Contributors
+# See license.txt
+
+import datetime
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from integracion.integracion.sii.method.carga_facturas import asignar_lineas
+from integracion.integracion.sii.method.facturas_emitidas import build_registro_emitida
+from integracion.integracion.sii.method.facturas_recibidas import build_registro_recibida
+
+PLANTILLAS = {
+	"IVA 21": frappe._dict(taxes=[frappe._dict(tax_rate=21)]),
+	"IVA 10": frappe._dict(taxes=[frappe._dict(tax_rate=10)]),
+}
+
+
+def plantilla(doctype, name):
+	return PLANTILLAS[name]
+
+
+class TestRegistrosSII(FrappeTestCase):
+	"""
+	Registros construidos a partir de filas con la misma forma que las de los
+	cargadores de carga_facturas (frappe._dict de frappe.get_all).
+	"""
+
+	def test_registro_recibida(self):
+		factura = frappe._dict(
+			name="ACC-PINV-0001", company="Empresa", posting_date=datetime.date(2024, 10, 20),
+			bill_no="F-1", bill_date=datetime.date(2024, 10, 15), supplier_name="Proveedor",
+			tax_id="B00000000", net_total=100, custom_tipo_factura=None, custom_clave_regimen=None,
+			custom_descripcion_factura=None,
+		)
+		asignar_lineas(
+			[factura],
+			{factura.name: [frappe._dict(item_code="A", net_amount=100, item_tax_template=None)]},
+			{factura.name: [frappe._dict(rate=21, add_deduct_tax="Add")]},
+		)
+
+		registro = build_registro_recibida(factura, "B11111111")
+		detalle = registro["FacturaRecibida"]["DesgloseFactura"]["DesgloseIVA"]["DetalleIVA"]
+		self.assertEqual(detalle, [{"TipoImpositivo": "21", "BaseImponible": "100.00", "CuotaSoportada": "21.00"}])
+
+	def test_registro_emitida_varios_tipos(self):
+		factura = frappe._dict(
+			name="ACC-SINV-0001", company="Empresa", posting_date=datetime.date(2024, 10, 15),
+			customer="Cliente", customer_name="Cliente", grand_total=165, total=150, net_total=150,
+			custom_tipo_comunicacion=None, custom_tipo_factura=None, custom_clave_regimen=None,
+			custom_descripcion_factura=None, custom_tipo_no_exenta=None,
+			cliente=frappe._dict(tax_id="12345678Z", custom_tipo_de_identificacion="NIF", codigo_pais="ES"),
+		)
+		asignar_lineas(
+			[factura],
+			{factura.name: [
+				frappe._dict(item_code="A", net_amount=100, item_tax_template="IVA 21"),
+				frappe._dict(item_code="B", net_amount=50, item_tax_template="IVA 10"),
+			]},
+			{factura.name: [frappe._dict(rate=21, tax_amount=21), frappe._dict(rate=10, tax_amount=5)]},
+		)
+
+		with patch("frappe.get_cached_doc", plantilla):
+			registro = build_registro_emitida(factura, "B11111111")
+
+		desglose = registro["FacturaExpedida"]["TipoDesglose"]["DesgloseFactura"]["Sujeta"]["NoExenta"]
+		self.assertEqual(desglose["DesgloseIVA"]["DetalleIVA"], [
+			{"TipoImpositivo": "21", "BaseImponible": "100.00", "CuotaRepercutida": "21.00"},
+			{"TipoImpositivo": "10", "BaseImponible": "50.00", "CuotaRepercutida": "5.00"},
+		])
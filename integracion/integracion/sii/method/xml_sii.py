@@ -0,0 +1,138 @@
+import io
+import logging
+from lxml import etree
+import frappe
+from .runtime_sii import get_schema
+
+NS_SOAPENV = "http://schemas.xmlsoap.org/soap/envelope/"
+NS_SII_LR = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii/fact/ws/SuministroLR.xsd"
+NS_SII = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii/fact/ws/SuministroInformacion.xsd"
+NSMAP = {"soapenv": NS_SOAPENV, "siiLR": NS_SII_LR, "sii": NS_SII}
+
+# Ruta directa a la cabecera dentro del sobre (Envelope/Body/Suministro.../Cabecera)
+RUTA_CABECERA = f"{{{NS_SOAPENV}}}Body/*/{{{NS_SII}}}Cabecera"
+
+XSD_SII = '/home/frappe/frappe-bench/apps/integracion/integracion/integracion/sii/WSDL/SuministroLR.xsd'
+
+# Elementos del espacio de nombres SuministroLR; el resto son de SuministroInformacion
+ELEMENTOS_LR = {
+    "SuministroLRFacturasEmitidas", "SuministroLRFacturasRecibidas",
+    "RegistroLRFacturasEmitidas", "RegistroLRFacturasRecibidas",
+    "IDFactura", "FacturaExpedida", "FacturaRecibida"
+}
+
+# Nombres cualificados (notación Clark) de cada elemento, calculados una vez por nombre
+_nombres = {}
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = logging.FileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/sii/logs/xml_sii.log')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+
+def qname(nombre):
+    """
+    Nombre cualificado del elemento `nombre` en su espacio de nombres.
+    """
+    cualificado = _nombres.get(nombre)
+    if cualificado is None:
+        cualificado = f"{{{NS_SII_LR if nombre in ELEMENTOS_LR else NS_SII}}}{nombre}"
+        _nombres[nombre] = cualificado
+    return cualificado
+
+
+def write_element(xf, nombre, valor, sangria=None):
+    """
+    Escribe un valor del diccionario que se pasa a zeep directamente en el
+    archivo abierto: los diccionarios son elementos con hijos en el mismo
+    orden, las listas elementos repetidos y el resto texto. Los valores None
+    se omiten. No se construye ningún árbol, así que los prefijos son los que
+    declara el Envelope una sola vez.
+
+    `sangria` es el salto de línea y la indentación del elemento, o None para
+    escribirlo sin indentar.
+    """
+    if isinstance(valor, list):
+        for item in valor:
+            write_element(xf, nombre, item, sangria)
+        return
+
+    if sangria is not None:
+        xf.write(sangria)
+    with xf.element(qname(nombre)):
+        if isinstance(valor, dict):
+            sangria_hijos = None if sangria is None else sangria + "  "
+            for hijo, valor_hijo in valor.items():
+                if valor_hijo is not None:
+                    write_element(xf, hijo, valor_hijo, sangria_hijos)
+            if sangria is not None:
+                xf.write(sangria)
+        else:
+            xf.write(str(valor))
+
+
+def write_envelope(destino, servicio, registro, datos, pretty_print=None):
+    """
+    Escribe el sobre SOAP del envío en `destino` (ruta o archivo) en una sola
+    pasada con escritura incremental: cada registro se escribe elemento a
+    elemento en el flujo. `datos` es el mismo diccionario que se pasa a zeep.
+
+    Solo se indenta en modo desarrollador, salvo que se indique `pretty_print`.
+    """
+    if pretty_print is None:
+        pretty_print = bool(frappe.conf.developer_mode)
+    sangria = "\n    " if pretty_print else None
+
+    with etree.xmlfile(destino, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element(f"{{{NS_SOAPENV}}}Envelope", nsmap=NSMAP):
+            with xf.element(f"{{{NS_SOAPENV}}}Body"):
+                with xf.element(f"{{{NS_SII_LR}}}{servicio}"):
+                    write_element(xf, "Cabecera", datos["Cabecera"], sangria)
+                    for registro_datos in datos[registro]:
+                        write_element(xf, registro, registro_datos, sangria)
+                    if pretty_print:
+                        xf.write("\n")
+
+
+def build_envelope(servicio, registro, datos, pretty_print=None):
+    """
+    Igual que `write_envelope` pero devuelve el XML en bytes.
+    """
+    salida = io.BytesIO()
+    write_envelope(salida, servicio, registro, datos, pretty_print)
+    return salida.getvalue()
+
+
+def validate_envelope(xml_source, xsd_path=XSD_SII):
+    """
+    Valida el contenido del <Body> contra el esquema compilado de la caché del
+    proceso. `xml_source` es una ruta o un archivo. Lanza ValueError con los
+    errores del esquema.
+    """
+    schema = get_schema(xsd_path)
+    documento = etree.parse(xml_source)
+    body_content = documento.getroot().find(f"{{{NS_SOAPENV}}}Body/*")
+    if body_content is None:
+        raise ValueError("No se encontró el elemento Body en el XML")
+
+    if not schema.validate(body_content):
+        errores = "; ".join(f"Línea {error.line}: {error.message}" for error in list(schema.error_log)[:20])
+        logger.error(f"Error de validación del XML: {errores}")
+        raise ValueError(f"El XML no cumple con el esquema XSD: {errores}")
+
+
+def write_and_validate(servicio, registro, datos):
+    """
+    Construye el sobre en memoria y lo valida sin pasar por disco, así que
+    varios envíos a la vez no comparten ningún archivo. Devuelve el mensaje
+    de error o None.
+    """
+    try:
+        validate_envelope(io.BytesIO(build_envelope(servicio, registro, datos)))
+    except Exception as e:
+        logger.error(f"Error en la validación del XML: {e}")
+        return f"Error en la validación del XML: {e}"
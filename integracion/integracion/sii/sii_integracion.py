@@ -2,6 +2,7 @@
 import frappe
 from .method.facturas_emitidas import enviar_facturas_emitidas
 from .method.facturas_recibidas import enviar_facturas_recibidas
+from .method.envio_sii import get_facturas_pendientes_sii
 
 @frappe.whitelist()
 def enviar_facturas_emitidas_wrapper(docnames):
@@ -10,3 +11,14 @@ def enviar_facturas_emitidas_wrapper(docnames):
 @frappe.whitelist()
 def enviar_facturas_recibidas_wrapper(docnames):
     return enviar_facturas_recibidas(docnames)
+
+@frappe.whitelist()
+def enviar_facturas_pendientes_wrapper(tipo_documento, desde, company=None, incluir_no_enviadas=0):
+    # Reenviar solo las facturas cuyo último envío al SII no fue aceptado
+    pendientes = [f.factura for f in get_facturas_pendientes_sii(tipo_documento, desde, company, incluir_no_enviadas)]
+    if not pendientes:
+        return {"success": True, "aceptadas": 0, "rechazadas": [], "lotes": []}
+
+    if tipo_documento == "Sales Invoice":
+        return enviar_facturas_emitidas(pendientes)
+    return enviar_facturas_recibidas(pendientes)
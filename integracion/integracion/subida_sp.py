@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import logging
+from logging.handlers import RotatingFileHandler
+import frappe
+
+site_config = frappe.get_site_config()
+
+# Tamaño de cada bloque en la subida por bloques
+TAMANO_BLOQUE = int(site_config.get('sp_tamano_bloque_mb') or 10) * 1024 * 1024
+# Los archivos mayores que este umbral se suben por bloques en lugar de en una sola petición
+UMBRAL_SUBIDA_POR_BLOQUES = int(site_config.get('sp_umbral_bloques_mb') or 20) * 1024 * 1024
+# Reintentos de la subida por bloques ante fallos transitorios, cada uno con una sesión nueva
+MAX_REINTENTOS_SUBIDA = 3
+
+# Configurar el logger
+logger = logging.getLogger(__name__)
+handler = RotatingFileHandler('/home/frappe/frappe-bench/apps/integracion/integracion/integracion/logs/subida_sp.log', maxBytes=5 * 1024 * 1024, backupCount=3)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+
+def upload_local_file(ctx, target_folder, file_path, file_name=None):
+    """
+    Sube un archivo del disco a `target_folder`. Los archivos pequeños se
+    suben en una sola petición; los que superan `UMBRAL_SUBIDA_POR_BLOQUES`
+    se envían por bloques sin cargarlos enteros en memoria.
+    """
+    file_name = file_name or os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+
+    if file_size <= max(UMBRAL_SUBIDA_POR_BLOQUES, TAMANO_BLOQUE):
+        with open(file_path, 'rb') as file_content:
+            return target_folder.upload_file(file_name, file_content.read()).execute_query()
+
+    return upload_file_in_chunks(ctx, target_folder, file_path, file_name, file_size)
+
+
+def upload_file_in_chunks(ctx, target_folder, file_path, file_name, file_size, chunk_size=TAMANO_BLOQUE):
+    """
+    Sube el archivo con una sesión de subida (start/continue/finish upload)
+    leyendo del disco un bloque cada vez.
+
+    SharePoint no permite consultar cuánto ha guardado una sesión: si confirmó
+    un bloque pero la respuesta se perdió, el desplazamiento conocido aquí ya
+    no coincide con el suyo y reenviar el bloque fallaría siempre. Por eso,
+    ante un fallo, se cancela la sesión y la subida empieza de nuevo con otra.
+    """
+    logger.info(f"Subida por bloques de {file_name} ({file_size} bytes, bloques de {chunk_size} bytes)")
+
+    # Crear el archivo vacío sobre el que se abren las sesiones de subida
+    target_file = target_folder.files.add(file_name, b"", True).execute_query()
+
+    intento = 0
+    while True:
+        upload_id = str(uuid.uuid4())
+        try:
+            upload_chunks(ctx, target_file, upload_id, file_path, file_name, file_size, chunk_size)
+            break
+        except Exception as e:
+            ctx.clear()
+            try:
+                target_file.cancel_upload(upload_id).execute_query()
+            except Exception:
+                ctx.clear()
+
+            intento += 1
+            if intento > MAX_REINTENTOS_SUBIDA:
+                logger.error(f"Subida de {file_name} abortada tras {intento} intentos: {e}")
+                raise
+            logger.warning(f"Fallo en la subida por bloques de {file_name} (intento {intento}), se reinicia la sesión: {e}")
+            time.sleep(2 ** intento)
+
+    logger.info(f"Subida por bloques completada: {file_name}")
+    return target_file
+
+
+def upload_chunks(ctx, target_file, upload_id, file_path, file_name, file_size, chunk_size):
+    """
+    Envía el archivo completo en la sesión `upload_id`, desde el primer bloque.
+    """
+    offset = 0
+    with open(file_path, 'rb') as file_content:
+        while True:
+            chunk = file_content.read(chunk_size)
+            es_ultimo = offset + len(chunk) >= file_size
+
+            if offset == 0:
+                result = target_file.start_upload(upload_id, chunk)
+            elif es_ultimo:
+                result = target_file.finish_upload(upload_id, offset, chunk)
+            else:
+                result = target_file.continue_upload(upload_id, offset, chunk)
+            ctx.execute_query()
+
+            if offset and es_ultimo:
+                return
+
+            # SharePoint devuelve el desplazamiento confirmado tras cada bloque
+            offset = int(result.value) if getattr(result, 'value', None) else offset + len(chunk)
+            file_content.seek(offset)
+            logger.debug(f"{file_name}: {offset}/{file_size} bytes confirmados")
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import logging
 from logging.handlers import RotatingFileHandler
 from urllib.parse import quote, urlsplit, urlunsplit, urlencode, parse_qs
@@ -12,6 +13,13 @@ import requests
 import re
 import inspect
 from frappe import _
+from integracion.integracion.conexion_sp import get_sharepoint_context
+from integracion.integracion.carpetas_sp import ensure_folder_path, invalidate_folder_cache, normalize_path
+from integracion.integracion.arbol_sp import (
+    build_tree, get_cached_structure, set_cached_structure, invalidate_structure_cache
+)
+from integracion.integracion.subida_sp import upload_local_file
+from integracion.integracion.bibliotecas_sp import resolve_library, split_sharepoint_url
 
 # Leer credenciales desde el archivo de configuración del sitio
 site_config = frappe.get_site_config()
@@ -53,29 +61,17 @@ folder_structure_map = {
     # Añade aquí más doctypes y su estructura de carpetas 
 }
 
+# Cola de subidas a SharePoint (doctype 'Subida SharePoint')
+LOTE_SUBIDAS = 50  # Subidas procesadas por cada trabajo del worker
+MAX_INTENTOS_SUBIDA = 5
+ESPERA_BASE_SUBIDA = 60  # Segundos de espera del primer reintento, se duplica en cada fallo
+TIEMPO_MAXIMO_SUBIDAS = 20 * 60  # Segundos que un trabajo sigue vaciando la cola (por debajo del timeout de la cola long)
+
 
 
 def connect_to_sharepoint_with_token(site_url):
-    try:
-        # Usar el certificado y la huella digital para autenticarse directamente
-        logger.info(f"Conectando al contexto del sitio: {site_url} con huella digital: {cert_finger} y ruta de certificado: {cert_path}")
-
-        # Configurar el contexto de cliente con el certificado
-        ctx = ClientContext(site_url).with_client_certificate(
-            client_id=id_cliente,
-            thumbprint=cert_finger.replace(":", "").upper(),
-            cert_path=cert_path,
-            tenant=tenant_id
-        )
-        
-        # Probar la conexión accediendo a algún recurso básico
-        web = ctx.web.get().execute_query()
-        logger.info(f"Conexión exitosa al sitio SharePoint: {web.properties['Title']}")
-        
-        return ctx
-    except Exception as e:
-        logger.error(f"Error al conectar a SharePoint con certificado: {e}")
-        return None
+    # Reutiliza el contexto autenticado del proceso para el sitio (ver conexion_sp)
+    return get_sharepoint_context(site_url)
 
 def sanitize_name(name):
     """
@@ -141,30 +137,28 @@ def get_folder_structure(doctype, docname, foldername):
 
 def create_folder_if_not_exists(ctx, folder_relative_url, folder_name):
     try:
-        logger.info(f"ctx.web: {dir(ctx.web)}")
-
         logger.info(f"Comprobando existencia de carpeta en la ruta: {folder_relative_url}/{folder_name}")
-        folder_relative_url = folder_relative_url.replace("%20", " ")
-        parent_folder = ctx.web.get_folder_by_server_relative_url(f"{folder_relative_url}")
-        ctx.load(parent_folder)
-        ctx.execute_query()
-
-        folders = parent_folder.folders
-        ctx.load(folders)
-        ctx.execute_query()
-
-        folder_names = [folder.properties['Name'] for folder in folders]
-
-        if folder_name in folder_names:
-            logger.info(f"La carpeta ya existe: {folder_relative_url}/{folder_name}")
-        else:
-            new_folder = parent_folder.folders.add(folder_name).execute_query()
-            logger.info(f"Carpeta creada: {new_folder.serverRelativeUrl}")
+        ensure_folder_path(ctx, f"{folder_relative_url}/{folder_name}")
     except Exception as e:
         logger.error(f"Error verificando/creando carpeta en {folder_relative_url}/{folder_name}: {e}")
         raise
 
 
+def get_structure_fields(doctype):
+    """
+    Devuelve los campos de la base de datos que intervienen en la estructura
+    de carpetas del doctype, desglosando los campos combinados con ' - '.
+    """
+    fields = []
+    for field in folder_structure_map.get(doctype, []):
+        if field == "name":
+            continue  # El nombre del documento no debería cambiar, omítelo
+        for part in field.split(' - '):
+            if part not in fields:
+                fields.append(part)
+    return fields
+
+
 def handle_structure_change(doc, method):
     try:
         doctype = doc.doctype
@@ -175,141 +169,120 @@ def handle_structure_change(doc, method):
         if doctype not in folder_structure_map:
             logger.info(f"No hay estructura definida para el doctype {doctype}, omitiendo.")
             return
+
+        if doc.is_new():
+            logger.info(f"{doctype} {docname} es nuevo, no hay carpetas que mover.")
+            return
+        
+        fields_to_check = get_structure_fields(doctype)
         
-        fields_to_check = folder_structure_map[doctype]
+        # Valores antiguos: el documento cargado antes de guardar o, si no está, una única consulta
+        doc_before_save = doc.get_doc_before_save()
+        if doc_before_save:
+            old_values = {field: doc_before_save.get(field) for field in fields_to_check}
+        else:
+            old_values = frappe.db.get_value(doctype, docname, fields_to_check, as_dict=True) or {}
+        new_values = {field: doc.get(field) for field in fields_to_check}  # Valores del objeto actual antes de guardar
+
+        changed_fields = [field for field in fields_to_check if old_values.get(field) != new_values[field]]
+        if not changed_fields:
+            logger.info(f"No se detectaron cambios en los valores clave, no se requiere mover carpetas.")
+            return
+
+        for field in changed_fields:
+            logger.info(f"Cambio detectado en el campo {field}: de {old_values.get(field)} a {new_values[field]}.")
+
+        logger.info(f"Se han detectado cambios en los valores clave. Iniciando proceso de mover carpetas.")
         
-        # Compara los valores antiguos y los nuevos usando la base de datos directamente
-        changes_detected = False
-        old_values = {}
-        new_values = {}
+        # Obtener la estructura de carpetas antigua
+        old_folder_structure = get_old_folder_structure(doctype, docname, docname, old_values)
         
-        for field in fields_to_check:
-            if field == "name":
-                continue  # El nombre del documento no debería cambiar, omítelo
-            
-            # Obtener tanto el valor antiguo como el nuevo valor desde la base de datos directamente
-            old_value = frappe.db.get_value(doctype, docname, field)
-            new_value = doc.get(field)  # Valor del objeto actual antes de guardar
-
-            logger.info(f"Comprobando el campo {field}. Valor anterior: {old_value}, Valor nuevo: {new_value}")
-            
-            if old_value != new_value:
-                logger.info(f"Cambio detectado en el campo {field}: de {old_value} a {new_value}.")
-                old_values[field] = old_value
-                new_values[field] = new_value
-                changes_detected = True
+        # Obtener la estructura de carpetas nueva basada en los valores "nuevos"
+        new_folder_structure = get_new_folder_structure(doctype, new_values, docname)
+
+        if not old_folder_structure or not new_folder_structure:
+            logger.error(f"Error al construir la estructura de carpetas. Estructura antigua: {old_folder_structure}, Estructura nueva: {new_folder_structure}")
+            return
+
+        logger.info(f"Estructura de carpetas anterior: {old_folder_structure}")
+        logger.info(f"Estructura de carpetas nueva: {new_folder_structure}")
         
-        if changes_detected:
-            logger.info(f"Se han detectado cambios en los valores clave. Iniciando proceso de mover carpetas.")
-            
-            # Obtener la estructura de carpetas antigua
-            old_folder_structure = get_old_folder_structure(doctype, docname, old_values.get('name', docname))
-            
-            # Obtener la estructura de carpetas nueva basada en los valores "nuevos"
-            new_folder_structure = get_new_folder_structure(doctype, new_values, docname)
-
-            if not old_folder_structure or not new_folder_structure:
-                logger.error(f"Error al construir la estructura de carpetas. Estructura antigua: {old_folder_structure}, Estructura nueva: {new_folder_structure}")
-                return
-
-            logger.info(f"Estructura de carpetas anterior: {old_folder_structure}")
-            logger.info(f"Estructura de carpetas nueva: {new_folder_structure}")
-            
-            # Obtener la URL de SharePoint del documento
-            parent_folder_full_url = None
-            biblioteca_name = frappe.db.get_value('Bibliotecas SP Docnames', {'docname': docname}, 'parent')
-
-            if biblioteca_name:
-                parent_folder_full_url = frappe.db.get_value('Bibliotecas SP', biblioteca_name, 'url_sp')
-                logger.info(f"URL encontrada en la tabla hija para {doctype} con docname {docname}: {parent_folder_full_url}")
-            else:
-                biblioteca_name = frappe.db.get_value('Bibliotecas SP', {'documento': doctype}, 'name')
-                if not biblioteca_name:
-                    logger.info(f"No se encontró ningún documento en 'Bibliotecas SP' para {doctype}.")
-                    return
-                
-                doc_biblioteca = frappe.get_doc('Bibliotecas SP', biblioteca_name)
-
-                if doc_biblioteca.docnames:
-                    matching_entry = next((entry for entry in doc_biblioteca.docnames if entry.docname == docname), None)
-                    if matching_entry:
-                        parent_folder_full_url = doc_biblioteca.url_sp
-                    else:
-                        logger.info(f"No se encontró una coincidencia en la tabla hija para {docname}, cancelando la ejecución.")
-                        return
-                else:
-                    parent_folder_full_url = doc_biblioteca.url_sp
-                    logger.info(f"Usando la URL general para {doctype}: {parent_folder_full_url}")
-            
-            # Verificar que se obtuvo la URL correcta
-            if not parent_folder_full_url:
-                logger.error("No se pudo obtener la URL de la carpeta en SharePoint.")
-                return
-
-            # Obtener la ruta relativa en SharePoint
-            start_idx = parent_folder_full_url.find('/sites/')
-            if start_idx == -1:
-                logger.error("La URL no contiene '/sites/'. No se puede calcular la ruta relativa.")
-                return
-            
-            site_url = parent_folder_full_url[:start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/')]
-            site_relative_path = parent_folder_full_url[start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/') + 1:]
-            logger.info(f"Ruta relativa calculada: {site_relative_path}")
-            logger.info(f"Conectando al contexto del sitio: {site_url}")
-
-            # Conectar a SharePoint
-            ctx = connect_to_sharepoint_with_token(site_url)
+        # Obtener la URL de SharePoint del documento
+        biblioteca = resolve_library(doctype, docname)
+        if not biblioteca:
+            return
+
+        site_url = biblioteca["site_url"]
+        site_relative_path = biblioteca["site_relative_path"]
+        logger.info(f"Ruta relativa calculada: {site_relative_path}")
+        logger.info(f"Conectando al contexto del sitio: {site_url}")
 
-            # Asegúrate de que las carpetas en la nueva ruta existan, como en el método `upload_file_to_sharepoint`
-            current_relative_path = site_relative_path.strip('/')
-            for folder_name in new_folder_structure[:-1]:
-                folder_name_sanitized = sanitize_name(folder_name)
-                logger.info(f"Verificando existencia o creando carpeta: {current_relative_path}/{folder_name_sanitized}")
-                create_folder_if_not_exists(ctx, current_relative_path, folder_name_sanitized)
-                current_relative_path = f"{current_relative_path}/{folder_name_sanitized}".strip('/')
+        # Conectar a SharePoint
+        ctx = connect_to_sharepoint_with_token(site_url)
 
-            # Ahora que las carpetas padre están creadas o verificadas, movemos la carpeta final
-            old_relative_path = f"{site_relative_path}/{'/'.join([sanitize_name(f) for f in old_folder_structure])}"
-            new_relative_path = f"{current_relative_path}/{sanitize_name(new_folder_structure[-1])}"
+        # Asegúrate de que las carpetas en la nueva ruta existan, como en el método `upload_file_to_sharepoint`
+        current_relative_path = site_relative_path.strip('/')
+        for folder_name in new_folder_structure[:-1]:
+            current_relative_path = f"{current_relative_path}/{sanitize_name(folder_name)}".strip('/')
+        logger.info(f"Verificando existencia o creando ruta: {current_relative_path}")
+        ensure_folder_path(ctx, current_relative_path)
 
-            logger.info(f"Moviendo carpeta {old_relative_path} a {new_relative_path}")
+        # Ahora que las carpetas padre están creadas o verificadas, movemos la carpeta final
+        old_relative_path = f"{site_relative_path}/{'/'.join([sanitize_name(f) for f in old_folder_structure])}"
+        new_relative_path = f"{current_relative_path}/{sanitize_name(new_folder_structure[-1])}"
 
-            try:
-                destination_parent_path = "/".join(new_relative_path.split('/')[:-1])
-                old_folder = ctx.web.get_folder_by_server_relative_url(old_relative_path)
-                old_folder.move_to(destination_parent_path).execute_query()
-                logger.info(f"Carpeta movida exitosamente de {old_relative_path} a {destination_parent_path}")
-            except Exception as e:
-                logger.error(f"Error al mover la carpeta de {old_relative_path} a {new_relative_path}: {e}")
-        else:
-            logger.info(f"No se detectaron cambios en los valores clave, no se requiere mover carpetas.")
+        logger.info(f"Moviendo carpeta {old_relative_path} a {new_relative_path}")
+
+        try:
+            destination_parent_path = "/".join(new_relative_path.split('/')[:-1])
+            old_folder = ctx.web.get_folder_by_server_relative_url(old_relative_path)
+            old_folder.move_to(destination_parent_path).execute_query()
+            logger.info(f"Carpeta movida exitosamente de {old_relative_path} a {destination_parent_path}")
+
+            # La carpeta antigua y su contenido ya no existen en la ruta cacheada
+            invalidate_folder_cache(site_url, old_relative_path)
+            invalidate_folder_cache(site_url, new_relative_path)
+            invalidate_structure_cache(doctype, docname)
+        except Exception as e:
+            logger.error(f"Error al mover la carpeta de {old_relative_path} a {new_relative_path}: {e}")
     except Exception as e:
         logger.error(f"Error en handle_structure_change para {docname}: {e}")
 
+
+def build_folder_structure(doctype, values, foldername):
+    """
+    Construye la estructura de carpetas de un doctype a partir de un
+    diccionario con los valores de sus campos, sin consultar la base de datos.
+    """
+    structure = []
+    for field in folder_structure_map[doctype]:
+        if ' - ' in field:
+            parts = field.split(' - ')
+            combined_field_value = ' - '.join(sanitize_name(values.get(part)) for part in parts if values.get(part))
+            if combined_field_value:
+                structure.append(combined_field_value)
+        elif field == "name":
+            structure.append(sanitize_name(foldername))  # Usa el docname directamente
+        else:
+            value = values.get(field)
+            if value:
+                structure.append(sanitize_name(value))
+    return structure
+
 # Método para obtener la estructura antigua
-def get_old_folder_structure(doctype, docname, foldername):
+def get_old_folder_structure(doctype, docname, foldername, old_values=None):
     """
     Devuelve la estructura de carpetas basada en los valores antiguos de la base de datos.
+    Si no se pasan `old_values`, se leen todos los campos en una única consulta.
     """
     if doctype not in folder_structure_map:
         logger.error(f"No se encontró estructura de carpetas para el doctype {doctype}")
         return []
 
-    fields = folder_structure_map[doctype]
     try:
-        structure = []
-        for field in fields:
-            if ' - ' in field:
-                parts = field.split(' - ')
-                combined_field_value = ' - '.join(sanitize_name(frappe.db.get_value(doctype, docname, part)) for part in parts if frappe.db.get_value(doctype, docname, part))
-                if combined_field_value:
-                    structure.append(combined_field_value)
-            elif field == "name":
-                structure.append(sanitize_name(foldername))  # Usa el docname directamente
-            else:
-                value = frappe.db.get_value(doctype, docname, field)
-                if value:
-                    structure.append(sanitize_name(value))
+        if old_values is None:
+            old_values = frappe.db.get_value(doctype, docname, get_structure_fields(doctype), as_dict=True) or {}
+        structure = build_folder_structure(doctype, old_values, foldername)
         
         logger.info(f"Estructura de carpetas antigua para {doctype} {docname}: {structure}")
         return structure
@@ -320,27 +293,14 @@ def get_old_folder_structure(doctype, docname, foldername):
 # Método para obtener la estructura nueva basada en los valores nuevos detectados
 def get_new_folder_structure(doctype, new_values, foldername):
     """
-    Devuelve la estructura de carpetas basada en los valores nuevos detectados.
+    Devuelve la estructura de carpetas basada en los valores nuevos del documento.
     """
     if doctype not in folder_structure_map:
         logger.error(f"No se encontró estructura de carpetas para el doctype {doctype}")
         return []
 
-    fields = folder_structure_map[doctype]
     try:
-        structure = []
-        for field in fields:
-            if ' - ' in field:
-                parts = field.split(' - ')
-                combined_field_value = ' - '.join(sanitize_name(new_values.get(part)) for part in parts if new_values.get(part))
-                if combined_field_value:
-                    structure.append(combined_field_value)
-            elif field == "name":
-                structure.append(sanitize_name(foldername))  # Usa el docname directamente
-            else:
-                value = new_values.get(field)
-                if value:
-                    structure.append(sanitize_name(value))
+        structure = build_folder_structure(doctype, new_values, foldername)
         
         logger.info(f"Estructura de carpetas nueva para {doctype}: {structure}")
         return structure
@@ -348,126 +308,239 @@ def get_new_folder_structure(doctype, new_values, foldername):
         logger.error(f"Error al obtener la estructura de carpetas nueva para {doctype}: {e}")
         return []
 
+def resolve_upload_target(file_doc):
+    """
+    Resuelve el sitio, la ruta base y la estructura de carpetas de SharePoint
+    para un File adjunto. Solo consulta la base de datos, no llama a SharePoint.
+    """
+    file_path = frappe.get_site_path(file_doc.file_url.strip("/"))
+    logger.info(f"Archivo encontrado: {file_path}")
+
+    if not file_path or not os.path.isfile(file_path):
+        logger.error(f"El archivo no existe o no se proporcionó una ruta válida: {file_path}")
+        return None
+
+    doctype_name = file_doc.attached_to_doctype
+    docname = file_doc.attached_to_name
+    foldername = sanitize_name(docname)
+    project_type = None
+
+    if doctype_name == "Job Offer":
+        if frappe.db.get_value('Job Offer', docname, 'status') != "Accepted":
+            logger.info(f"El estado de la oferta de trabajo no es 'Accepted', no se subirá el archivo.")
+            return None
+
+    if doctype_name == "Project":
+        project_type = frappe.db.get_value('Project', docname, 'project_type')
+        if not project_type:
+            logger.info(f"El proyecto no tiene Project type seleccionado")
+            return None
+
+    biblioteca = resolve_library(doctype_name, docname, project_type)
+    if not biblioteca:
+        return None
+
+    site_url = biblioteca["site_url"]
+    site_relative_path = biblioteca["site_relative_path"]
+    logger.info(f"Ruta relativa calculada: {site_relative_path}")
+
+    folder_structure = get_folder_structure(doctype_name, docname, foldername)
+    if not folder_structure:
+        logger.error(f"No se encontró la estructura de carpetas para {doctype_name} con nombre {docname}")
+        return None
+
+    current_relative_path = site_relative_path.strip('/')
+    for folder_name in folder_structure:
+        current_relative_path = f"{current_relative_path}/{quote(sanitize_name(folder_name))}".strip('/')
+
+    return {
+        "file_path": file_path,
+        "site_url": site_url,
+        "site_relative_path": site_relative_path,
+        "folder_structure": folder_structure,
+        "target_path": current_relative_path
+    }
+
+
 def upload_file_to_sharepoint(doc, method):
+    """
+    Registra una 'Subida SharePoint' pendiente para el File y programa el
+    worker que las procesa. No se llama a SharePoint durante la petición.
+    """
     logger.info(f"Hook llamado al subir File: {doc.name}")
     try:
-        file_doc = frappe.get_doc('File', doc.name)
-        file_path = frappe.get_site_path(file_doc.file_url.strip("/"))
-        logger.info(f"Archivo encontrado: {file_path}")
+        if not doc.attached_to_doctype or not doc.attached_to_name:
+            return
 
-        if not file_path or not os.path.isfile(file_path):
-            logger.error(f"El archivo no existe o no se proporcionó una ruta válida: {file_path}")
+        # on_create y on_update se disparan ambos al adjuntar: la clave evita subir dos veces
+        clave = f"{doc.name}-{doc.content_hash or ''}".strip('-')
+        if frappe.db.exists("Subida SharePoint", clave):
+            logger.info(f"Subida ya registrada para {doc.name}, se omite.")
             return
 
-        doctype_name = file_doc.attached_to_doctype
-        docname = file_doc.attached_to_name
-        foldername = sanitize_name(docname)
-        project_type = None
-
-        if doctype_name == "Job Offer":
-            job_offer_doc = frappe.get_doc('Job Offer', docname)
-            if job_offer_doc.status != "Accepted":
-                logger.info(f"El estado de la oferta de trabajo no es 'Accepted', no se subirá el archivo.")
-                return
-
-        if doctype_name == "Project":
-            project_doc = frappe.get_doc('Project', docname)
-            if project_doc.project_type:
-                project_type = project_doc.project_type
-            else:
-                logger.info(f"El proyecto no tiene Project type seleccionado")
-                return
-
-        # Primera Verificación: Consultar directamente en la tabla hija si existe un registro con docname igual a doc.name
-        parent_folder_full_url = None
-        if project_type:
-            biblioteca_name = frappe.db.get_value(
-                'Bibliotecas SP Docnames',
-                {'docname': project_type},
-                'parent'
-            )
-            logger.info(f"Tabla hija: {biblioteca_name}")
-        else:
-            biblioteca_name = frappe.db.get_value(
-                'Bibliotecas SP Docnames', 
-                {'docname': docname}, 
-                'parent'
-            )
-            logger.info(f"Tabla hija: {biblioteca_name}")
-
-        if biblioteca_name:
-            # Si existe, obtener la URL del registro padre
-            parent_folder_full_url = frappe.db.get_value('Bibliotecas SP', biblioteca_name, 'url_sp')
-            logger.info(f"URL encontrada en la tabla hija para {doctype_name} con docname {docname}: {parent_folder_full_url}")
-        else:
-            # Segunda Verificación: Buscar en 'Bibliotecas SP' por doctype_name
-            biblioteca_name = frappe.db.get_value('Bibliotecas SP', {'documento': doctype_name}, 'name')
-            if not biblioteca_name:
-                logger.info(f"No se encontró ningún documento en 'Bibliotecas SP' para {doctype_name}.")
-                return
-            
-            doc_biblioteca = frappe.get_doc('Bibliotecas SP', biblioteca_name)
-
-            if doc_biblioteca.docnames:
-                # Si la tabla hija no está vacía, pero no se encontró coincidencia en la búsqueda anterior
-                logger.info(f"Tabla hija no vacía, verificando si {docname} está en la tabla hija.")
-                matching_entry = next((entry for entry in doc_biblioteca.docnames if entry.docname == docname), None)
-                if matching_entry:
-                    parent_folder_full_url = doc_biblioteca.url_sp
-                else:
-                    logger.info(f"No se encontró una coincidencia en la tabla hija para {docname}, cancelando la ejecución.")
-                    return
-            else:
-                # Si la tabla hija está vacía, usamos la URL general
-                parent_folder_full_url = doc_biblioteca.url_sp
-                logger.info(f"Tabla hija vacía, usando la URL general para {doctype_name}: {parent_folder_full_url}")
-
-        # Continuar con la lógica de conexión a SharePoint y subida de archivo
-        start_idx = parent_folder_full_url.find('/sites/')
-        if start_idx == -1:
-            logger.error("La URL no contiene '/sites/'. No se puede calcular la ruta relativa.")
+        target = resolve_upload_target(doc)
+        if not target:
             return
-        
-        site_url = parent_folder_full_url[:start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/')]
-        site_relative_path = parent_folder_full_url[start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/') + 1:]
-        logger.info(f"Ruta relativa calculada: {site_relative_path}")
-        logger.info(f"Conectando al contexto del sitio: {site_url}")
 
-        ctx = connect_to_sharepoint_with_token(site_url)
+        frappe.get_doc({
+            "doctype": "Subida SharePoint",
+            "clave": clave,
+            "estado": "Pendiente",
+            "archivo": doc.name,
+            "nombre_archivo": os.path.basename(target["file_path"]),
+            "ruta_archivo": target["file_path"],
+            "documento": doc.attached_to_doctype,
+            "docname": doc.attached_to_name,
+            "site_url": target["site_url"],
+            "ruta_base": target["site_relative_path"],
+            "estructura": json.dumps(target["folder_structure"]),
+            "carpeta_destino": target["target_path"],
+            "siguiente_intento": frappe.utils.now_datetime(),
+        }).insert(ignore_permissions=True)
+        logger.info(f"Subida pendiente registrada para {doc.name} en {target['target_path']}")
+
+        enqueue_pending_uploads()
+    except frappe.DuplicateEntryError:
+        logger.info(f"Subida ya registrada para {doc.name}, se omite.")
+    except Exception as e:
+        logger.error(f"Error al registrar la subida a SharePoint: {str(e)}")
 
-        folder_structure = get_folder_structure(doctype_name, docname, foldername)
-        if not folder_structure:
-            logger.error(f"No se encontró la estructura de carpetas para {doctype_name} con nombre {docname}")
-            return
 
-        current_relative_path = site_relative_path.strip('/')
-        for folder_name in folder_structure:
-            folder_name_sanitized = sanitize_name(folder_name)
-            folder_name_encoded = quote(folder_name_sanitized)
-            create_folder_if_not_exists(ctx, current_relative_path, folder_name_encoded)
-            current_relative_path = f"{current_relative_path}/{folder_name_encoded}".strip('/')
+def enqueue_pending_uploads():
+    frappe.enqueue(
+        "integracion.integracion.subir_archivo_sp.process_pending_uploads",
+        queue="long",
+        job_id="subidas_sharepoint",
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+
+def mark_upload_failed(subida, error):
+    """
+    Registra el fallo de una subida y programa el reintento con espera
+    exponencial, o la marca como 'Error' al agotar los intentos. La carpeta
+    destino se olvida de la caché para que el reintento la vuelva a comprobar
+    (puede haberse borrado en SharePoint).
+    """
+    invalidate_folder_cache(subida.site_url, subida.carpeta_destino)
+
+    intentos = (subida.intentos or 0) + 1
+    values = {"intentos": intentos, "error": str(error)[:1000]}
+    if intentos >= MAX_INTENTOS_SUBIDA:
+        values["estado"] = "Error"
+    else:
+        values["estado"] = "Pendiente"
+        values["siguiente_intento"] = frappe.utils.add_to_date(
+            frappe.utils.now_datetime(), seconds=ESPERA_BASE_SUBIDA * 2 ** (intentos - 1)
+        )
+    frappe.db.set_value("Subida SharePoint", subida.name, values, update_modified=True)
+    logger.error(f"Error al subir {subida.nombre_archivo} (intento {intentos}): {error}")
 
-        with open(file_path, 'rb') as file_content:
-            content = file_content.read()
 
-        file_name = os.path.basename(file_path)
-        file_url = f"{current_relative_path}/{file_name}"
-        logger.info(f"Intentando subir archivo a: {file_url}")
+def process_pending_uploads(lote=LOTE_SUBIDAS):
+    """
+    Worker: vacía la cola de subidas lote a lote hasta que no quedan subidas
+    listas o se agota `TIEMPO_MAXIMO_SUBIDAS`; lo que quede lo recoge el
+    siguiente trabajo del cron. No se vuelve a encolar a sí mismo: con el
+    mismo job_id y deduplicate, un trabajo en marcha cuenta como encolado.
+    """
+    # Recuperar subidas que se quedaron a medias si un worker murió durante la subida
+    frappe.db.set_value(
+        "Subida SharePoint",
+        {"estado": "Subiendo", "modified": ["<", frappe.utils.add_to_date(frappe.utils.now_datetime(), hours=-1)]},
+        "estado", "Pendiente"
+    )
+    frappe.db.commit()
+
+    limite = time.monotonic() + TIEMPO_MAXIMO_SUBIDAS
+    while time.monotonic() < limite and process_upload_batch(lote):
+        pass
 
+
+def process_upload_batch(lote=LOTE_SUBIDAS):
+    """
+    Procesa un lote de subidas listas agrupadas por sitio y carpeta destino,
+    de modo que la autenticación y la creación de carpetas se hacen una vez
+    por grupo y no una vez por archivo. Devuelve el número de subidas del lote.
+    """
+    subidas = frappe.get_all(
+        "Subida SharePoint",
+        filters=[
+            ["estado", "=", "Pendiente"],
+            ["siguiente_intento", "<=", frappe.utils.now_datetime()]
+        ],
+        fields=["name", "archivo", "nombre_archivo", "ruta_archivo", "documento", "docname",
+                "site_url", "ruta_base", "estructura", "carpeta_destino", "intentos"],
+        order_by="creation asc",
+        limit=lote
+    )
+    if not subidas:
+        return 0
+
+    frappe.db.set_value(
+        "Subida SharePoint", {"name": ["in", [s.name for s in subidas]]}, "estado", "Subiendo"
+    )
+    frappe.db.commit()
+
+    grupos = {}
+    for subida in subidas:
+        grupos.setdefault((subida.site_url, subida.carpeta_destino), []).append(subida)
+
+    for (site_url, carpeta_destino), grupo in grupos.items():
+        logger.info(f"Subiendo {len(grupo)} archivos a {site_url}/{carpeta_destino}")
         try:
-            target_folder = ctx.web.get_folder_by_server_relative_url(current_relative_path)
-            ctx.load(target_folder)
-            ctx.execute_query()
+            ctx = connect_to_sharepoint_with_token(site_url)
+            if not ctx:
+                raise Exception(f"No se pudo conectar a SharePoint: {site_url}")
 
-            target_folder.upload_file(file_name, content).execute_query()
-            logger.info(f"Archivo subido: {file_url}")
-            
-            frappe.delete_doc('File', doc.name, force=True)
-            logger.info(f"Archivo {file_name} eliminado de ERPNext")
+            # Una sola llamada (o ninguna si la ruta está en caché) para toda la estructura
+            target_path = ensure_folder_path(ctx, carpeta_destino)
+            target_folder = ctx.web.get_folder_by_server_relative_url(target_path)
         except Exception as e:
-            logger.error(f"Error al subir archivo a SharePoint: {str(e)}")
-    except Exception as e:
-        logger.error(f"Error al subir archivo a SharePoint: {str(e)}")
+            for subida in grupo:
+                mark_upload_failed(subida, e)
+            frappe.db.commit()
+            continue
+
+        for subida in grupo:
+            try:
+                upload_local_file(ctx, target_folder, subida.ruta_archivo, subida.nombre_archivo)
+                file_url = f"{carpeta_destino}/{subida.nombre_archivo}"
+                logger.info(f"Archivo subido: {file_url}")
+
+                frappe.db.set_value("Subida SharePoint", subida.name, {
+                    "estado": "Subido",
+                    "url_sp": f"{site_url}/{file_url}",
+                    "error": None
+                }, update_modified=True)
+                invalidate_structure_cache(subida.documento, subida.docname)
+
+                if frappe.db.exists("File", subida.archivo):
+                    frappe.delete_doc('File', subida.archivo, force=True, ignore_permissions=True)
+                    logger.info(f"Archivo {subida.nombre_archivo} eliminado de ERPNext")
+            except Exception as e:
+                frappe.db.rollback()
+                mark_upload_failed(subida, e)
+            frappe.db.commit()
+
+    return len(subidas)
+
+
+@frappe.whitelist()
+def get_upload_status(doctype, docname):
+    """
+    Devuelve el estado de las subidas a SharePoint de un documento para que
+    la interfaz pueda consultarlo periódicamente.
+    """
+    frappe.has_permission(doctype, "read", docname, throw=True)
+
+    return frappe.get_all(
+        "Subida SharePoint",
+        filters={"documento": doctype, "docname": docname},
+        fields=["name", "nombre_archivo", "estado", "intentos", "error", "url_sp", "modified"],
+        order_by="creation desc"
+    )
 
 
 def on_update_or_create(doc, method):
@@ -475,78 +548,38 @@ def on_update_or_create(doc, method):
 
 
 @frappe.whitelist(allow_guest=True)
-def get_sharepoint_structure(doctype, docname):
+def get_sharepoint_structure(doctype, docname, max_depth=None):
+    max_depth = frappe.utils.cint(max_depth) or None
+
+    # Las aperturas repetidas del mismo documento se sirven desde caché,
+    # con la carpeta resuelta del documento como parte de la clave
+    raiz = get_document_root(doctype, docname)
+    if raiz[0]:
+        estructura_json = get_cached_structure(doctype, docname, max_depth, *raiz)
+        if estructura_json is not None:
+            return estructura_json
+
+    return build_sharepoint_structure(doctype, docname, max_depth, raiz)
+
+
+def build_sharepoint_structure(doctype, docname, max_depth=None, raiz=None):
     foldername = sanitize_name(docname)
     lista = []
     project_type = None
     
     # Verificación específica para "Project"
     if doctype == "Project":
-        project_doc = frappe.get_doc('Project', docname)
-        if project_doc.project_type:
-            project_type = project_doc.project_type
-        else:
+        project_type = frappe.db.get_value('Project', docname, 'project_type')
+        if not project_type:
             logger.info(f"El proyecto no tiene Project type seleccionado")
             return
 
-    # Primera Verificación: Consultar directamente en la tabla hija si existe un registro con docname igual a docname
-    parent_folder_full_url = None
-    if project_type:
-        biblioteca_name = frappe.db.get_value(
-            'Bibliotecas SP Docnames',
-            {'docname': project_type},
-            'parent'
-        )
-        logger.info(f"Tabla hija: {biblioteca_name}")
-    else:
-        biblioteca_name = frappe.db.get_value(
-            'Bibliotecas SP Docnames', 
-            {'docname': docname}, 
-            'parent'
-        )
-        logger.info(f"Tabla hija: {biblioteca_name}")
-
-    if biblioteca_name:
-        # Si existe, obtener la URL del registro padre
-        parent_folder_full_url = frappe.db.get_value('Bibliotecas SP', biblioteca_name, 'url_sp')
-        logger.info(f"URL encontrada en la tabla hija para {doctype} con docname {docname}: {parent_folder_full_url}")
-    else:
-        # Segunda Verificación: Buscar en 'Bibliotecas SP' por doctype_name
-        try:
-            biblioteca_name = frappe.db.get_value('Bibliotecas SP', {'documento': doctype}, 'name')
-
-            if not biblioteca_name:
-                logger.info(f"No se encontró ningún documento en 'Bibliotecas SP' con documento {doctype}.")
-                return json.dumps([])
-
-            doc_biblioteca = frappe.get_doc('Bibliotecas SP', biblioteca_name)
-        except frappe.DoesNotExistError:
-            logger.error(f"No se encontró un documento para el doctype {doctype} en Bibliotecas SP. Terminando la ejecución.")
-            return json.dumps([])
-
-        if doc_biblioteca.docnames:
-            # Si la tabla hija no está vacía, pero no se encontró coincidencia en la búsqueda anterior
-            logger.info(f"Tabla hija no vacía, verificando si {docname} está en la tabla hija.")
-            matching_entry = next((entry for entry in doc_biblioteca.docnames if entry.docname == docname), None)
-            if matching_entry:
-                parent_folder_full_url = doc_biblioteca.url_sp
-            else:
-                logger.info(f"No se encontró una coincidencia en la tabla hija para {docname}, terminando la ejecución.")
-                return json.dumps([])
-        else:
-            # Si la tabla hija está vacía, usamos la URL general
-            parent_folder_full_url = doc_biblioteca.url_sp
-            logger.info(f"Tabla hija vacía, usando la URL general para {doctype}: {parent_folder_full_url}")
-
-    logger.info(f"URL de la carpeta padre: {parent_folder_full_url}")
-
-    start_idx = parent_folder_full_url.find('/sites/')
-    if start_idx == -1:
-        logger.error("La URL no contiene '/sites/'. No se puede calcular la ruta relativa.")
+    biblioteca = resolve_library(doctype, docname, project_type)
+    if not biblioteca:
         return json.dumps([])
-    
-    site_url = parent_folder_full_url[:start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/')]
-    site_relative_path = parent_folder_full_url[start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/') + 1:]
+
+    site_url = biblioteca["site_url"]
+    site_relative_path = biblioteca["site_relative_path"]
     logger.info(f"Ruta relativa calculada: {site_relative_path}")
     logger.info(f"Conectando al contexto del sitio: {site_url}")
 
@@ -676,50 +709,80 @@ def get_sharepoint_structure(doctype, docname):
         current_relative_path = next_relative_path
 
     if carpeta_actual:
-        procesa_carpeta(ctx, site_url, current_relative_path, carpeta_actual)
+        modificados = {}
+        build_tree(site_url, current_relative_path, carpeta_actual, max_depth, modificados)
+
+        # La clave es la carpeta que se ha listado; solo se cachea si es la que
+        # calcula get_document_root, que es con la que se consulta la caché
+        raiz_site_url, raiz_ruta = raiz or get_document_root(doctype, docname)
+        carpeta_listada = normalize_path(current_relative_path).lower()
+        if raiz_site_url and (site_url.lower(), carpeta_listada) == (raiz_site_url.lower(), raiz_ruta):
+            set_cached_structure(doctype, docname, max_depth, site_url, carpeta_listada, modificados, json.dumps(lista))
+        else:
+            logger.info(f"No se cachea la estructura de {doctype} {docname}: se listó {site_url}/{carpeta_listada}")
 
     logger.info(f"Lista: {json.dumps(lista)}")
     return json.dumps(lista)
 
 
 
+def get_document_root(doctype, docname):
+    """
+    URL del sitio y ruta normalizada (en minúsculas) de la carpeta del
+    documento en SharePoint, calculadas con la misma biblioteca y estructura
+    que usa `build_sharepoint_structure`. Devuelve (None, None) si el
+    documento no tiene carpeta.
+    """
+    project_type = frappe.db.get_value("Project", docname, "project_type") if doctype == "Project" else None
+    biblioteca = resolve_library(doctype, docname, project_type)
+    if not biblioteca:
+        return None, None
+
+    folder_structure = get_folder_structure(doctype, docname, sanitize_name(docname))
+    if not folder_structure:
+        return None, None
+
+    carpetas = [sanitize_name(f) for f in folder_structure]
+    # En las salas la carpeta de la modalidad sustituye al primer nivel
+    modalidad = frappe.db.get_value("Room", docname, "custom_modalidad") if doctype == "Room" else None
+    if modalidad:
+        carpetas[0] = sanitize_name(modalidad)
+
+    ruta = "/".join([biblioteca["site_relative_path"].strip('/')] + carpetas)
+    return biblioteca["site_url"], normalize_path(ruta).lower()
+
+
 def procesa_carpeta(ctx, share, ruta, carpeta_actual):
-    try:
-        logger.info(f"Ruta: {ruta}")
-        logger.info(f"Share: {share}")
-        root = ctx.web.get_folder_by_server_relative_url(f'{ruta}')
-        folders = root.folders
-        ctx.load(folders)
-        ctx.execute_query()
-        logger.info(f"Folders loaded: {folders}")  # Log details of loaded folders
-        
-        for folder in folders:
-            logger.info(f"Processing folder: {folder.properties['Name']}")
-            subcarpeta = {
-                "tipo": "C",
-                "nombre": folder.properties["Name"],
-                'url': f"{share}/{ruta}/{folder.properties['Name']}",
-                "children": []
-            }
-            carpeta_actual["children"].append(subcarpeta)
-            procesa_carpeta(ctx, share, f"{ruta}/{folder.properties['Name']}", subcarpeta)
-        
-        files = root.files
-        ctx.load(files)
-        ctx.execute_query()
-        logger.info(f"Files loaded: {files}")  # Log details of loaded files
-        
-        for file in files:
-            carpeta_actual["children"].append({
-                "tipo": "F",
-                "nombre": file.properties["Name"],
-                'url': f"{share}/{ruta}/{file.properties['Name']}"
-            })
-            logger.info(f"File added to list: {file.properties['Name']}")
-        
-        logger.info(f"Estructura obtenida: {json.dumps(carpeta_actual)}")
-    except Exception as e:
-        logger.error(f"Error procesando la carpeta {ruta}: {e}")
+    # Se mantiene por compatibilidad: el listado se hace por niveles en arbol_sp
+    build_tree(share, ruta, carpeta_actual)
+
+
+@frappe.whitelist()
+def get_sharepoint_folder(doctype, docname, url, max_depth=1):
+    """
+    Expande bajo demanda una carpeta devuelta por `get_sharepoint_structure`
+    con `"expandir": True`. Devuelve sus hijos con la misma estructura JSON.
+    """
+    frappe.has_permission(doctype, "read", docname, throw=True)
+
+    site_url, ruta = split_sharepoint_url(url)
+    if not site_url:
+        return json.dumps([])
+
+    # Solo se permite navegar dentro de la carpeta del propio documento, en su sitio y biblioteca
+    root_site_url, root_ruta = get_document_root(doctype, docname)
+    ruta_normalizada = normalize_path(ruta).lower()
+    if (
+        not root_site_url
+        or site_url.lower() != root_site_url.lower()
+        or ".." in ruta_normalizada.split('/')
+        or not (ruta_normalizada == root_ruta or ruta_normalizada.startswith(f"{root_ruta}/"))
+    ):
+        frappe.throw(_("La carpeta no pertenece al documento {0}").format(docname), frappe.PermissionError)
+
+    carpeta = {"children": []}
+    build_tree(site_url, ruta, carpeta, frappe.utils.cint(max_depth) or None)
+    return json.dumps(carpeta["children"])
 
 
 def create_project_folder(doc, method):
@@ -734,61 +797,12 @@ def create_project_folder(doc, method):
         foldername = sanitize_name(docname)
         
         # Obtener la URL de SharePoint del documento
-        parent_folder_full_url = None
-        project_type = None
-        
-        if doc.project_type:
-            project_type = doc.project_type
-            biblioteca_name = frappe.db.get_value(
-                'Bibliotecas SP Docnames',
-                {'docname': project_type},
-                'parent'
-            )
-            logger.info(f"Tabla hija: {biblioteca_name}")
-        else:
-            biblioteca_name = frappe.db.get_value(
-                'Bibliotecas SP Docnames',
-                {'docname': docname},
-                'parent'
-            )
-            logger.info(f"Tabla hija: {biblioteca_name}")
-        
-        if biblioteca_name:
-            parent_folder_full_url = frappe.db.get_value('Bibliotecas SP', biblioteca_name, 'url_sp')
-            logger.info(f"URL encontrada en la tabla hija para Project con docname {docname}: {parent_folder_full_url}")
-        else:
-            # Si no se encuentra en la tabla hija, buscar en 'Bibliotecas SP' general
-            biblioteca_name = frappe.db.get_value('Bibliotecas SP', {'documento': doctype}, 'name')
-            if not biblioteca_name:
-                logger.info(f"No se encontró ningún documento en 'Bibliotecas SP' para {doctype}.")
-                return
-
-            doc_biblioteca = frappe.get_doc('Bibliotecas SP', biblioteca_name)
-
-            if doc_biblioteca.docnames:
-                matching_entry = next((entry for entry in doc_biblioteca.docnames if entry.docname == docname), None)
-                if matching_entry:
-                    parent_folder_full_url = doc_biblioteca.url_sp
-                else:
-                    logger.info(f"No se encontró una coincidencia en la tabla hija para {docname}, cancelando la ejecución.")
-                    return
-            else:
-                parent_folder_full_url = doc_biblioteca.url_sp
-                logger.info(f"Usando la URL general para {doctype}: {parent_folder_full_url}")
-
-        # Verificar que se obtuvo la URL correcta
-        if not parent_folder_full_url:
-            logger.error("No se pudo obtener la URL de la carpeta en SharePoint.")
-            return
-
-        # Obtener la ruta relativa en SharePoint
-        start_idx = parent_folder_full_url.find('/sites/')
-        if start_idx == -1:
-            logger.error("La URL no contiene '/sites/'. No se puede calcular la ruta relativa.")
+        biblioteca = resolve_library(doctype, docname, doc.project_type)
+        if not biblioteca:
             return
 
-        site_url = parent_folder_full_url[:start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/')]
-        site_relative_path = parent_folder_full_url[start_idx + len('/sites/') + parent_folder_full_url[start_idx + len('/sites/'):].find('/') + 1:]
+        site_url = biblioteca["site_url"]
+        site_relative_path = biblioteca["site_relative_path"]
         logger.info(f"Ruta relativa calculada: {site_relative_path}")
         logger.info(f"Conectando al contexto del sitio: {site_url}")
 
@@ -804,10 +818,9 @@ def create_project_folder(doc, method):
         # Crear la estructura de carpetas en SharePoint
         current_relative_path = site_relative_path.strip('/')
         for folder_name in folder_structure:
-            folder_name_sanitized = sanitize_name(folder_name)
-            logger.info(f"Verificando existencia o creando carpeta: {current_relative_path}/{folder_name_sanitized}")
-            create_folder_if_not_exists(ctx, current_relative_path, folder_name_sanitized)
-            current_relative_path = f"{current_relative_path}/{folder_name_sanitized}".strip('/')
+            current_relative_path = f"{current_relative_path}/{sanitize_name(folder_name)}".strip('/')
+        logger.info(f"Verificando existencia o creando ruta: {current_relative_path}")
+        ensure_folder_path(ctx, current_relative_path)
 
         logger.info(f"Carpeta creada exitosamente para el proyecto {docname}.")
 
@@ -1,5 +1,11 @@
 import frappe
-import xml.etree.ElementTree as ET
+from integracion.integracion.escritor_asientos import insert_journal_entries
+from integracion.integracion.renumerar_asientos import limpiar_numeros_transaccion
+from integracion.integracion.progreso import ReporteProgreso, get_job_progress
+from integracion.integracion.indice_nominas import IndiceNominas
+import hashlib
+from contextlib import ExitStack
+from lxml import etree
 from datetime import datetime
 import os
 import logging
@@ -13,13 +19,135 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.ERROR)
 
+class EscritorFallos:
+    """
+    Escribe el XML de fallos según se rechazan los asientos, con la misma
+    estructura que el original (Exportacion/Empresa/Asientos/Asiento), sin
+    mantener el árbol en memoria. Los asientos se agrupan bajo la empresa
+    del archivo original a la que pertenecen.
+    """
+
+    def __init__(self, path):
+        self.pila = ExitStack()
+        self.xf = self.pila.enter_context(etree.xmlfile(path, encoding="utf-8"))
+        self.xf.write_declaration()
+        self.pila.enter_context(self.xf.element("Exportacion", {"Origen": "Nominas", "Destino": "Contabilidad"}))
+        self.empresa_actual = None
+        self.pila_empresa = None
+
+    def set_empresa(self, empresa):
+        if empresa == self.empresa_actual:
+            return
+        if self.pila_empresa:
+            self.pila_empresa.close()
+        self.pila_empresa = ExitStack()
+        self.pila_empresa.enter_context(self.xf.element("Empresa", {
+            "NombreFiscal": empresa[0],
+            "Identificador": empresa[1]
+        }))
+        self.pila_empresa.enter_context(self.xf.element("Asientos"))
+        self.empresa_actual = empresa
+
+    def write_asiento(self, asiento):
+        self.set_empresa(asiento["empresa"])
+        asiento_fallo = etree.Element("Asiento", {
+            "Fecha": asiento["attrib"]['Fecha'],
+            "Nif": asiento["attrib"]['Nif'],
+            "Nombre": asiento["attrib"]['Nombre'],
+            "CP": asiento["attrib"].get('CP', '')
+        })
+        for attrib, text in asiento["apuntes"]:
+            etree.SubElement(asiento_fallo, "Apunte", attrib).text = text
+        self.xf.write(asiento_fallo)
+
+    def close(self):
+        if self.pila_empresa:
+            self.pila_empresa.close()
+        self.pila.close()
+
+
+def hash_asiento(company, nif, fecha, apuntes):
+    """
+    Huella del contenido de un asiento (empresa, NIF, fecha y apuntes tal como
+    vienen en el XML). Se guarda en el Journal Entry para no volver a crear un
+    asiento ya importado si el archivo se sube de nuevo.
+    """
+    contenido = "|".join([company, nif or "", fecha or ""] + [
+        f"{apunte.get('Cuenta')};{apunte.get('Naturaleza')};{(texto or '').strip()}"
+        for apunte, texto in apuntes
+    ])
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+def scan_asientos(xml_path, company):
+    """
+    Primera pasada rápida que no guarda el árbol: devuelve la huella de cada
+    asiento del archivo, con lo que también se obtiene el total.
+    """
+    hashes = []
+    # El archivo viene de fuera: sin entidades externas ni accesos a la red
+    for _, elemento in etree.iterparse(
+        xml_path, events=("end",), tag="Asiento", resolve_entities=False, no_network=True
+    ):
+        apuntes = [(apunte.attrib, apunte.text) for apunte in elemento.iterfind("Apunte")]
+        hashes.append(hash_asiento(company, elemento.get('Nif'), elemento.get('Fecha'), apuntes))
+        release_element(elemento)
+    return hashes
+
+
+def get_imported_hashes(hashes):
+    """
+    Huellas que ya tienen un Journal Entry no cancelado, con una sola consulta
+    sobre el campo indexado 'custom_hash_nomina'.
+    """
+    if not hashes:
+        return set()
+
+    return set(frappe.get_all(
+        "Journal Entry",
+        filters={"custom_hash_nomina": ["in", list(set(hashes))], "docstatus": ["<", 2]},
+        pluck="custom_hash_nomina"
+    ))
+
+
+def release_element(elemento):
+    # Liberar el elemento procesado y los hermanos anteriores que aún cuelgan del padre
+    elemento.clear()
+    while elemento.getprevious() is not None:
+        del elemento.getparent()[0]
+
+
+def iter_asientos(xml_path):
+    """
+    Recorre los asientos del archivo según se leen. Cada asiento se entrega
+    como una copia ligera (empresa, atributos y apuntes) y el elemento se
+    libera en cuanto se ha copiado.
+    """
+    empresa = None
+    for evento, elemento in etree.iterparse(
+        xml_path, events=("start", "end"), tag=("Empresa", "Asiento"), resolve_entities=False, no_network=True
+    ):
+        if elemento.tag == "Empresa":
+            if evento == "start":
+                empresa = (elemento.get('NombreFiscal'), elemento.get('Identificador'))
+                yield {"empresa": empresa, "attrib": None, "apuntes": []}
+            else:
+                release_element(elemento)
+            continue
+
+        if evento == "end":
+            yield {
+                "empresa": empresa,
+                "attrib": dict(elemento.attrib),
+                "apuntes": [(dict(apunte.attrib), apunte.text) for apunte in elemento.iterfind("Apunte")]
+            }
+            release_element(elemento)
+
+
 # Función principal para procesar el archivo XML
 @frappe.whitelist()
 def subir_nominas(company, xml_file):
     logger.debug("Iniciando el proceso de subida de nóminas.")
-        # Publicar el progreso inicial
-
-    progreso = 1
 
 
     if not company:
@@ -31,27 +159,29 @@ def subir_nominas(company, xml_file):
     # Obtener el archivo XML subido
     try:
         file_doc = frappe.get_doc("File", {"file_url": xml_file})
-        xml_content = file_doc.get_content()
+        xml_path = file_doc.get_full_path()
     except Exception as e:
         logger.error(f"Error al obtener el archivo XML: {str(e)}")
         return {'error': f'Error al obtener el archivo XML: {str(e)}'}
 
-    # Cargar el XML
+    # Contar los asientos; esta primera pasada también comprueba que el XML es válido
     try:
-        tree = ET.ElementTree(ET.fromstring(xml_content))
-        root = tree.getroot()
+        hashes = scan_asientos(xml_path, company)
+        total_asientos = len(hashes) + 1
         logger.debug("XML cargado correctamente.")
     except Exception as e:
         logger.error(f"Error al cargar el XML: {str(e)}")
         return {'error': f'Error al cargar el archivo XML: {str(e)}'}
-    
-    total_asientos = len(root.findall("./Empresa/Asientos/Asiento")) + 1
-    frappe.cache().hset('nominas_progreso', 'total_asientos', total_asientos)
-    frappe.cache().hset('nominas_progreso', 'progreso', progreso)
-    frappe.publish_realtime(
-        "subir_nominas_progress", {"progress": [progreso, total_asientos], "message": "Iniciando la carga del archivo XML..."}, user=frappe.session.user
-    )
-    progreso += 1
+
+    # Asientos del archivo ya importados en una subida anterior (completa o interrumpida)
+    importados = get_imported_hashes(hashes)
+    del hashes
+    if importados:
+        logger.info(f"{len(importados)} asientos del archivo ya estaban importados, se omitirán.")
+
+    # Publicar el progreso inicial; el resto se publica por intervalos
+    progreso = ReporteProgreso("subir_nominas_progress")
+    progreso.set_total(total_asientos, actual=1, mensaje="Iniciando la carga del archivo XML...")
     # Obtener la fecha actual para incluir en los nombres de archivo
     current_date = datetime.now().strftime('%Y-%m-%d')
 
@@ -63,13 +193,12 @@ def subir_nominas(company, xml_file):
     temp_folder_path = frappe.get_site_path("private", "files")
     error_log_path = os.path.join(temp_folder_path, error_log_filename)
 
-    # Crear el XML de fallos con la misma estructura que el original
-    root_fallos = ET.Element("Exportacion", attrib={"Origen": "Nominas", "Destino": "Contabilidad"})
-    empresa_fallos = ET.SubElement(root_fallos, "Empresa", attrib={
-        "NombreFiscal": root.find('./Empresa').attrib['NombreFiscal'],
-        "Identificador": root.find('./Empresa').attrib['Identificador']
-    })
-    asientos_fallos = ET.SubElement(empresa_fallos, "Asientos")
+    # Crear el XML de fallos con la misma estructura que el original; se escribe según se rechazan asientos
+    fallo_xml_path = os.path.join(temp_folder_path, fallo_xml_filename)
+    fallos = EscritorFallos(fallo_xml_path)
+
+    # Empleados y cuentas de la empresa, cargados una sola vez para todo el archivo
+    indice = IndiceNominas(company)
 
     # Diccionario para almacenar asientos ya registrados
     asientos_registrados = set()
@@ -77,7 +206,7 @@ def subir_nominas(company, xml_file):
     # Función para registrar errores en el archivo TXT y XML de fallos
     def log_error_and_register_asiento(asiento, nif, motivo):
         # Registrar el error en el archivo TXT
-        fecha_asiento = asiento.attrib['Fecha']
+        fecha_asiento = asiento["attrib"]['Fecha']
         try:
         # Convertir al formato normalizado
             fecha_normalizada = datetime.strptime(fecha_asiento, '%d/%m/%Y').strftime('%Y-%m-%d')
@@ -90,253 +219,217 @@ def subir_nominas(company, xml_file):
         
         logger.debug(f"Registrando asiento fallido: {asiento_id} - {motivo}")
 
-        logger.debug(f"Asientos registrados: {asientos_registrados}")
-
         # Verificar si el asiento ya fue registrado
         if asiento_id in asientos_registrados:
             logger.warning(f"Asiento ya registrado: {asiento_id}. Evitando duplicación.")
             return  # Si ya fue registrado, no hacer nad
         
-        empleado_name = ""
-
-        if frappe.db.exists("Employee", {"custom_dninie_id": nif}):
-            empleado = frappe.get_doc("Employee", {"custom_dninie_id": nif})
-        elif frappe.db.exists("Employee", {"custom_dninie": nif}):
-            empleado = frappe.get_doc("Employee", {"custom_dninie": nif})
-        else:
-            empleado = None
-
-        if empleado:
-            empleado_name = empleado.employee_name
+        empleado_name = indice.get_employee_name(nif)
 
-        with open(error_log_path, 'a') as f:
-            f.write(f"Empleado {nif} {empleado_name} {motivo}\n")
-            logger.error(f"{nif} {empleado_name} - {motivo}")
+        error_log.write(f"Empleado {nif} {empleado_name} {motivo}\n")
+        logger.error(f"{nif} {empleado_name} - {motivo}")
 
         # Registrar el asiento fallido en el XML de fallos
-        asiento_fallo = ET.SubElement(asientos_fallos, "Asiento", attrib={
-            "Fecha": asiento.attrib['Fecha'],
-            "Nif": asiento.attrib['Nif'],
-            "Nombre": asiento.attrib['Nombre'],
-            "CP": asiento.attrib.get('CP', '')
-        })
-        for apunte in asiento.findall("Apunte"):
-            ET.SubElement(asiento_fallo, "Apunte", attrib=apunte.attrib).text = apunte.text
+        fallos.write_asiento(asiento)
         asientos_registrados.add(asiento_id)
 
-    # Limpiar el archivo de errores si ya existe
-    with open(error_log_path, 'w') as f:
-        f.write('Log de errores para la creación de asientos contables desde el XML\n\n')
-    logger.debug("Archivo de errores inicializado.")
-
-    # Función para obtener la cuenta padre de empleados (640 o 4751)
-    def get_parent_employee_account(cuenta_padre, company):
-        parent_account = frappe.get_all('Account', 
-                                        filters={'account_number': cuenta_padre, 'company': company, 'is_group': 1}, 
-                                        fields=['name', 'account_number', 'parent_account'])
-        return parent_account[0] if parent_account else None
-
-    # Función para obtener la cuenta de empleado usando el objeto padre
-    def get_employee_account(parent_account, nif, company):
-        accounts = frappe.get_all('Account', 
-                                  filters={'parent_account': parent_account['name'], 'company': company, 'custom_empleado': nif}, 
-                                  fields=['name', 'account_number'])
-        return accounts[0] if accounts else None
-
-    # Función para obtener la cuenta hija con el número de cuenta más bajo de las cuentas como 642
-    def get_lowest_child_account(parent_account, company):
-        child_accounts = frappe.get_all('Account', 
-                                        filters={'parent_account': parent_account['name'], 'company': company}, 
-                                        fields=['name', 'account_number'], order_by="account_number asc")
-        return child_accounts[0] if child_accounts else None
-
-    # Función para obtener el empleado a partir del NIF
-    def get_employee(nif):
-        # Verifica si existe el empleado con el campo 'custom_dninie_id'
-        if frappe.db.exists('Employee', {'custom_dninie_id': nif}):
-            # Si existe, obtiene el empleado
-            employee = frappe.get_all('Employee', filters={'custom_dninie_id': nif}, fields=['name'])
-        elif frappe.db.exists('Employee', {'custom_dninie': nif}):
-            # Si no existe en 'custom_dninie_id', verifica si existe con 'custom_dninie'
-            employee = frappe.get_all('Employee', filters={'custom_dninie': nif}, fields=['name'])
-        elif frappe.db.exists('Employee', {'name': nif}):
-            # Verificar si existe el empleado con el nombre (nif)
-            employee = frappe.get_all('Employee', filters={'name': nif}, fields=['name'])
-        else:
-            # Si no existe en ninguno de los campos, devuelve None
-            employee = None
-
-        return employee[0] if employee else None
-
-
-    # **Paso 1: Comprobar y ajustar las cuentas en el XML**
-    logger.debug("Comenzando el proceso de validación y ajuste de cuentas.")
-        # Continuar el procesamiento
-    frappe.publish_realtime(
-        "subir_nominas_progress", {"progress": [progreso, total_asientos], "message": "Comprobando cuentas/empleados..."}, user=frappe.session.user
-    )
-    progreso += 1
-
-    
-    for asiento in root.findall("./Empresa/Asientos/Asiento"):
-        nif = asiento.attrib['Nif']
-        
-        # Buscar el empleado en la tabla Employee
-        employee = get_employee(nif)
+    def check_accounts(asiento, nif):
+        """
+        Paso 1: comprueba el empleado y sustituye las cuentas de los apuntes
+        por las subcuentas de la empresa. Devuelve False si el asiento falla.
+        """
+        # Buscar el empleado en el índice
+        employee = indice.get_employee(nif)
         if not employee:
             logger.warning(f"No se encontró un empleado con NIF: {nif}.")
             log_error_and_register_asiento(asiento, nif, "Empleado no encontrado")
-            continue
+            return False
 
         # Iterar sobre los apuntes del asiento
-        for apunte in asiento.findall("Apunte"):
-            cuenta = apunte.attrib['Cuenta']
+        for apunte, _ in asiento["apuntes"]:
+            cuenta = apunte['Cuenta']
             cuenta_prefix = cuenta.split('.')[0]
 
             if cuenta_prefix in ['640', '4751']:
                 # Obtener la cuenta padre para 640 o 4751
-                parent_account = get_parent_employee_account(cuenta_prefix, company)
+                parent_account = indice.get_group_account(cuenta_prefix)
 
                 if not parent_account:
                     logger.warning(f"No se encontró cuenta padre para {cuenta_prefix}.")
                     log_error_and_register_asiento(asiento, nif, "No se encontró cuenta padre")
-                    break  # Salimos del bucle ya que el asiento completo falla
+                    return False  # El asiento completo falla
 
                 # Buscar la cuenta del empleado
-                account = get_employee_account(parent_account, nif, company)
+                account = indice.get_employee_account(parent_account, nif)
 
                 if account:
-                    apunte.set('Cuenta', account['account_number'])
+                    apunte['Cuenta'] = account['account_number']
                     logger.debug(f"Cuenta del empleado actualizada para el NIF {nif}.")
                 else:
                     logger.warning(f"No se encontró cuenta empleado para el NIF {nif}.")
                     log_error_and_register_asiento(asiento, nif, "No se encontró cuenta para el empleado")
-                    break  # Salimos del bucle ya que el asiento completo falla
+                    return False  # El asiento completo falla
 
             else:
                 # Para otras cuentas (como 642), buscar la primera cuenta hija disponible
-                parent_account = frappe.get_all('Account', 
-                                                filters={'account_number': cuenta_prefix, 'company': company, 'is_group': 1}, 
-                                                fields=['name', 'account_number'])
+                parent_account = indice.get_group_account(cuenta_prefix)
                 if parent_account:
-                    parent_account = parent_account[0]
                     # Obtener la cuenta hija con el número de cuenta más bajo
-                    account = get_lowest_child_account(parent_account, company)
+                    account = indice.get_lowest_child_account(parent_account)
 
                     if account:
-                        apunte.set('Cuenta', account['account_number'])
+                        apunte['Cuenta'] = account['account_number']
                         logger.debug(f"Cuenta hija encontrada para la cuenta {cuenta_prefix}.")
                     else:
                         logger.warning(f"No se encontró cuenta hija para la cuenta {cuenta_prefix}.")
                         log_error_and_register_asiento(asiento, nif, f"No se encontró cuenta hija para empresa {cuenta_prefix}")
-                        break  # Salimos del bucle ya que el asiento completo falla
-
-    # **Paso 2: Crear los asientos contables**
-    logger.debug("Comenzando el proceso de creación de asientos contables.")
-        # Continuar el procesamiento
+                        return False  # El asiento completo falla
 
+        return True
 
-    for asiento in root.findall("./Empresa/Asientos/Asiento"):
-        progreso += 1
-        frappe.cache().hset('nominas_progreso', 'progreso', progreso)
-        frappe.publish_realtime(
-            "subir_nominas_progress", {"progress": [progreso, total_asientos], "message": f"Procesando asiento {progreso} de {total_asientos-1}"}, user=frappe.session.user
-        )
-        nif = asiento.attrib['Nif']
-        posting_date = datetime.strptime(asiento.attrib['Fecha'], '%d/%m/%Y').strftime('%Y-%m-%d')  # Convertir la fecha al formato esperado por Frappe
+    def build_journal_entry(asiento, nif):
+        """
+        Paso 2: construye el Journal Entry del asiento o devuelve None si falla.
+        """
+        posting_date = datetime.strptime(asiento["attrib"]['Fecha'], '%d/%m/%Y').strftime('%Y-%m-%d')  # Convertir la fecha al formato esperado por Frappe
 
         concept = f"Nómina {posting_date} para {nif}"
 
-        try:
-            # Verificar si el empleado existe antes de crear el asiento
-            employee = frappe.get_value("Employee", {"custom_dninie_id": nif}, "name") or \
-                       frappe.get_value("Employee", {"custom_dninie": nif}, "name") or \
-                       frappe.get_value("Employee", {"name": nif}, "name")
+        # Verificar si el empleado existe antes de crear el asiento
+        employee = indice.get_employee(nif)
+
+        if not employee:
+            log_error_and_register_asiento(asiento, nif, "Empleado no encontrado")
+            return None
+
+        # Crear el Journal Entry
+        journal_entry = {
+            "doctype": "Journal Entry",
+            "voucher_type": "Journal Entry",
+            "title": concept,
+            "company": company,
+            "posting_date": posting_date,
+            "user_remark": concept,
+            "custom_nomina": 1,
+            "accounts": []
+        }
 
-            if not employee:
-                log_error_and_register_asiento(asiento, nif, "Empleado no encontrado")
+        # Iterar sobre los apuntes del asiento
+        total_debit, total_credit = 0, 0  # Para comprobar el balance
+        cuenta_valida = False  # Verificación si hay alguna cuenta válida
+        for apunte, texto in asiento["apuntes"]:
+            naturaleza = apunte['Naturaleza']
+            amount = float(texto.replace(',', '.'))  # Tomar el texto del nodo, no como atributo
+            account_number = apunte['Cuenta']
+
+            # Obtener la cuenta usando el número de cuenta y la empresa
+            account = indice.get_account(account_number)
+
+            if not account:
+                log_error_and_register_asiento(asiento, nif, f"Cuenta no encontrada: {account_number}")
                 continue
 
-            # Crear el Journal Entry
-            journal_entry = frappe.get_doc({
-                "doctype": "Journal Entry",
-                "voucher_type": "Journal Entry",
-                "title": concept,
-                "company": company,
-                "posting_date": posting_date,
-                "user_remark": concept,
-                "custom_nomina": 1,
-                "accounts": []
+            account_name, account_type = account
+
+            cuenta_valida = True  # Al menos una cuenta válida encontrada
+            debit = amount if naturaleza == "DEBE" else 0
+            credit = amount if naturaleza == "HABER" else 0
+
+            # Preparar los datos adicionales si la cuenta es de tipo Payable/Receivable
+            party_type = None
+            party = None
+
+            if account_type in ["Payable", "Receivable"]:
+                party_type = "Employee"
+                party = employee  # Usamos el valor del empleado verificado previamente
+
+            # Agregar la transacción al Journal Entry
+            journal_entry["accounts"].append({
+                "account": account_name,
+                "debit_in_account_currency": debit,
+                "credit_in_account_currency": credit,
+                "party_type": party_type,
+                "party": party
             })
 
-            # Iterar sobre los apuntes del asiento
-            total_debit, total_credit = 0, 0  # Para comprobar el balance
-            cuenta_valida = False  # Verificación si hay alguna cuenta válida
-            for apunte in asiento.findall("Apunte"):
-                naturaleza = apunte.attrib['Naturaleza']
-                amount = float(apunte.text.replace(',', '.'))  # Tomar el texto del nodo, no como atributo
-                account_number = apunte.attrib['Cuenta']
-
-                # Obtener la cuenta usando el número de cuenta y la empresa
-                account_name = frappe.get_value("Account", {"account_number": account_number, "company": company}, "name")
-
-                if not account_name:
-                    log_error_and_register_asiento(asiento, nif, f"Cuenta no encontrada: {account_number}")
-                    continue
-
-                cuenta_valida = True  # Al menos una cuenta válida encontrada
-                debit = amount if naturaleza == "DEBE" else 0
-                credit = amount if naturaleza == "HABER" else 0
-
-                # Preparar los datos adicionales si la cuenta es de tipo Payable/Receivable
-                account_type = frappe.get_value("Account", account_name, "account_type")
-                party_type = None
-                party = None
-
-                if account_type in ["Payable", "Receivable"]:
-                    party_type = "Employee"
-                    party = employee  # Usamos el valor del empleado verificado previamente
-
-                # Agregar la transacción al Journal Entry
-                journal_entry.append("accounts", {
-                    "account": account_name,
-                    "debit_in_account_currency": debit,
-                    "credit_in_account_currency": credit,
-                    "party_type": party_type,
-                    "party": party
-                })
-
-                total_debit += debit
-                total_credit += credit
-
-            # Verificar el balance del asiento
-            if not cuenta_valida:
-                log_error_and_register_asiento(asiento, nif, "Ninguna cuenta válida encontrada")
+            total_debit += debit
+            total_credit += credit
+
+        # Verificar el balance del asiento
+        if not cuenta_valida:
+            log_error_and_register_asiento(asiento, nif, "Ninguna cuenta válida encontrada")
+            return None
+
+        if round(total_debit, 2) != round(total_credit, 2):
+            difference = round(total_debit - total_credit, 2)
+            log_error_and_register_asiento(asiento, nif, f"Balance con diferencia de {difference}")
+            return None
+
+        return journal_entry
+
+    omitidos = {"total": 0}
+
+    def asientos_validados():
+        """
+        Una sola pasada por el XML: cada asiento se comprueba y se convierte en
+        Journal Entry según se lee; los rechazados van directos a los fallos.
+        """
+        for asiento in iter_asientos(xml_path):
+            if asiento["attrib"] is None:
+                # Inicio de una empresa del archivo: se abre también en el XML de fallos
+                fallos.set_empresa(asiento["empresa"])
+                continue
+
+            progreso.avanzar(mensaje=f"Procesando asiento {progreso.actual + 1} de {total_asientos-1}")
+            nif = asiento["attrib"]['Nif']
+
+            # La huella se calcula antes de sustituir las cuentas de los apuntes. Solo se
+            # omiten los asientos ya importados en la base de datos, no los repetidos en el archivo
+            hash_nomina = hash_asiento(company, nif, asiento["attrib"].get('Fecha'), asiento["apuntes"])
+            if hash_nomina in importados:
+                omitidos["total"] += 1
                 continue
 
-            if round(total_debit, 2) != round(total_credit, 2):
-                difference = round(total_debit - total_credit, 2)
-                log_error_and_register_asiento(asiento, nif, f"Balance con diferencia de {difference}")
+            try:
+                # El paso 2 se ejecuta aunque el paso 1 falle, como cuando eran dos recorridos:
+                # el asiento ya está registrado como fallido y no se vuelve a anotar
+                check_accounts(asiento, nif)
+                journal_entry = build_journal_entry(asiento, nif)
+            except Exception as e:
+                log_error_and_register_asiento(asiento, nif, str(e))
                 continue
 
-            # Insertar el Journal Entry
-            journal_entry.insert(ignore_permissions=True)
-            frappe.db.commit()
-            logger.info(f"Journal Entry creado para el NIF {nif}, fecha {posting_date}.")
+            if journal_entry:
+                journal_entry["custom_hash_nomina"] = hash_nomina
+                yield {"doc": journal_entry, "asiento": asiento, "nif": nif}
 
-        except Exception as e:
-            log_error_and_register_asiento(asiento, nif, str(e))
+    # Insertar los Journal Entry por lotes; un asiento que falla no afecta al resto
+    def registrar_error(asiento_validado, error):
+        log_error_and_register_asiento(asiento_validado["asiento"], asiento_validado["nif"], str(error))
 
-        # Continuar el procesamiento
-    frappe.cache().hset('nominas_progreso', 'progreso', progreso)
-    frappe.publish_realtime(
-        "subir_nominas_progress", {"progress": [progreso, total_asientos], "message": "Guardado fallos y registrando en Doctype..."}, user=frappe.session.user
-    )
+    logger.debug("Comenzando el proceso de validación y creación de asientos contables.")
+    progreso.avanzar(mensaje="Comprobando cuentas/empleados...")
+    progreso.flush(forzar=True)
 
-    # Guardar el XML de fallos con la fecha y el nombre de la empresa
-    fallo_xml_path = os.path.join(temp_folder_path, fallo_xml_filename)
-    fallo_tree = ET.ElementTree(root_fallos)
-    fallo_tree.write(fallo_xml_path)
+    # Limpiar el archivo de errores si ya existe
+    with open(error_log_path, 'w') as error_log:
+        error_log.write('Log de errores para la creación de asientos contables desde el XML\n\n')
+        logger.debug("Archivo de errores inicializado.")
+
+        try:
+            # Los números de asiento asignados dentro de un savepoint deshecho ya no son válidos
+            resumen = insert_journal_entries(asientos_validados(), on_error=registrar_error, on_rollback=limpiar_numeros_transaccion)
+        finally:
+            # Cerrar el XML de fallos
+            fallos.close()
+
+        if omitidos["total"]:
+            error_log.write(f"\nAsientos ya importados anteriormente y omitidos: {omitidos['total']}\n")
+
+    logger.info(f"Journal Entries de nóminas creados: {len(resumen['creados'])} ({resumen['asientos_por_segundo']} asientos/s), {omitidos['total']} ya importados.")
+
+    progreso.set_mensaje("Guardado fallos y registrando en Doctype...")
+    progreso.flush(forzar=True)
 
     # Guardar el archivo de errores y el XML generado en la carpeta de files
     error_log_url = frappe.get_doc({
@@ -358,13 +451,9 @@ def subir_nominas(company, xml_file):
     # Devolver las URLs de los archivos generados para que puedan ser descargados en el frontend
     logger.debug("Proceso completado, generando URLs de los archivos.")
 
-    progreso = total_asientos
-    frappe.cache().hset('nominas_progreso', 'progreso', progreso)
-    frappe.publish_realtime(
-        "subir_nominas_progress", {"progress": [total_asientos, total_asientos], "message": "Proceso completado con éxito."}, user=frappe.session.user
-    )
-    frappe.cache().hdel('nominas_progreso', 'progreso')  # Borrar cuando termine el proceso
-    frappe.cache().hdel('nominas_progreso', 'total_asientos')  # Borrar cuando termine el proceso
+    progreso.actual = total_asientos
+    progreso.set_mensaje("Proceso completado con éxito.")
+    progreso.finalizar()  # Publica el cierre y borra el progreso de la caché
     return {
         "error_log": error_log_url,
         "fallo_xml": fallo_xml_url
@@ -391,13 +480,12 @@ def create_registro(error_log,error_xml,company,date):
         return None
 
 @frappe.whitelist()
-def get_nominas_progreso():
-    progreso = frappe.cache().hget('nominas_progreso', 'progreso')
-    total_asientos = frappe.cache().hget('nominas_progreso', 'total_asientos')
+def get_nominas_progreso(job_id=None):
+    progreso = get_job_progress("subir_nominas_progress", job_id)
 
-    if progreso and total_asientos:
+    if progreso and progreso["progreso"] and progreso["total"]:
         return {
-            "progreso": int(progreso),
-            "total_asientos": int(total_asientos)
+            "progreso": int(progreso["progreso"]),
+            "total_asientos": int(progreso["total"])
         }
     return None
@@ -0,0 +1,62 @@
+import os
+import pickle
+import tempfile
+import frappe
+from openpyxl import load_workbook
+
+# Proceso de validación de hojas del diario (import_journal_entries). Los
+# procesos se crean con spawn: este módulo no lee la configuración del sitio al
+# importarse, así que es lo único que el proceso hijo carga antes del inicializador.
+
+# Índice y compañía del proceso de validación, recibidos en el inicializador
+_indice_proceso = None
+_company_proceso = None
+
+
+def init_validation_process(site, sites_path, indice, company):
+	"""
+	Inicializa el sitio (solo la configuración, sin conexión a la base de
+	datos) y guarda el índice serializado que envía el proceso principal.
+	"""
+	global _indice_proceso, _company_proceso
+	frappe.init(site=site, sites_path=sites_path)
+	_indice_proceso = indice
+	_company_proceso = company
+
+
+def validate_sheet(file_path, sheet_name):
+	"""
+	Valida una hoja completa y escribe sus asientos, según se limpian, en un
+	archivo temporal (un pickle por asiento). Devuelve la ruta del archivo, que
+	el proceso principal lee y borra con `read_validated_sheet`.
+	"""
+	from integracion.integracion.import_journal_entries import clean_sheet
+
+	wb = load_workbook(file_path, read_only=True, data_only=True)
+	fd, ruta = tempfile.mkstemp(prefix="diario_", suffix=".pkl")
+	try:
+		with os.fdopen(fd, "wb") as salida:
+			for asiento in clean_sheet(wb[sheet_name], _indice_proceso, _company_proceso):
+				pickle.dump(asiento, salida, protocol=pickle.HIGHEST_PROTOCOL)
+	except Exception:
+		os.remove(ruta)
+		raise
+	finally:
+		wb.close()
+	return ruta
+
+
+def read_validated_sheet(ruta):
+	"""
+	Emite uno a uno los asientos escritos por `validate_sheet` y borra el archivo.
+	"""
+	try:
+		with open(ruta, "rb") as entrada:
+			while True:
+				try:
+					yield pickle.load(entrada)
+				except EOFError:
+					return
+	finally:
+		if os.path.exists(ruta):
+			os.remove(ruta)
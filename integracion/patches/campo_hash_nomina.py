@@ -0,0 +1,19 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+
+
+def execute():
+    """
+    Campo indexado en Journal Entry con la huella del asiento de nómina del
+    que procede, para que una subida repetida o reanudada no lo duplique.
+    """
+    create_custom_field("Journal Entry", {
+        "fieldname": "custom_hash_nomina",
+        "label": "Hash Nómina",
+        "fieldtype": "Data",
+        "insert_after": "custom_nomina",
+        "read_only": 1,
+        "hidden": 1,
+        "no_copy": 1,
+        "search_index": 1
+    })
@@ -0,0 +1,47 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+
+def execute():
+    """
+    Campos de las facturas con el resultado del último envío al SII.
+    """
+    campos = [
+        {
+            "fieldname": "custom_estado_sii",
+            "label": "Estado SII",
+            "fieldtype": "Data",
+            "insert_after": "custom_descripcion_factura",
+            "read_only": 1,
+            "allow_on_submit": 1,
+            "no_copy": 1,
+            "in_standard_filter": 1
+        },
+        {
+            "fieldname": "custom_csv_sii",
+            "label": "CSV SII",
+            "fieldtype": "Data",
+            "insert_after": "custom_estado_sii",
+            "read_only": 1,
+            "allow_on_submit": 1,
+            "no_copy": 1
+        },
+        {
+            "fieldname": "custom_fecha_envio_sii",
+            "label": "Fecha Envío SII",
+            "fieldtype": "Datetime",
+            "insert_after": "custom_csv_sii",
+            "read_only": 1,
+            "allow_on_submit": 1,
+            "no_copy": 1
+        },
+        {
+            "fieldname": "custom_error_sii",
+            "label": "Error SII",
+            "fieldtype": "Small Text",
+            "insert_after": "custom_fecha_envio_sii",
+            "read_only": 1,
+            "allow_on_submit": 1,
+            "no_copy": 1
+        }
+    ]
+    create_custom_fields({"Sales Invoice": campos, "Purchase Invoice": campos})
@@ -29,7 +29,10 @@ frappe.listview_settings['Journal Entry'] = {
 
         // Suscribirse al canal de progreso para importación de diario
         frappe.realtime.on("import_journal_entries_progreso", function(data) {
-            if (!data.success) {
+            if (data.error) {
+                frappe.hide_progress(__('Procesando diario de asientos'));
+                frappe.msgprint(__('Error al importar el diario de asientos: ') + data.error);
+            } else if (!data.success) {
                 frappe.show_progress(__('Procesando diario de asientos'), data.progress[0], data.progress[1], data.message);
             } else {
                 frappe.hide_progress(__('Procesando diario de asientos'));
@@ -142,8 +145,9 @@ frappe.listview_settings['Journal Entry'] = {
                             company: values.company
                         },
                         callback: function(r) {
-                            if (r.message) {
-                                window.open(r.message);
+                            // La importación sigue en segundo plano; el resultado llega por realtime
+                            if (r.message && r.message.job_id) {
+                                frappe.show_alert({message: __('Importación del diario en curso...'), indicator: 'blue'});
                             }
                         }
                     });
@@ -186,7 +190,15 @@ frappe.listview_settings['Journal Entry'] = {
 
                         // Suscribirse al canal de progreso
                         frappe.realtime.on("renumerar_journal_entries_progress", function(data) {
-                            if (!data.success) {
+                            if (data.success === false) {
+                                // La renumeración se ejecuta en segundo plano: los errores llegan por este canal
+                                frappe.hide_progress();
+                                frappe.realtime.off("renumerar_journal_entries_progress");
+                                frappe.show_alert({
+                                    message: __('Error al renumerar los asientos contables: ') + data.message,
+                                    indicator: 'red'
+                                }, 5);
+                            } else if (!data.success) {
                                 if (data.progress) {
                                     frappe.show_progress(
                                         __('Renumerando asientos'),